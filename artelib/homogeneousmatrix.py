@@ -7,8 +7,8 @@ The HomogeneousMatrix class
 """
 import numpy as np
 # from artelib.euler import Euler
-from artelib.tools import rot2quaternion, buildT
-from artelib import quaternion, rotationmatrix, euler, vector
+from artelib.tools import rot2quaternion, rot2euler, buildT
+from artelib import quaternion, rotationmatrix, euler, vector, homogeneousmatrixarray
 import matplotlib.pyplot as plt
 # from artelib.quaternion import Quaternion
 
@@ -80,6 +80,8 @@ class HomogeneousMatrix():
         elif isinstance(other, vector.Vector):
             u = np.dot(self.array, other.array)
             return vector.Vector(u)
+        elif isinstance(other, homogeneousmatrixarray.HomogeneousMatrixArray):
+            return homogeneousmatrixarray.HomogeneousMatrixArray(np.matmul(self.array, other.array))
 
     def __add__(self, other):
         T = self.array+other.array
@@ -103,7 +105,8 @@ class HomogeneousMatrix():
             tx = self.array[0, 3]
             ty = self.array[1, 3]
             tz = self.array[2, 3]
-            th = self.Q().Euler()[0].abg
+            # caution: rot2euler modifies R
+            th = rot2euler(self.array[0:3, 0:3].copy())[0]
             return np.array([tx, ty, tz, th[0], th[1], th[2]])
 
     def plot(self, title='Homogeneous transformation', block=True):
@@ -147,66 +150,37 @@ class HomogeneousMatrix():
 def compute_homogeneous_transforms(df_data):
     """
     Compute homogeneous transforms from global panda.
+    Returns a HomogeneousMatrixArray (can be indexed as a list of HomogeneousMatrix).
     """
-    transforms = []
-    for i in df_data.index:
-        # CAUTION: THE ORDER IN THE QUATERNION class IS [qw, qx qy qz]
-        # the order in ROS is [qx qy qz qw]
-        qw = df_data['qw'][i]
-        qx = df_data['qx'][i]
-        qy = df_data['qy'][i]
-        qz = df_data['qz'][i]
-        q = [qw, qx, qy, qz]
-        x = df_data['x'][i]
-        y = df_data['y'][i]
-        z = df_data['z'][i]
-        pos = [x, y, z]
-        Q = quaternion.Quaternion(q)
-        Ti = HomogeneousMatrix(pos, Q)
-        transforms.append(Ti)
-    return transforms
+    # CAUTION: THE ORDER IN THE QUATERNION class IS [qw, qx qy qz]
+    # the order in ROS is [qx qy qz qw]
+    q = df_data[['qw', 'qx', 'qy', 'qz']].to_numpy(dtype=float)
+    pos = df_data[['x', 'y', 'z']].to_numpy(dtype=float)
+    return homogeneousmatrixarray.HomogeneousMatrixArray(pos, q)
 
 
 def compute_relative_transformations(global_transforms):
     """
     Given a list of global transforms, obtain n-1 relative transforms.
+    Returns a HomogeneousMatrixArray (can be indexed as a list of HomogeneousMatrix).
     """
-    transforms_relative = []
-    # compute relative transformations
-    for i in range(len(global_transforms) - 1):
-        Ti = global_transforms[i]
-        Tj = global_transforms[i + 1]
-        Tij = Ti.inv() * Tj
-        transforms_relative.append(Tij)
-    return transforms_relative
+    return homogeneousmatrixarray.HomogeneousMatrixArray(global_transforms).relative()
 
 
-def compute_global_transformations(transforms_relative, T0, Trobot_gps):
+def compute_global_transformations(transforms_relative, T0, Trobot_gps=None):
     """
     Compute global transformations from relative transformations, starting at T0.
+    Returns a HomogeneousMatrixArray (can be indexed as a list of HomogeneousMatrix).
     """
     if T0 is None:
-        T = HomogeneousMatrix()
-    else:
-        T = T0
+        T0 = HomogeneousMatrix()
     if Trobot_gps is None:
         Trobot_gps = HomogeneousMatrix()
-    transforms_global = []
-    transforms_global.append(T0)
     # compute global transformations from relative
-    for i in range(len(transforms_relative)):
-        Tij = transforms_relative[i]
-        # Tij.print_nice()
-        T = T*Tij
-        transforms_global.append(T)
+    transforms_global = homogeneousmatrixarray.HomogeneousMatrixArray(transforms_relative).cumulative(T0)
     # given that the global coordinates are computed, now compute a relative transform
-    for i in range(len(transforms_global)):
-        transforms_global[i] = transforms_global[i]*Trobot_gps
-    return transforms_global
+    return transforms_global*Trobot_gps
 
 
 def multiply_by_transform(transforms, Trel):
-    transforms_result = []
-    for i in range(len(transforms)):
-        transforms_result.append(transforms[i]*Trel)
-    return transforms_result
\ No newline at end of file
+    return homogeneousmatrixarray.HomogeneousMatrixArray(transforms)*Trel
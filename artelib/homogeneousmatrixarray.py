@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+The HomogeneousMatrixArray class. A trajectory of N poses stored as a single (N, 4, 4) np array.
+All the operations are vectorized, instead of allocating a HomogeneousMatrix object per pose.
+@Authors: Arturo Gil
+@Time: April 2023
+"""
+import numpy as np
+from artelib.tools import quaternion2rot_array, rot2quaternion_array, rot2euler_array
+from artelib import homogeneousmatrix
+
+
+class HomogeneousMatrixArray():
+    def __init__(self, *args):
+        """
+        Build from:
+            - nothing: an empty array of transforms.
+            - a (N, 4, 4) or (4, 4) np array.
+            - a list of HomogeneousMatrix (or 4x4 arrays).
+            - a HomogeneousMatrixArray.
+            - two args: positions (N, 3) and quaternions (N, 4) [qw, qx, qy, qz].
+        """
+        if len(args) == 0:
+            self.array = np.zeros((0, 4, 4))
+        elif len(args) == 1:
+            if isinstance(args[0], HomogeneousMatrixArray):
+                self.array = args[0].toarray()
+            elif isinstance(args[0], homogeneousmatrix.HomogeneousMatrix):
+                self.array = args[0].toarray()[np.newaxis, :, :]
+            elif isinstance(args[0], np.ndarray):
+                self.array = args[0]
+            else:
+                self.array = np.array([T.toarray() if isinstance(T, homogeneousmatrix.HomogeneousMatrix) else T
+                                       for T in args[0]], dtype=float)
+            if self.array.ndim == 2:
+                self.array = self.array[np.newaxis, :, :]
+            self.array = self.array.reshape(-1, 4, 4)
+        elif len(args) == 2:
+            positions = np.asarray(args[0], dtype=float)
+            quaternions = np.asarray(args[1], dtype=float)
+            self.array = np.zeros((len(positions), 4, 4))
+            self.array[:, 0:3, 0:3] = quaternion2rot_array(quaternions)
+            self.array[:, 0:3, 3] = positions
+            self.array[:, 3, 3] = 1
+
+    def __str__(self):
+        return str(self.array)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, item):
+        """
+        An integer index returns a HomogeneousMatrix, a slice or an array of indexes returns a HomogeneousMatrixArray.
+        """
+        if isinstance(item, (int, np.integer)):
+            return homogeneousmatrix.HomogeneousMatrix(self.array[item].copy())
+        return HomogeneousMatrixArray(self.array[item])
+
+    def __iter__(self):
+        for i in range(len(self.array)):
+            yield self[i]
+
+    def toarray(self):
+        return self.array
+
+    def tolist(self):
+        """
+        A list of HomogeneousMatrix, as used across the code.
+        """
+        return [homogeneousmatrix.HomogeneousMatrix(T) for T in self.array.copy()]
+
+    def append(self, T):
+        """
+        Append T (HomogeneousMatrix or HomogeneousMatrixArray) at the end, in place (as list.append).
+        Caution: the array is copied on each call. Build long trajectories as a list and convert them at the end.
+        """
+        self.array = np.concatenate((self.array, HomogeneousMatrixArray(T).array))
+
+    def inv(self):
+        return HomogeneousMatrixArray(np.linalg.inv(self.array))
+
+    def pos(self):
+        """
+        The positions as a (N, 3) array.
+        """
+        return self.array[:, 0:3, 3]
+
+    def R(self):
+        """
+        The rotation matrices as a (N, 3, 3) array.
+        """
+        return self.array[:, 0:3, 0:3]
+
+    def Q(self):
+        """
+        The orientations as a (N, 4) array of quaternions [qw, qx, qy, qz].
+        """
+        return rot2quaternion_array(self.array)
+
+    def euler(self):
+        """
+        Both Euler XYZ solutions as (N, 3) arrays.
+        """
+        return rot2euler_array(self.array)
+
+    def __mul__(self, other):
+        """
+        Compose transforms:
+            - with a HomogeneousMatrixArray of the same length: T[i]*other[i]
+            - with a HomogeneousMatrix: T[i]*other
+        """
+        if isinstance(other, HomogeneousMatrixArray):
+            return HomogeneousMatrixArray(np.matmul(self.array, other.array))
+        elif isinstance(other, homogeneousmatrix.HomogeneousMatrix):
+            return HomogeneousMatrixArray(np.matmul(self.array, other.array))
+        return NotImplemented
+
+    def __rmul__(self, other):
+        """
+        Compose a HomogeneousMatrix on the left: other*T[i]
+        """
+        if isinstance(other, homogeneousmatrix.HomogeneousMatrix):
+            return HomogeneousMatrixArray(np.matmul(other.array, self.array))
+        return NotImplemented
+
+    def relative(self):
+        """
+        The n-1 relative transforms between consecutive poses: T[i].inv()*T[i+1]
+        """
+        return HomogeneousMatrixArray(np.matmul(np.linalg.inv(self.array[:-1]), self.array[1:]))
+
+    def cumulative(self, T0=None):
+        """
+        The global transforms from relative transforms, starting at T0 (n+1 transforms):
+        T0, T0*T[0], T0*T[0]*T[1], ...
+        The cumulative product is computed as a parallel prefix scan: log2(n) steps of vectorized matmul.
+        """
+        if T0 is None:
+            T0 = homogeneousmatrix.HomogeneousMatrix()
+        T = self.array.copy()
+        k = 1
+        while k < len(T):
+            T[k:] = np.matmul(T[:-k], T[k:])
+            k = 2*k
+        T = np.matmul(T0.toarray(), T)
+        return HomogeneousMatrixArray(np.concatenate((T0.toarray()[np.newaxis, :, :], T)))
+
+    def t2v(self, n=2):
+        """
+        Vectorized HomogeneousMatrix.t2v. Returns a (N, 3) array [tx, ty, th] if n == 2 or
+        a (N, 6) array [tx, ty, tz, alpha, beta, gamma] otherwise.
+        """
+        if n == 2:
+            th = np.arctan2(self.array[:, 1, 0], self.array[:, 0, 0])
+            return np.column_stack((self.array[:, 0, 3], self.array[:, 1, 3], th))
+        else:
+            th = rot2euler_array(self.array)[0]
+            return np.column_stack((self.array[:, 0:3, 3], th))
@@ -172,6 +172,114 @@ def rot2quaternion(R):
     return Q
 
 
+def quaternion2rot_array(Q):
+    """
+    Vectorized version of quaternion2rot.
+    Q is a (N, 4) array of quaternions [qw, qx, qy, qz]. Returns a (N, 3, 3) array of rotation matrices.
+    """
+    Q = np.asarray(Q)
+    qw = Q[:, 0]
+    qx = Q[:, 1]
+    qy = Q[:, 2]
+    qz = Q[:, 3]
+    R = np.empty((len(Q), 3, 3))
+    R[:, 0, 0] = 1 - 2 * qy**2 - 2 * qz**2
+    R[:, 0, 1] = 2 * qx * qy - 2 * qz * qw
+    R[:, 0, 2] = 2 * qx * qz + 2 * qy * qw
+    R[:, 1, 0] = 2 * qx * qy + 2 * qz * qw
+    R[:, 1, 1] = 1 - 2*qx**2 - 2*qz**2
+    R[:, 1, 2] = 2 * qy * qz - 2 * qx * qw
+    R[:, 2, 0] = 2 * qx * qz - 2 * qy * qw
+    R[:, 2, 1] = 2 * qy * qz + 2 * qx * qw
+    R[:, 2, 2] = 1 - 2 * qx**2 - 2 * qy**2
+    return R
+
+
+def rot2quaternion_array(R):
+    """
+    Vectorized version of rot2quaternion.
+    R is a (N, 3, 3) (or (N, 4, 4)) array. Returns a (N, 4) array of quaternions [qw, qx, qy, qz].
+    The branches on the dominant element of the diagonal are computed with masks.
+    """
+    R = np.asarray(R)[:, 0:3, 0:3]
+    tr = np.trace(R, axis1=1, axis2=2) + 1
+    # caution: tr should not be negative
+    tr = np.maximum(0.0, tr)
+    s = np.sqrt(tr) / 2.0
+    kx = R[:, 2, 1] - R[:, 1, 2]  # Oz - Ay
+    ky = R[:, 0, 2] - R[:, 2, 0]  # Ax - Nz
+    kz = R[:, 1, 0] - R[:, 0, 1]  # Ny - Ox
+
+    # equation(7)
+    k = np.argmax(np.diagonal(R, axis1=1, axis2=2), axis=1)
+    # Nx dominates
+    kx1 = R[:, 0, 0] - R[:, 1, 1] - R[:, 2, 2] + 1
+    ky1 = R[:, 1, 0] + R[:, 0, 1]
+    kz1 = R[:, 2, 0] + R[:, 0, 2]
+    sgn = np.where(kx >= 0, 1, -1)
+    # Oy dominates
+    idx = k == 1
+    kx1[idx] = R[idx, 1, 0] + R[idx, 0, 1]
+    ky1[idx] = R[idx, 1, 1] - R[idx, 0, 0] - R[idx, 2, 2] + 1
+    kz1[idx] = R[idx, 2, 1] + R[idx, 1, 2]
+    sgn[idx] = np.where(ky[idx] >= 0, 1, -1)
+    # Az dominates
+    idx = k == 2
+    kx1[idx] = R[idx, 2, 0] + R[idx, 0, 2]
+    ky1[idx] = R[idx, 2, 1] + R[idx, 1, 2]
+    kz1[idx] = R[idx, 2, 2] - R[idx, 0, 0] - R[idx, 1, 1] + 1
+    sgn[idx] = np.where(kz[idx] >= 0, 1, -1)
+    # equation(8)
+    kx = kx + sgn * kx1
+    ky = ky + sgn * ky1
+    kz = kz + sgn * kz1
+
+    nm = np.sqrt(kx**2 + ky**2 + kz**2)
+    # handle special case of null quaternion
+    null = nm == 0
+    nm[null] = 1.0
+    # equation(10)
+    c = np.sqrt(np.maximum(0.0, 1 - s**2))/nm
+    Q = np.column_stack((s, c*kx, c*ky, c*kz))
+    Q[null] = np.array([1, 0, 0, 0])
+    return Q
+
+
+def rot2euler_array(R):
+    """
+    Vectorized version of rot2euler.
+    R is a (N, 3, 3) (or (N, 4, 4)) array. Returns both solutions e1, e2 as (N, 3) arrays of Euler angles (XYZ).
+    The degenerate case is computed with masks.
+    """
+    R = np.asarray(R)[:, 0:3, 0:3]
+    r02 = np.clip(R[:, 0, 2], -1, 1)
+    th = np.abs(np.abs(r02)-1.0)
+    beta1 = np.arcsin(r02)
+    # caso no degenerado
+    beta2 = np.pi - beta1
+    s1 = np.sign(np.cos(beta1))
+    s2 = np.sign(np.cos(beta2))
+    alpha1 = np.arctan2(-s1*R[:, 1, 2], s1*R[:, 2, 2])
+    gamma1 = np.arctan2(-s1*R[:, 0, 1], s1*R[:, 0, 0])
+    alpha2 = np.arctan2(-s2*R[:, 1, 2], s2*R[:, 2, 2])
+    gamma2 = np.arctan2(-s2*R[:, 0, 1], s2*R[:, 0, 0])
+    # caso degenerado
+    degenerate = th <= 0.0001
+    positive = beta1 > 0
+    alpha1 = np.where(degenerate, 0, alpha1)
+    alpha2 = np.where(degenerate, np.pi, alpha2)
+    beta2 = np.where(degenerate, np.where(positive, np.pi/2, -np.pi/2), beta2)
+    gamma_degenerate = np.where(positive, np.arctan2(R[:, 1, 0], R[:, 1, 1]), np.arctan2(-R[:, 1, 0], R[:, 1, 1]))
+    gamma1 = np.where(degenerate, gamma_degenerate, gamma1)
+    gamma2 = np.where(degenerate, gamma_degenerate - np.pi, gamma2)
+    # finally normalize to +-pi
+    e1 = np.column_stack((alpha1, beta1, gamma1))
+    e2 = np.column_stack((alpha2, beta2, gamma2))
+    e1 = np.arctan2(np.sin(e1), np.cos(e1))
+    e2 = np.arctan2(np.sin(e2), np.cos(e2))
+    return e1, e2
+
+
 def mod_sign(x):
     """
        modified  version of sign() function as per   the    paper
@@ -275,6 +383,49 @@ def rot2euler(R):
     return e1, e2
 
 
+def euler2rot_array(abg):
+    """
+    Vectorized version of euler2rot.
+    abg is a (N, 3) array of Euler angles (XYZ). Returns a (N, 3, 3) array of rotation matrices R = Rx*Ry*Rz.
+    """
+    abg = np.asarray(abg)
+    calpha = np.cos(abg[:, 0])
+    salpha = np.sin(abg[:, 0])
+    cbeta = np.cos(abg[:, 1])
+    sbeta = np.sin(abg[:, 1])
+    cgamma = np.cos(abg[:, 2])
+    sgamma = np.sin(abg[:, 2])
+    R = np.empty((len(abg), 3, 3))
+    R[:, 0, 0] = cbeta*cgamma
+    R[:, 0, 1] = -cbeta*sgamma
+    R[:, 0, 2] = sbeta
+    R[:, 1, 0] = calpha*sgamma + salpha*sbeta*cgamma
+    R[:, 1, 1] = calpha*cgamma - salpha*sbeta*sgamma
+    R[:, 1, 2] = -salpha*cbeta
+    R[:, 2, 0] = salpha*sgamma - calpha*sbeta*cgamma
+    R[:, 2, 1] = salpha*cgamma + calpha*sbeta*sgamma
+    R[:, 2, 2] = calpha*cbeta
+    return R
+
+
+def euler2q_array(abg):
+    """
+    Vectorized version of euler2q. Returns a (N, 4) array of quaternions [qw, qx, qy, qz].
+    """
+    R = euler2rot_array(abg=abg)
+    Q = rot2quaternion_array(R)
+    return Q
+
+
+def q2euler_array(Q):
+    """
+    Vectorized version of q2euler. Returns both solutions e1, e2 as (N, 3) arrays.
+    """
+    R = quaternion2rot_array(Q)
+    abg = rot2euler_array(R)
+    return abg
+
+
 def euler2q(abg):
     R = euler2rot(abg=abg)
     Q = rot2quaternion(R)
@@ -29,6 +29,28 @@ class Icp_parameters():
 
             self.distance_threshold = config.get('icp').get('distance_threshold')
 
+            self.pyramid_voxel_sizes = config.get('icp_pyramid').get('voxel_sizes')
+            self.pyramid_distance_thresholds = config.get('icp_pyramid').get('distance_thresholds')
+            self.pyramid_max_iterations = config.get('icp_pyramid').get('max_iterations')
+            self.pyramid_relative_fitness = config.get('icp_pyramid').get('relative_fitness')
+            self.pyramid_relative_rmse = config.get('icp_pyramid').get('relative_rmse')
+            check_icp_pyramid(voxel_sizes=self.pyramid_voxel_sizes,
+                              distance_thresholds=self.pyramid_distance_thresholds,
+                              max_iterations=self.pyramid_max_iterations)
+
+
+def check_icp_pyramid(voxel_sizes, distance_thresholds, max_iterations):
+    """
+    The icp_pyramid section lists the voxel sizes of the coarse levels only: the finest level is always the pointcloud
+    filtered with the voxel_size of down_sample. distance_thresholds and max_iterations give a value for each coarse
+    level plus one for the finest level, so len(voxel_sizes) == len(distance_thresholds) - 1 == len(max_iterations) - 1
+    """
+    if not (len(voxel_sizes) == len(distance_thresholds) - 1 == len(max_iterations) - 1):
+        raise ValueError('icp_pyramid: expected len(voxel_sizes) == len(distance_thresholds) - 1 == '
+                         'len(max_iterations) - 1 (the finest level is the pointcloud filtered with voxel_size). '
+                         'Found voxel_sizes: ' + str(voxel_sizes) + ', distance_thresholds: ' +
+                         str(distance_thresholds) + ', max_iterations: ' + str(max_iterations))
+
 
 # EXP_PARAMETERS = Exp_parameters()
 ICP_PARAMETERS = Icp_parameters()
\ No newline at end of file
@@ -1,8 +1,10 @@
 import numpy as np
 import yaml
 
-from artelib.homogeneousmatrix import HomogeneousMatrix
+from artelib.homogeneousmatrix import HomogeneousMatrix, compute_homogeneous_transforms
+from artelib.homogeneousmatrixarray import HomogeneousMatrixArray
 from artelib.quaternion import Quaternion
+from artelib.tools import q2euler_array
 import pandas as pd
 import matplotlib.pyplot as plt
 import os
@@ -43,7 +45,13 @@ class EurocReader():
     def save_csv(self, df, filename):
         df.to_csv(self.directory+filename)
 
-    def save_transforms_as_csv(self, sensor_times, transforms, filename):
+    def save_transforms_as_csv(self, sensor_times, transforms, filename, save_binary=False):
+        """
+        Save the transforms in EuRoC format (#timestamp [ns], x, y, z, qx, qy, qz, qw).
+        The positions and quaternions of all the transforms are computed at once.
+        If save_binary, the times and the (N, 4, 4) transforms are also saved to a .npz file next to the csv file,
+        so that they can be read back without any conversion (see read_transforms).
+        """
         global_filename = self.directory+filename
         import os
         global_directory = os.path.dirname(os.path.abspath(global_filename))
@@ -51,18 +59,40 @@ class EurocReader():
             os.makedirs(global_directory)
         except OSError:
             print("Directory exists or creation failed", global_directory)
-        data_list = []
-        for i in range(len(transforms)):
-            Ti = transforms[i]
-            t = Ti.pos()
-            q = Ti.Q()
-            data_list.append({'#timestamp [ns]': sensor_times[i],
-                         'x': t[0], 'y': t[1], 'z': t[2],
-                         'qx': q[1], 'qy': q[2], 'qz': q[3], 'qw': q[0]})
-        df = pd.DataFrame(data_list)
+        transforms = HomogeneousMatrixArray(transforms)
+        # caution: there may be more times than transforms (i.e. relative transforms)
+        sensor_times = np.asarray(sensor_times)[0:len(transforms)]
+        t = transforms.pos()
+        q = transforms.Q()
+        df = pd.DataFrame({'#timestamp [ns]': sensor_times,
+                           'x': t[:, 0], 'y': t[:, 1], 'z': t[:, 2],
+                           'qx': q[:, 1], 'qy': q[:, 2], 'qz': q[:, 3], 'qw': q[:, 0]})
         df.to_csv(self.directory+filename)
+        if save_binary:
+            np.savez(self.binary_filename(filename), times=sensor_times, transforms=transforms.toarray())
         return df
 
+    def binary_filename(self, filename):
+        return self.directory + os.path.splitext(filename)[0] + '.npz'
+
+    def read_transforms(self, filename):
+        """
+        Read the times and transforms saved with save_transforms_as_csv.
+        The binary .npz file is used if found and up to date with the csv file. Else, the csv file is read and the
+        transforms are computed from it.
+        Returns the times and a HomogeneousMatrixArray.
+        """
+        csv_filename = self.directory + filename
+        binary_filename = self.binary_filename(filename)
+        if os.path.exists(binary_filename) and \
+                (not os.path.exists(csv_filename) or os.path.getmtime(binary_filename) >= os.path.getmtime(csv_filename)):
+            print('Reading transforms from: ', binary_filename)
+            data = np.load(binary_filename)
+            return data['times'], HomogeneousMatrixArray(data['transforms'])
+        df = self.read_csv(filename)
+        times = df['#timestamp [ns]'].to_numpy()
+        return times, compute_homogeneous_transforms(df)
+
     def save_sensor_times_as_csv(self, sensor_times, filename):
         global_filename = self.directory+filename
         import os
@@ -106,22 +136,19 @@ class EurocReader():
         Get odometry times separated by dxy (m) and dth (rad)
         """
         df_odo = self.read_csv('/robot0/lidar/data.csv')
-        odo_times = []
-        for ind in df_odo.index:
-            # print(df_odo['x'][ind])
-            position = [df_odo['x'][ind], df_odo['y'][ind], df_odo['z'][ind]]
-            q = Quaternion([df_odo['qw'][ind], df_odo['qx'][ind], df_odo['qy'][ind], df_odo['qz'][ind]])
-            th = q.Euler()
-            odo = np.array([position[0], position[1], th.abg[2]])
-            current_time = df_odo['#timestamp [ns]'][ind]
-            if ind == 0:
-                odo_times.append(current_time)
-                odoi = odo
-            odoi1 = odo
+        # convert all the orientations at once
+        q = df_odo[['qw', 'qx', 'qy', 'qz']].to_numpy(dtype=float)
+        th = q2euler_array(q)[0]
+        odo = np.column_stack((df_odo['x'].to_numpy(), df_odo['y'].to_numpy(), th[:, 2]))
+        times = df_odo['#timestamp [ns]'].to_numpy()
+        odo_times = [times[0]]
+        odoi = odo[0]
+        for ind in range(1, len(odo)):
+            odoi1 = odo[ind]
             dxy = np.linalg.norm(odoi1[0:2]-odoi[0:2])
             dth = np.linalg.norm(odoi1[2]-odoi[2])
             if dxy > deltaxy or dth > deltath:
-                odo_times.append(current_time)
+                odo_times.append(times[ind])
                 odoi = odoi1
         return np.array(odo_times)
 
@@ -130,29 +157,66 @@ class EurocReader():
         For each time in master_sensor_times, find the closest time in sensor_times.
         The resulting time vector has the same dimensions as master_sensor_times
         """
-        output_times = []
-        # for each master_sensor_times, find the closest time in sensor_times
-        for timestamp in master_sensor_times:
-            d = np.abs(sensor_times-timestamp)
-            index = np.argmin(d)
-            time_diff_s = d[index]
-            output_times.append(sensor_times[index])
-            if time_diff_s > warning_max_time_dif_s:
-                print('CAUTION!!! Found time difference (s): ', time_diff_s/1e9)
-                print('CAUTION!!! Should we associate data??')
-        output_times = np.array(output_times)
+        sensor_times = np.asarray(sensor_times)
+        indexes, time_diffs = self.get_closest_indexes(master_sensor_times=master_sensor_times,
+                                                       sensor_times=sensor_times,
+                                                       warning_max_time_dif_s=warning_max_time_dif_s)
+        output_times = sensor_times[indexes]
         return output_times
 
+    def get_closest_indexes(self, master_sensor_times, sensor_times, warning_max_time_dif_s=0.5*1e9):
+        """
+        For each time in master_sensor_times, find the index of the closest time in sensor_times, using a binary
+        search on the sorted sensor_times (O((N+M)logM)).
+        Returns the indexes in sensor_times and the absolute time differences.
+        As with np.argmin, ties are resolved by choosing the first index in sensor_times.
+        """
+        master_sensor_times = np.asarray(master_sensor_times)
+        sensor_times = np.asarray(sensor_times)
+        # sensor_times are usually sorted, but this is not assumed
+        order = np.argsort(sensor_times, kind='stable')
+        sorted_times = sensor_times[order]
+        n = len(sorted_times)
+        # the sorted times right after and right before each master time
+        right = np.clip(np.searchsorted(sorted_times, master_sensor_times, side='left'), 0, n-1)
+        left = np.clip(right - 1, 0, n-1)
+        # in case of repeated times, the first one in sensor_times (stable sort)
+        left = order[np.searchsorted(sorted_times, sorted_times[left], side='left')]
+        right = order[np.searchsorted(sorted_times, sorted_times[right], side='left')]
+        diff_left = np.abs(sensor_times[left] - master_sensor_times)
+        diff_right = np.abs(sensor_times[right] - master_sensor_times)
+        select_left = (diff_left < diff_right) | ((diff_left == diff_right) & (left <= right))
+        indexes = np.where(select_left, left, right)
+        time_diffs = np.abs(sensor_times[indexes] - master_sensor_times)
+        exceeded = time_diffs > warning_max_time_dif_s
+        if np.any(exceeded):
+            print('CAUTION!!! Found ', np.sum(exceeded), ' time differences above (s): ', warning_max_time_dif_s/1e9)
+            print('CAUTION!!! Maximum time difference (s): ', np.max(time_diffs)/1e9, ' at master times: ',
+                  master_sensor_times[exceeded])
+            print('CAUTION!!! Should we associate data??')
+        return indexes, time_diffs
+
     def get_df_at_times(self, df_data, time_list):
         """
-        Build a pandas df from exaclty the times specified
+        Build a pandas df from exaclty the times specified.
+        All the rows in df_data found at each time are returned, in the order of time_list (repeated times
+        produce repeated rows). The rows are selected in a single call, using an index sorted by time.
         """
-        df = pd.DataFrame(columns=['#timestamp [ns]', 'x', 'y', 'z', 'qx', 'qy', 'qz', 'qw'])
-        # now find odo corresponding to closest times
-        for timestamp in time_list:
-            # find the exact timestamp in df
-            ind = df_data['#timestamp [ns]'] == timestamp
-            row = df_data.loc[ind]
-            df = pd.concat([df, row], ignore_index=True)
+        columns = ['#timestamp [ns]', 'x', 'y', 'z', 'qx', 'qy', 'qz', 'qw']
+        data_times = df_data['#timestamp [ns]'].to_numpy()
+        time_list = np.asarray(time_list)
+        # build the time index once
+        order = np.argsort(data_times, kind='stable')
+        sorted_times = data_times[order]
+        # the rows at each time are in [start, end) in the sorted index
+        start = np.searchsorted(sorted_times, time_list, side='left')
+        end = np.searchsorted(sorted_times, time_list, side='right')
+        counts = end - start
+        # the position in the sorted index of all the rows, concatenated in the order of time_list
+        offsets = np.repeat(start - np.cumsum(counts) + counts, counts)
+        positions = order[np.arange(np.sum(counts)) + offsets]
+        df = df_data.iloc[positions].reset_index(drop=True)
+        # keep the same columns: the transform columns first, then the rest of columns in df_data
+        columns = columns + [column for column in df_data.columns if column not in columns]
+        df = df.reindex(columns=columns)
         return df
-
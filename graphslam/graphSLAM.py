@@ -7,6 +7,7 @@ import gtsam.utils.plot as gtsam_plot
 import matplotlib.pyplot as plt
 import numpy as np
 from artelib.homogeneousmatrix import HomogeneousMatrix
+from artelib.homogeneousmatrixarray import HomogeneousMatrixArray
 
 
 # Declare the 3D translational standard deviations of the prior factor's Gaussian model, in meters.
@@ -53,12 +54,68 @@ ODO_NOISE = gtsam.noiseModel.Diagonal.Sigmas(np.array([odo_rpy_sigma*np.pi/180,
 GPS_NOISE = gtsam.Point3(gps_xy_sigma, gps_xy_sigma, gps_altitude_sigma)
 
 
+def robust_noise(noise, robust_kernel, robust_kernel_parameter):
+    """
+    Wrap the noise model with a robust kernel: 'huber', 'cauchy' or 'dcs' (Dynamic Covariance Scaling).
+    None returns the same (Gaussian) noise model.
+    """
+    if robust_kernel is None:
+        return noise
+    elif robust_kernel == 'huber':
+        estimator = gtsam.noiseModel.mEstimator.Huber.Create(robust_kernel_parameter)
+    elif robust_kernel == 'cauchy':
+        estimator = gtsam.noiseModel.mEstimator.Cauchy.Create(robust_kernel_parameter)
+    elif robust_kernel == 'dcs':
+        estimator = gtsam.noiseModel.mEstimator.DCS.Create(robust_kernel_parameter)
+    else:
+        raise Exception('Unknown robust kernel: ' + str(robust_kernel))
+    return gtsam.noiseModel.Robust.Create(estimator, noise)
+
+
+def extract_poses(values):
+    """
+    All the Pose3 in values (sorted by key) as a (n, 4, 4) array, computed at once with extractPose3.
+    extractPose3 returns, for each pose, 9 elements of the rotation matrix and the position (n, 12).
+    Caution: the 9 elements are the columns of the rotation matrix (r1, r2, r3) in some versions of GTSAM and the rows
+    in others (e.g. 4.3). The layout is checked against the pose with the least symmetric rotation matrix.
+    """
+    data = gtsam.utilities.extractPose3(values)
+    poses = np.zeros((len(data), 4, 4))
+    poses[:, 0:3, 0:3] = data[:, 0:9].reshape(-1, 3, 3)
+    poses[:, 0:3, 3] = data[:, 9:12]
+    poses[:, 3, 3] = 1
+    if len(poses) > 0:
+        R = poses[:, 0:3, 0:3]
+        k = np.argmax(np.sum(np.abs(R - R.transpose(0, 2, 1)), axis=(1, 2)))
+        if not np.allclose(R[k], values.atPose3(values.keys()[k]).rotation().matrix()):
+            poses[:, 0:3, 0:3] = R.transpose(0, 2, 1)
+    return poses
+
+
 class GraphSLAM():
-    def __init__(self, T0, T0_gps):
+    def __init__(self, T0, T0_gps, robust_kernel=None, robust_kernel_parameter=1.0):
+        """
+        robust_kernel: None, 'huber', 'cauchy' or 'dcs'. The robust kernel used in the loop closing edges ('LC'), so
+        that wrong loop closures are downweighted. robust_kernel_parameter is the parameter of the kernel.
+        """
         # self.current_index = 0
+        # all the factors added to the graph
         self.graph = gtsam.NonlinearFactorGraph()
+        # the factors added since the last optimization [factor, edge index or None] and the iSAM2 indexes of the
+        # factors to be removed in the next optimization
+        self.new_factors = []
+        self.remove_factor_indices = []
+        # the binary edges added with add_edge: i, j, noise type, measurement, the index of the factor in iSAM2
+        # (None until optimized) and in graph. Disabled edges are removed from iSAM2.
+        self.edges = []
         self.initial_estimate = gtsam.Values()
         self.current_estimate = gtsam.Values()
+        # the current estimate of all the poses as a (n, 4, 4) array, updated only for the poses that change (see
+        # update_estimate). The capacity is doubled as needed
+        self.poses = np.zeros((1024, 4, 4))
+        self.number_of_poses = 0
+        # the iSAM2 delta at the last update, to find the poses that changed
+        self.last_delta = np.zeros((0, 6))
 
         # transforms
         self.T0 = T0
@@ -68,6 +125,8 @@ class GraphSLAM():
         self.PRIOR_NOISE = PRIOR_NOISE
         self.SM_NOISE = SM_NOISE
         self.ODO_NOISE = ODO_NOISE
+        # loop closing noise: scanmatching with a robust kernel (if any)
+        self.LC_NOISE = robust_noise(SM_NOISE, robust_kernel, robust_kernel_parameter)
         self.GPS_NOISE = gtsam.noiseModel.Diagonal.Sigmas(GPS_NOISE)
 
         # Solver parameters
@@ -79,36 +138,162 @@ class GraphSLAM():
     def init_graph(self):
         T = self.T0
         # init graph starting at 0 and with initial pose T0 = eye
-        self.graph.push_back(gtsam.PriorFactorPose3(0, gtsam.Pose3(T.array), self.PRIOR_NOISE))
+        self.add_factor(gtsam.PriorFactorPose3(0, gtsam.Pose3(T.array), self.PRIOR_NOISE))
         # CAUTION: the initial T0 transform is the identity.
         self.initial_estimate.insert(0, gtsam.Pose3())
         # self.current_estimate = self.initial_estimate
         self.current_estimate.insert(0, gtsam.Pose3())
+        self.set_pose(0, np.eye(4))
+
+    def add_factor(self, factor, edge_index=None):
+        self.graph.push_back(factor)
+        self.new_factors.append([factor, edge_index])
 
     def add_edge(self, atb, i, j, noise_type):
+        """
+        Add a binary factor between i and j. Returns the index of the edge (see disable_edge).
+        """
         noise = self.select_noise(noise_type)
         # add consecutive observation
-        self.graph.push_back(gtsam.BetweenFactorPose3(i, j, gtsam.Pose3(atb.array), noise))
+        self.edges.append({'i': i, 'j': j, 'noise_type': noise_type, 'atb': atb, 'factor_index': None,
+                           'graph_index': self.graph.size(), 'enabled': True})
+        self.add_factor(gtsam.BetweenFactorPose3(i, j, gtsam.Pose3(atb.array), noise), edge_index=len(self.edges)-1)
+        return len(self.edges)-1
+
+    def disable_edge(self, edge_index):
+        """
+        Remove the edge from the graph. The factor is removed from iSAM2 in the next optimization.
+        """
+        edge = self.edges[edge_index]
+        if not edge['enabled']:
+            return
+        print('Disabling edge (i, j): ', edge['i'], edge['j'])
+        edge['enabled'] = False
+        # the factor may be pending (not added to iSAM2 yet)
+        if edge['factor_index'] is not None:
+            self.remove_factor_indices.append(edge['factor_index'])
+
+    def edge_error(self, edge_index):
+        """
+        The chi2 error of the edge at the current estimate, using the Gaussian noise (without the robust kernel).
+        """
+        edge = self.edges[edge_index]
+        noise_type = edge['noise_type']
+        if noise_type == 'LC':
+            noise_type = 'SM'
+        factor = gtsam.BetweenFactorPose3(edge['i'], edge['j'], gtsam.Pose3(edge['atb'].array),
+                                          self.select_noise(noise_type))
+        # caution: error is 0.5*chi2
+        return 2.0*factor.error(self.current_estimate)
+
+    def reject_outliers(self, chi2_threshold=16.81, noise_type='LC'):
+        """
+        Disable the edges of noise_type (loop closings by default) whose chi2 error at the current estimate is over
+        chi2_threshold (default: 99% for 6 dof). Returns the indexes of the disabled edges.
+        """
+        rejected = []
+        for k in range(len(self.edges)):
+            edge = self.edges[k]
+            if not edge['enabled'] or edge['noise_type'] != noise_type or edge['factor_index'] is None:
+                continue
+            if self.edge_error(k) > chi2_threshold:
+                self.disable_edge(k)
+                rejected.append(k)
+        return rejected
+
+    def active_graph(self):
+        """
+        The factors of the graph without the disabled edges.
+        """
+        disabled = set([edge['graph_index'] for edge in self.edges if not edge['enabled']])
+        graph = gtsam.NonlinearFactorGraph()
+        for k in range(self.graph.size()):
+            if k not in disabled:
+                graph.push_back(self.graph.at(k))
+        return graph
 
     def add_GPSfactor(self, utmx, utmy, utmaltitude, i):
         utm = gtsam.Point3(utmx, utmy, utmaltitude)
-        self.graph.add(gtsam.GPSFactor(i, utm, self.GPS_NOISE))
+        self.add_factor(gtsam.GPSFactor(i, utm, self.GPS_NOISE))
 
     def add_initial_estimate(self, atb, k):
         next_estimate = self.current_estimate.atPose3(k-1).compose(gtsam.Pose3(atb.array))
         self.initial_estimate.insert(k, next_estimate)
         self.current_estimate.insert(k, next_estimate)
+        self.set_pose(k, next_estimate.matrix())
 
     def optimize(self):
-        self.isam.update(self.graph, self.initial_estimate)
-        self.current_estimate = self.isam.calculateEstimate()
+        """
+        Update iSAM2 with the factors added since the last optimization (the disabled edges are not added) and remove
+        the factors of the edges disabled.
+        """
+        new_factors = gtsam.NonlinearFactorGraph()
+        edge_indexes = []
+        for factor, edge_index in self.new_factors:
+            if edge_index is not None and not self.edges[edge_index]['enabled']:
+                continue
+            new_factors.push_back(factor)
+            edge_indexes.append(edge_index)
+        result = self.isam.update(new_factors, self.initial_estimate, gtsam.KeyVector(self.remove_factor_indices))
+        # store the index of each new factor in iSAM2, so that it can be removed later
+        factor_indices = result.getNewFactorsIndices()
+        for k in range(len(edge_indexes)):
+            if edge_indexes[k] is not None:
+                self.edges[edge_indexes[k]]['factor_index'] = factor_indices[k]
+        self.new_factors = []
+        self.remove_factor_indices = []
         self.initial_estimate.clear()
+        self.update_estimate()
+
+    def update_estimate(self):
+        """
+        Update current_estimate and the poses array after an iSAM2 update.
+        The estimate is only computed for the poses whose delta changed in the update (i.e. the new poses and the poses
+        affected by a loop closure). If most of the poses changed, the whole estimate is computed at once.
+        """
+        # caution: all the variables are Pose3 (6 dof) with keys 0, 1, 2... in order
+        delta = self.isam.getDelta().vector().reshape(-1, 6)
+        n = len(self.last_delta)
+        changed = np.where(np.any(delta[0:n] != self.last_delta, axis=1))[0]
+        changed = np.concatenate((changed, np.arange(n, len(delta))))
+        self.last_delta = delta
+        if len(changed) > len(delta) // 2:
+            self.current_estimate = self.isam.calculateEstimate()
+            poses = extract_poses(self.current_estimate)
+            self.reserve(len(poses))
+            self.poses[0:len(poses)] = poses
+            self.number_of_poses = len(poses)
+            return
+        for k in changed:
+            pose = self.isam.calculateEstimatePose3(k)
+            self.current_estimate.update(k, pose)
+            self.set_pose(k, pose.matrix())
+
+    def reserve(self, n):
+        if n > len(self.poses):
+            poses = np.zeros((max(n, 2 * len(self.poses)), 4, 4))
+            poses[0:self.number_of_poses] = self.poses[0:self.number_of_poses]
+            self.poses = poses
+
+    def set_pose(self, k, T):
+        self.reserve(k + 1)
+        self.poses[k] = T
+        self.number_of_poses = max(self.number_of_poses, k + 1)
+
+    def get_poses(self):
+        """
+        The current estimate of all the poses as a (n, 4, 4) array.
+        CAUTION: this is a view of the internal array. Copy it if needed (i.e. when used from another thread).
+        """
+        return self.poses[0:self.number_of_poses]
 
     def select_noise(self, noise_type):
         if noise_type == 'ODO':
             return self.ODO_NOISE
         elif noise_type == 'SM':
             return self.SM_NOISE
+        elif noise_type == 'LC':
+            return self.LC_NOISE
         elif noise_type == 'GPS':
             return self.GPS_NOISE
 
@@ -116,7 +301,8 @@ class GraphSLAM():
         """Print and plot incremental progress of the robot for 3D Pose SLAM using iSAM2."""
         # Compute the marginals for all states in the graph.
         if plot_uncertainty_ellipse:
-            marginals = gtsam.Marginals(self.graph, self.current_estimate)
+            # the disabled (i.e. rejected) edges do not affect the covariances
+            marginals = gtsam.Marginals(self.active_graph(), self.current_estimate)
 
         # Plot the newly updated iSAM2 inference.
         if plot3D:
@@ -153,28 +339,13 @@ class GraphSLAM():
             fig = plt.figure(1)
             axes = fig.gca(projection='3d')
             plt.cla()
-
-            i = 0
-            data = []
-            while self.current_estimate.exists(i):
-                ce = self.current_estimate.atPose3(i)
-                T = HomogeneousMatrix(ce.matrix())
-                data.append(T.pos())
-                i += np.max([skip, 1])
-            data = np.array(data)
+            data = self.get_poses()[::np.max([skip, 1]), 0:3, 3]
             axes.scatter(data[:, 0], data[:, 1], data[:, 2])
         else:
             # Plot the newly updated iSAM2 inference.
             fig = plt.figure(0)
             plt.cla()
-            i = 0
-            data = []
-            while self.current_estimate.exists(i):
-                ce = self.current_estimate.atPose3(i)
-                T = HomogeneousMatrix(ce.matrix())
-                data.append(T.pos())
-                i += np.max([skip, 1])
-            data = np.array(data)
+            data = self.get_poses()[::np.max([skip, 1]), 0:3, 3]
             plt.plot(data[:, 0], data[:, 1], '.', color='blue')
             plt.xlabel('X (m, UTM)')
             plt.ylabel('Y (m, UTM)')
@@ -185,14 +356,7 @@ class GraphSLAM():
         Print and plot the result simply.
         """
         plt.figure(3)
-        i = 0
-        data = []
-        while self.current_estimate.exists(i):
-            ce = self.current_estimate.atPose3(i)
-            T = HomogeneousMatrix(ce.matrix())
-            data.append(T.pos())
-            i += 1
-        data = np.array(data)
+        data = self.get_solution_array()[:, 0:3, 3]
         # data = data[0:150]
         # df_gps = df_gps[0:150]
         plt.plot(data[:, 0], data[:, 1], marker='.', color='blue')
@@ -211,23 +375,20 @@ class GraphSLAM():
     def get_solution(self):
         return self.current_estimate
 
+    def get_solution_array(self, lidar=False):
+        """
+        All the estimated poses as a (n, 4, 4) array (a copy).
+        lidar: if True, the poses of the LiDAR are returned (the T0_gps transformation is removed from all the poses
+        at once).
+        """
+        poses = self.get_poses().copy()
+        if lidar:
+            poses = np.matmul(poses, self.T0_gps.inv().array)
+        return poses
+
     def get_solution_transforms(self):
-        solution_transforms = []
-        i = 0
-        while self.current_estimate.exists(i):
-            ce = self.current_estimate.atPose3(i)
-            T = HomogeneousMatrix(ce.matrix())
-            solution_transforms.append(T)
-            i += 1
-        return solution_transforms
+        return HomogeneousMatrixArray(self.get_solution_array())
 
     def get_solution_transforms_lidar(self):
-        solution_transforms = []
-        i = 0
-        while self.current_estimate.exists(i):
-            ce = self.current_estimate.atPose3(i)
-            T = HomogeneousMatrix(ce.matrix())
-            solution_transforms.append(T*self.T0_gps.inv())
-            i += 1
-        return solution_transforms
+        return HomogeneousMatrixArray(self.get_solution_array(lidar=True))
 
@@ -1,13 +1,15 @@
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 # import matplotlib.pyplot as plt
 # from tools.conversions import mod_2pi
 # import gtsam
 # import gtsam.utils.plot as gtsam_plot
 from artelib.homogeneousmatrix import HomogeneousMatrix
+from graphslam.positiongrid import PositionGrid
 
 
 class LoopClosing():
-    def __init__(self, graphslam, distance_backwards=7, radius_threshold=5.0):
+    def __init__(self, graphslam, distance_backwards=7, radius_threshold=5.0, number_of_workers=1):
         """
         This class provides functions for loop-closing in a ICP context using LiDAR points.
         Though called DataAssociation, it really provides ways to find out whether the computation of the
@@ -23,12 +25,21 @@ class LoopClosing():
         c) For each triplet, it must be: Tij1*Tj1j2*Tj2i=Tii=I, the identity. Due to errors, I must be different from the identity
         I is then converted to I.pos() and I.euler() and checked to find p = 0, and abg=0 approximately. If the transformation
         differs from I, the observations are discarded. On the contrary, both Tij1 and Tij2 are added to the graph.
+        number_of_workers: if > 1, the registrations of all the sampled triplets are computed in parallel with a pool
+        of threads (Open3D releases the GIL during ICP).
         """
         self.graphslam = graphslam
         # look for data associations that are delta_index back in time
         self.distance_backwards = distance_backwards
         self.radius_threshold = radius_threshold
+        self.number_of_workers = number_of_workers
+        # the estimated poses (n, 4, 4) used to find loop closures (see set_estimate)
+        self.poses = None
         self.positions = None
+        # a spatial index of the positions, to find the candidates within radius_threshold
+        self.position_grid = PositionGrid(cell_size=radius_threshold)
+        # the cumulative distance travelled along the trajectory up to each pose
+        self.path_lengths = np.zeros(0)
 
     def loop_closing_simple(self, current_index, number_of_candidates_DA, keyframe_manager):
         """
@@ -42,6 +53,7 @@ class LoopClosing():
         # Data association. Now, add, each cada 15, 20, observaciones (i.e.) 5 metros, ejecutar una asociación de datos
         # Determine if there is loop closure based on the odometry measurement and the previous estimate of the state.
         # find a number of candidates within a radius
+        self.set_estimate()
         candidates = self.find_candidates()
         print(candidates)
         i = current_index
@@ -67,23 +79,49 @@ class LoopClosing():
         Still, of course, sometimes, the measurement found using ICP may be wrong, in this case, it is less probable that
          both Tij and Tik have errors that can cancel each other. As a result, this is a nice manner to filter out observations.
         """
+        edges = self.find_loop_closures_triangle(current_index=current_index,
+                                                 number_of_triplets_loop_closing=number_of_triplets_loop_closing,
+                                                 keyframe_manager=keyframe_manager)
+        added_loop_closures = []
+        for i, j, Tij in edges:
+            self.add_loop_closing_observation(i=i, j=j, Tij=Tij)
+            added_loop_closures.append([i, j])
+        return added_loop_closures
+
+    def find_loop_closures_triangle(self, current_index, number_of_triplets_loop_closing, keyframe_manager,
+                                    poses=None):
+        """
+        Steps a) to d) of loop_closing_triangle: the consistent observations are returned as a list of edges [i, j, Tij],
+        but not added to the graph.
+        poses: the estimated poses (n, 4, 4) used to find the candidates and initial transformations. By default, the
+        current estimate of graphslam. A copy should be used if the graph is optimized meanwhile (i.e. in another thread).
+        """
+        self.set_estimate(poses)
         # forming triplets (i, j1, j2) so that j1 and j2 are within d >< distance.
         triplets = self.find_feasible_triplets(current_index=current_index)
         if len(triplets) == 0:
-            return
+            return []
         triplet_indexes = range(len(triplets))
         # sample candidate indexes
         n = np.min([len(triplet_indexes), number_of_triplets_loop_closing])
         # find pairs of close candidates randomly
         triplet_indexes_sampled = np.random.choice(triplet_indexes, size=n, replace=False)
-        added_loop_closures = []
-        for k in triplet_indexes_sampled:
+        triplets = [triplets[k] for k in triplet_indexes_sampled]
+        # the registrations of all the triplets: Tij1 and Tij2
+        pairs = []
+        for triplet in triplets:
+            pairs.append([triplet[0], triplet[1]])
+            pairs.append([triplet[0], triplet[2]])
+        transforms = self.compute_transformations_between_pairs(pairs=pairs, keyframe_manager=keyframe_manager)
+        edges = []
+        # check the triplets and keep the observations in order
+        for k in range(len(triplets)):
             print('Checking loop closing triplet: ', triplets[k])
             i = triplets[k][0]
             j1 = triplets[k][1]
             j2 = triplets[k][2]
-            Tij1 = self.compute_transformations_between_candidates(i=i, j=j1, keyframe_manager=keyframe_manager)
-            Tij2 = self.compute_transformations_between_candidates(i=i, j=j2, keyframe_manager=keyframe_manager)
+            Tij1 = transforms[2*k]
+            Tij2 = transforms[2*k+1]
             Tj1j2 = self.compute_consecutive_transformations(i=j1, j=j2)
             # computing a loop closing t
             I = Tij1*Tj1j2*Tij2.inv()
@@ -91,13 +129,15 @@ class LoopClosing():
             if self.check_distances(I):
                 print(10*'#')
                 print('FOUND CONSISTENT OBSERVATIONS!')
-                print('Adding loop closing observations.')
                 print(10 * '#')
-                self.add_loop_closing_observation(i=i, j=j1, Tij=Tij1)
-                self.add_loop_closing_observation(i=i, j=j2, Tij=Tij2)
-                added_loop_closures.append([i, j1])
-                added_loop_closures.append([i, j2])
-        return added_loop_closures
+                edges.append([i, j1, Tij1])
+                edges.append([i, j2, Tij2])
+        return edges
+
+    def set_estimate(self, poses=None):
+        if poses is None:
+            poses = self.graphslam.get_poses()
+        self.poses = poses
 
     def find_feasible_triplets(self, current_index):
         triplets = []
@@ -108,12 +148,10 @@ class LoopClosing():
         print(candidates)
         i = current_index
         candidates = np.sort(candidates)
-        for k in range(len(candidates)):
-            # for each j, find
-            j1 = candidates[k]
-            j2 = self.look_for_valid_indexes(j1, candidates[k:])
-            if j2 is not None:
-                triplets.append([i, j1, j2])
+        # for each j1, find j2
+        valid_indexes = self.look_for_valid_indexes(candidates)
+        for k in np.where(valid_indexes >= 0)[0]:
+            triplets.append([i, candidates[k], valid_indexes[k]])
         return triplets
 
     def check_distances(self, I):
@@ -128,20 +166,23 @@ class LoopClosing():
         print('FOUND INCONSISTENT LOOP CLOSING TRIPLET: DISCARDING!!!!!!!')
         return False
 
-    def look_for_valid_indexes(self, i, rest_of_candidates):
+    def look_for_valid_indexes(self, candidates):
         """
-        Find that the indexes are relative (between 1 and 10) and also within a Euclidean distance
+        For each candidate j1 in the sorted candidates, find the first candidate j2 after it so that the indexes are
+        relative (between 1 and 80) and also within a Euclidean distance.
+        All the pairs are checked at once, using the differences in indexes and the pairwise distances of the positions.
+        Returns an array with j2 for each candidate (-1 if not found).
         TODO: dindex and deuclidena must be parameters in the graphSLAM class
         """
-        for j in range(len(rest_of_candidates)):
-            u = rest_of_candidates[j]
-            # distance in indexes
-            dindex = abs(u - i)
-            deuclidean = self.distance(i, u)
-            # print('Dindex, dEuclidean: ', dindex, deuclidean)
-            if (1 < dindex < 80) and (1.0 < deuclidean < 2.0):
-                return u
-        return None
+        positions = self.positions[candidates]
+        # distance in indexes and Euclidean distance between all pairs
+        dindex = np.abs(candidates[:, None] - candidates[None, :])
+        deuclidean = np.linalg.norm(positions[:, None, :] - positions[None, :, :], axis=2)
+        valid = (1 < dindex) & (dindex < 80) & (1.0 < deuclidean) & (deuclidean < 2.0)
+        # only j2 after j1 in the candidates
+        valid = np.triu(valid)
+        first = np.argmax(valid, axis=1)
+        return np.where(np.any(valid, axis=1), candidates[first], -1)
 
     def add_loop_closing_observation(self, i, j, Tij):
         """
@@ -149,7 +190,34 @@ class LoopClosing():
         """
         print('Adding loop_closing edge (i, j): ', i, j)
         # Add a binary factor in between two existing states if loop closure is detected.
-        self.graphslam.add_edge(Tij, i, j, 'SM')
+        self.graphslam.add_edge(Tij, i, j, 'LC')
+
+    def compute_transformations_between_pairs(self, pairs, keyframe_manager):
+        """
+        Compute the observations Tij for all pairs [i, j]. Returns the transformations in the same order.
+        With number_of_workers > 1, each scan is first loaded and pre-processed once. Next, the registrations are computed
+        in parallel. The scans are pinned in the keyframe_manager meanwhile, so that they are not unloaded.
+        """
+        if self.number_of_workers <= 1:
+            return [self.compute_transformations_between_candidates(i=i, j=j, keyframe_manager=keyframe_manager)
+                    for i, j in pairs]
+        # the scans of the registrations found in cache are not needed
+        pending = [[i, j] for i, j in pairs
+                   if not keyframe_manager.is_registration_cached(i, j, self.compute_consecutive_transformations(i, j))]
+        indexes = np.unique(np.array(pending, dtype=int))
+        for index in indexes:
+            keyframe_manager.pin(index)
+        try:
+            with ThreadPoolExecutor(max_workers=self.number_of_workers) as executor:
+                # caution: each scan must be pre-processed by a single thread
+                list(executor.map(keyframe_manager.load_and_pre_process, indexes))
+                futures = [executor.submit(self.compute_transformations_between_candidates, i, j, keyframe_manager)
+                           for i, j in pairs]
+                transforms = [future.result() for future in futures]
+        finally:
+            for index in indexes:
+                keyframe_manager.unpin(index)
+        return transforms
 
     def compute_transformations_between_candidates(self, i, j, keyframe_manager):
         """
@@ -160,22 +228,11 @@ class LoopClosing():
         # i = current_index
         # CAUTION: do not add the keyframe to the list: it should have been added before
         # keyframe_manager.add_keyframe(i)
-        keyframe_manager.load_pointcloud(i)
-        keyframe_manager.pre_process(i)
-        # for j in candidates:
-        # compute initial error-prone estimation
-        Ti = HomogeneousMatrix(self.graphslam.current_estimate.atPose3(i).matrix())
-        Tj = HomogeneousMatrix(self.graphslam.current_estimate.atPose3(j).matrix())
-        # Correct each estimation by the gps transformation
-        # caution, we are estimating the GPS position the robot
-        Ti = Ti*T0_gps.inv()
-        Tj = Tj * T0_gps.inv()
-        # compute the relative transformation between lidars
+        # compute initial error-prone estimation: the relative transformation between lidars
         # this is the initial estimation between the pointclouds
-        Tij = Ti.inv() * Tj
+        Tij = self.compute_consecutive_transformations(i=i, j=j)
         # compute observation using ICP (change the method)
-        keyframe_manager.load_pointcloud(j)
-        keyframe_manager.pre_process(j)
+        # the scans are loaded and pre-processed by the keyframe_manager, unless the registration is found in its cache
         # Caution: the transformation Tijsm is computed from Lidar to Lidar reference frames
         Tijsm = keyframe_manager.compute_transformation(i, j, Tij=Tij)
         # compute the transformation considering the T0_gps transform
@@ -190,8 +247,8 @@ class LoopClosing():
         """
         T0_gps = self.graphslam.T0_gps
         # computing relative transformation from the graphslam current solution
-        Ti = HomogeneousMatrix(self.graphslam.current_estimate.atPose3(i).matrix())
-        Tj = HomogeneousMatrix(self.graphslam.current_estimate.atPose3(j).matrix())
+        Ti = HomogeneousMatrix(self.poses[i])
+        Tj = HomogeneousMatrix(self.poses[j])
         # Correct each estimation by the gps transformation
         # caution, we are estimating the GPS position the robot
         Ti = Ti*T0_gps.inv()
@@ -200,15 +257,35 @@ class LoopClosing():
         return Tij
 
     def store_positions(self):
-        poses = []
-        i = 0
-        # fill a vector with all positions
-        while self.graphslam.current_estimate.exists(i):
-            ce = self.graphslam.current_estimate.atPose3(i)
-            T = HomogeneousMatrix(ce.matrix())
-            poses.append(T.pos())
-            i += 1
-        self.positions = np.array(poses)
+        """
+        Get all the positions from the estimated poses and update the spatial index.
+        Only the positions that moved to a different cell of the grid after the optimization are updated in the grid.
+        """
+        # caution: copy, the poses may be a view of the array in graphslam
+        positions = self.poses[:, 0:3, 3].copy()
+        self.update_path_lengths(positions)
+        # the positions were replaced by a shorter trajectory: no index of the grid can be kept
+        if self.positions is not None and len(positions) < len(self.positions):
+            self.position_grid.rebuild(positions)
+        self.positions = positions
+        self.position_grid.update(self.positions)
+
+    def update_path_lengths(self, positions):
+        """
+        Update the cumulative distance travelled up to each position.
+        Only the path lengths after the first position that changed are recomputed.
+        """
+        n = min(len(self.path_lengths), len(positions))
+        if self.positions is None:
+            k = 0
+        else:
+            changed = np.where(np.any(positions[0:n] != self.positions[0:n], axis=1))[0]
+            k = changed[0] if len(changed) > 0 else n
+        # the segment from k-1 to k changed too
+        k = max(k - 1, 0)
+        d = np.linalg.norm(np.diff(positions[k:], axis=0), axis=1)
+        start = self.path_lengths[k] if k < n else 0.0
+        self.path_lengths = np.concatenate((self.path_lengths[0:k], start + np.concatenate(([0.0], np.cumsum(d)))))
 
     def find_candidates(self):
         """
@@ -223,48 +300,30 @@ class LoopClosing():
     def find_index_backwards(self):
         """
         Return the maximum index to which we can try to perform data associations.
-        This is represented by a distance
+        This is represented by a distance: this is the last index i for which the distance travelled from i to the current pose is over
+        distance_backwards, found with a binary search on the cumulative path lengths.
         """
-        # current_pose = self.positions[-1, :]
-        d = 0
-        for i in reversed(range(len(self.positions)-1)):
-            posei = self.positions[i]
-            posei1 = self.positions[i+1]
-            di = np.linalg.norm(posei1-posei)
-            d += di
-            if d > self.distance_backwards:
-                return i
-        return None
+        if len(self.path_lengths) == 0:
+            return None
+        i = np.searchsorted(self.path_lengths, self.path_lengths[-1] - self.distance_backwards, side='left') - 1
+        if i < 0:
+            return None
+        return int(i)
 
     def find_candidates_within_radius(self, index):
         """
-        Find the distance of the current_pose to all the past poses.
-        Alternatively: sum the relative distances of consecutive poses.
+        Find the past poses (up to index) within radius_threshold of the current pose.
         """
         if index is None:
             return []
         current_pose = self.positions[-1, :]
-        # compute distance to all positions up to index
-        positions = self.positions[0:index, :]
-        d = np.linalg.norm(positions - current_pose, axis=1)
-        # print('distances:')
-        # print(d)
-        candidates = np.where(d < self.radius_threshold)[0]
+        # find the positions up to index, only in the cells of the grid around the current pose
+        candidates = self.position_grid.query_radius(current_pose, radius=self.radius_threshold, max_index=index)
         return candidates
 
     def distance(self, i, j):
-        # if self.graphslam.current_estimate.exists(i):
-        ce = self.graphslam.current_estimate.atPose3(i)
-        Ti = HomogeneousMatrix(ce.matrix())
-        pi = Ti.pos()
-        # else:
-        #     return 1000.0
-        # if self.graphslam.current_estimate.exists(j):
-        ce = self.graphslam.current_estimate.atPose3(j)
-        Tj = HomogeneousMatrix(ce.matrix())
-        pj = Tj.pos()
-        # else:
-        #     return 1000.0
+        pi = self.poses[i, 0:3, 3]
+        pj = self.poses[j, 0:3, 3]
         return np.linalg.norm(pi-pj)
 
 
@@ -0,0 +1,100 @@
+"""
+Loop closing in a background thread.
+"""
+import queue
+import threading
+import numpy as np
+
+
+class LoopClosingService():
+    def __init__(self, loop_closing, keyframe_manager, number_of_triplets_loop_closing):
+        """
+        Runs LoopClosing.find_loop_closures_triangle in a background thread, so that the main loop keeps adding
+        edges to the graph while the loop closing ICPs are computed.
+        The main loop posts requests (post) and adds the edges found (get_edges) to the graph before the next
+        optimization.
+        A single thread consumes the requests, since the LoopClosing object keeps its own state (positions, grid...).
+        The ICPs of each request may still be computed in parallel (see LoopClosing number_of_workers).
+        If the requests arrive faster than they are processed, only the most recent one is processed.
+        If a request fails, the exception is raised in the main loop by the next call to get_edges, wait or close.
+        CAUTION: the keyframe_manager must not be used by the main loop meanwhile.
+        """
+        self.loop_closing = loop_closing
+        self.keyframe_manager = keyframe_manager
+        self.number_of_triplets_loop_closing = number_of_triplets_loop_closing
+        self.requests = queue.Queue()
+        # lists of edges [i, j, Tij] found, one per request
+        self.results = queue.Queue()
+        # the exception raised by the last failed request (raised again in the main loop)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def post(self, current_index, poses):
+        """
+        Request to look for loop closures at current_index, given the estimated poses (n, 4, 4). A copy of the poses is
+        made, since the graph is optimized in the main loop meanwhile.
+        """
+        self.requests.put((current_index, np.array(poses)))
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            # skip the old requests, if newer requests are found
+            while request is not None and not self.requests.empty():
+                self.requests.task_done()
+                print('Loop closing service: skipping request at index: ', request[0])
+                request = self.requests.get()
+            if request is None:
+                self.requests.task_done()
+                break
+            current_index, poses = request
+            try:
+                edges = self.loop_closing.find_loop_closures_triangle(
+                    current_index=current_index,
+                    number_of_triplets_loop_closing=self.number_of_triplets_loop_closing,
+                    keyframe_manager=self.keyframe_manager, poses=poses)
+            except Exception as e:
+                print('Loop closing service: error at index: ', current_index, e)
+                self.error = e
+                edges = []
+            self.results.put(edges)
+            self.requests.task_done()
+
+    def raise_error(self):
+        """
+        Raise the exception of a failed request in the calling thread.
+        """
+        error = self.error
+        if error is not None:
+            self.error = None
+            raise error
+
+    def get_edges(self):
+        """
+        Return all the edges [i, j, Tij] found since the last call (without waiting).
+        """
+        self.raise_error()
+        edges = []
+        while True:
+            try:
+                edges.extend(self.results.get_nowait())
+            except queue.Empty:
+                return edges
+
+    def wait(self):
+        """
+        Wait until all the requests posted are processed.
+        """
+        self.requests.join()
+        self.raise_error()
+
+    def close(self):
+        """
+        Wait until all the requests posted are processed and stop the thread.
+        """
+        try:
+            self.wait()
+        finally:
+            self.requests.put(None)
+            self.thread.join()
@@ -0,0 +1,88 @@
+"""
+A uniform hash grid to find the robot positions within a radius.
+"""
+import numpy as np
+
+
+class PositionGrid():
+    def __init__(self, cell_size):
+        """
+        The space is divided into cubic cells of side cell_size. Each non-empty cell stores the indexes of the positions
+        inside it, so that a radius query only visits the cells around the query point, instead of all the positions.
+        The grid is updated incrementally: only the positions that changed cell are moved in the grid.
+        Best results are obtained with cell_size similar to the radius of the queries.
+        """
+        self.cell_size = cell_size
+        # cell (tuple of ints) --> set of indexes
+        self.grid = {}
+        # the positions and the cell of each position (by index)
+        self.positions = np.zeros((0, 3))
+        self.cells = np.zeros((0, 3), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def update(self, positions):
+        """
+        Update the grid with the current (N, 3) positions. The first positions are the ones already stored (i.e. the
+        estimated positions after an optimization), possibly followed by new positions.
+        If there are less positions than stored, the grid is rebuilt.
+        """
+        positions = np.asarray(positions, dtype=float)
+        if len(positions) < len(self.positions):
+            self.rebuild(positions)
+            return
+        cells = np.floor(positions / self.cell_size).astype(np.int64)
+        n = min(len(self.cells), len(cells))
+        # the positions that moved to another cell
+        moved = np.where(np.any(cells[0:n] != self.cells[0:n], axis=1))[0]
+        for k in moved:
+            self.remove(k, self.cells[k])
+            self.add(k, cells[k])
+        for k in range(n, len(cells)):
+            self.add(k, cells[k])
+        self.positions = positions
+        self.cells = cells
+
+    def clear(self):
+        self.grid = {}
+        self.positions = np.zeros((0, 3))
+        self.cells = np.zeros((0, 3), dtype=np.int64)
+
+    def rebuild(self, positions):
+        """
+        Build the grid from scratch with the (N, 3) positions, i.e. when the positions are replaced by a different
+        trajectory.
+        """
+        self.clear()
+        self.update(positions)
+
+    def add(self, index, cell):
+        self.grid.setdefault(tuple(cell), set()).add(index)
+
+    def remove(self, index, cell):
+        key = tuple(cell)
+        indexes = self.grid[key]
+        indexes.discard(index)
+        if len(indexes) == 0:
+            del self.grid[key]
+
+    def query_radius(self, point, radius, max_index=None):
+        """
+        Return the sorted indexes of the positions at a distance below radius from point.
+        If max_index is not None, only the indexes below max_index are considered.
+        """
+        point = np.asarray(point, dtype=float)
+        cell = np.floor(point / self.cell_size).astype(np.int64)
+        # number of neighbour cells to visit in each direction
+        r = int(np.ceil(radius / self.cell_size))
+        indexes = []
+        for dx in range(-r, r + 1):
+            for dy in range(-r, r + 1):
+                for dz in range(-r, r + 1):
+                    indexes.extend(self.grid.get((cell[0] + dx, cell[1] + dy, cell[2] + dz), ()))
+        indexes = np.array(indexes, dtype=np.int64)
+        if max_index is not None:
+            indexes = indexes[indexes < max_index]
+        d = np.linalg.norm(self.positions[indexes] - point, axis=1)
+        return np.sort(indexes[d < radius])
@@ -0,0 +1,34 @@
+"""
+Correspondences for ICP against a target whose KD-tree is built beforehand.
+The KD-tree (a scipy.spatial.cKDTree) is built once per keyframe (see KeyFrame.get_kdtree) and reused by all the
+registrations of the numpy engine against it, e.g. scan i against i-1 and i+1 and the loop closing candidates.
+Caution: o3d.pipelines.registration.registration_icp (the open3d engine) cannot take a prebuilt tree and builds the
+KD-tree of the target in each call. Only the numpy engine reuses these trees.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def build_kdtree(points):
+    """
+    The KD-tree of the (n, 3) points. The points are copied to a contiguous array, so that the tree is not affected if
+    the pointcloud is modified.
+    """
+    return cKDTree(np.array(points, dtype=np.float64), copy_data=False)
+
+
+def find_correspondences(points, target_tree, max_correspondence_distance):
+    """
+    The closest target point of each point within max_correspondence_distance. The query is run in parallel.
+    Returns the correspondences (n, 2) (source index, target index), the fitness and the RMSE of the inliers.
+    """
+    distances, indexes = target_tree.query(points, k=1, distance_upper_bound=max_correspondence_distance,
+                                           workers=-1)
+    valid = indexes < target_tree.n
+    correspondences = np.column_stack((np.flatnonzero(valid), indexes[valid])).astype(np.int32)
+    if len(correspondences) == 0:
+        return correspondences, 0.0, 0.0
+    fitness = len(correspondences) / len(points)
+    inlier_rmse = np.sqrt(np.sum(distances[valid] ** 2) / len(correspondences))
+    return correspondences, fitness, inlier_rmse
+
@@ -3,14 +3,29 @@ from artelib.euler import Euler
 from artelib.homogeneousmatrix import HomogeneousMatrix
 import open3d as o3d
 import copy
+import hashlib
+import os
+import threading
 from config import ICP_PARAMETERS
+from keyframemanager.pointcloudfilter import radius_height_mask, voxel_down_sample, plane_mask, to_pointcloud
+from keyframemanager.kdtreeicp import build_kdtree
+from keyframemanager.registrationengine import combine_two_planes
+
+# pointclouds stored in the cache of pre-processed keyframes
+CACHED_POINTCLOUDS = ['pointcloud_filtered', 'pointcloud_ground_plane', 'pointcloud_non_ground_plane']
 
 
 class KeyFrame():
-    def __init__(self, directory, scan_time, voxel_size):
+    def __init__(self, directory, scan_time, voxel_size, scan_store=None, plane_tracker=None, index=None):
         # directory
         self.directory = directory
         self.scan_time = scan_time
+        # if a ScanStore is given, the points are read from it instead of the pcd files
+        self.scan_store = scan_store
+        # if a PlaneTracker is given, the ground plane is tracked from the previous scans instead of RANSAC.
+        # The index of the keyframe sets the order of the scans in the tracker
+        self.plane_tracker = plane_tracker
+        self.index = index
         # voxel sizes
         self.voxel_size = voxel_size
         self.voxel_size_normals = 0.1
@@ -22,12 +37,21 @@ class KeyFrame():
         # filename = directory + '/robot0/lidar/data/' + str(scan_time) + '.pcd'
         # the original complete pointcloud
         self.pointcloud = None #o3d.io.read_point_cloud(filename)
+        # the original points, when read from the scan store (a view into the memory-mapped file)
+        self.points = None
         # a reduced/voxelized pointcloud
         self.pointcloud_filtered = None
         self.pointcloud_ground_plane = None
         self.pointcloud_non_ground_plane = None
         # used for global FPFH registration
         self.pointcloud_fpfh = None
+        # coarse levels used by the coarse to fine ICP (icppyramid), from coarse to fine.
+        # The finest level is pointcloud_filtered
+        self.pointcloud_pyramid = None
+        # the KD-trees of the pointclouds used as targets by the numpy registration engine, built once
+        # (name: (pointcloud, tree))
+        self.kdtrees = {}
+        self.lock = threading.Lock()
 
         self.voxel_size_normals_ground_plane = 0.5
         self.voxel_size_normals = 0.3
@@ -36,15 +60,22 @@ class KeyFrame():
         self.max_height = ICP_PARAMETERS.max_height
         self.min_height = ICP_PARAMETERS.min_height
         self.plane_model = None
+        # the ratio of inliers of the last RANSAC of the PlaneTracker
+        self.plane_reference_ratio = None
         self.pre_processed = False
 
     def load_pointcloud(self):
+        if self.scan_store is not None:
+            # caution: no copies are made. The original points are kept as a view of the memory-mapped file
+            self.points = self.scan_store.get_points(self.scan_time)
+            return
         filename = self.directory + '/robot0/lidar/data/' + str(self.scan_time) + '.pcd'
         print('Reading pointcloud: ', filename)
         # Load the original complete pointcloud
         self.pointcloud = o3d.io.read_point_cloud(filename)
 
     def save_pointcloud(self):
+        self.check_not_scan_store()
         filename = self.directory + '/robot0/lidar/dataply/' + str(self.scan_time) + '.ply'
         print('Saving pointcloud: ', filename)
         # Load the original complete pointcloud
@@ -52,12 +83,22 @@ class KeyFrame():
 
     def save_pointcloud_as_mesh(self):
         # https: // www.open3d.org / docs / release / tutorial / geometry / surface_reconstruction.html
+        self.check_not_scan_store()
         filename = self.directory + '/robot0/lidar/dataply/' + str(self.scan_time) + '.ply'
         print('Saving pointcloud. Converting alpha shape: ', filename)
         mesh = o3d.geometry.TriangleMesh.create_from_point_cloud_alpha_shape(self.pointcloud, 0.01)
         # Load the original complete pointcloud
         o3d.io.write_triangle_mesh(filename, mesh)
 
+    def check_not_scan_store(self):
+        """
+        The scans read from a ScanStore are not saved one file per scan: the store is read-only and is written at
+        once with ScanStoreWriter (see run_converter.py).
+        """
+        if self.scan_store is not None:
+            raise ValueError('Cannot save the pointcloud of a keyframe read from a scan store (use_scan_store). '
+                             'Use ScanStoreWriter to write a new store.')
+
     def unload_pointcloud(self):
         print('Removing pointclouds from memory (filtered, planes, fpfh): ')
         del self.pointcloud
@@ -65,33 +106,174 @@ class KeyFrame():
         del self.pointcloud_fpfh
         del self.pointcloud_ground_plane
         del self.pointcloud_non_ground_plane
+        del self.pointcloud_pyramid
         self.pointcloud = None
         self.pointcloud_filtered = None
         self.pointcloud_ground_plane = None
         self.pointcloud_non_ground_plane = None
         self.pointcloud_fpfh = None
+        self.pointcloud_pyramid = None
+        self.kdtrees = {}
+        self.points = None
+        self.pre_processed = False
+
+    def get_points(self):
+        """
+        The original points as a np array. They are read if not in memory (e.g. the keyframe was restored from the
+        cache of pre-processed keyframes, which does not need the original pointcloud).
+        """
+        if self.points is None and self.pointcloud is None:
+            self.load_pointcloud()
+        if self.points is not None:
+            return self.points
+        return np.asarray(self.pointcloud.points)
+
+    def preprocessing_key(self, method):
+        """
+        A hash of all the parameters that affect the pre-processing of the pointcloud.
+        """
+        parameters = [method, self.voxel_size, self.voxel_size_normals, self.voxel_size_normals_ground_plane,
+                      sorted(vars(ICP_PARAMETERS).items())]
+        # the tracked ground plane may differ slightly from the RANSAC plane
+        if self.plane_tracker is not None:
+            parameters.append('plane_tracker')
+        return hashlib.sha1(str(parameters).encode()).hexdigest()[0:16]
+
+    def cache_filename(self, method):
+        return self.directory + '/robot0/lidar/cache/' + str(self.scan_time) + '_' + \
+            self.preprocessing_key(method) + '.npz'
+
+    def is_cached(self, method):
+        return os.path.exists(self.cache_filename(method))
+
+    def load_from_cache(self, method):
+        """
+        Read the pre-processed pointclouds (points and normals) from the cache.
+        Returns False if the keyframe is not found in the cache.
+        """
+        if not self.is_cached(method):
+            return False
+        filename = self.cache_filename(method)
+        print('Reading pre-processed pointcloud: ', filename)
+        try:
+            data = np.load(filename)
+            for name in CACHED_POINTCLOUDS:
+                if name + '_points' not in data:
+                    continue
+                pointcloud = o3d.geometry.PointCloud(
+                    o3d.utility.Vector3dVector(data[name + '_points'].astype(np.float64)))
+                if name + '_normals' in data:
+                    pointcloud.normals = o3d.utility.Vector3dVector(data[name + '_normals'].astype(np.float64))
+                setattr(self, name, pointcloud)
+            pyramid = []
+            while 'pointcloud_pyramid_' + str(len(pyramid)) + '_points' in data:
+                name = 'pointcloud_pyramid_' + str(len(pyramid))
+                pointcloud = o3d.geometry.PointCloud(
+                    o3d.utility.Vector3dVector(data[name + '_points'].astype(np.float64)))
+                pointcloud.normals = o3d.utility.Vector3dVector(data[name + '_normals'].astype(np.float64))
+                pyramid.append(pointcloud)
+            if len(pyramid) > 0:
+                self.pointcloud_pyramid = pyramid
+            if 'fpfh' in data:
+                self.pointcloud_fpfh = o3d.pipelines.registration.Feature()
+                self.pointcloud_fpfh.data = data['fpfh'].astype(np.float64)
+            if 'plane_model' in data:
+                self.plane_model = data['plane_model']
+            if 'plane_reference_ratio' in data:
+                self.plane_reference_ratio = float(data['plane_reference_ratio'])
+        except (OSError, ValueError, KeyError):
+            print('Could not read the cache file: ', filename)
+            return False
+        return True
+
+    def save_to_cache(self, method):
+        """
+        Store the pre-processed pointclouds (points and normals) and the FPFH features as float32 arrays.
+        """
+        filename = self.cache_filename(method)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        data = {}
+        pointclouds = [(name, getattr(self, name)) for name in CACHED_POINTCLOUDS]
+        if self.pointcloud_pyramid is not None:
+            pointclouds.extend([('pointcloud_pyramid_' + str(k), pointcloud)
+                                for k, pointcloud in enumerate(self.pointcloud_pyramid)])
+        for name, pointcloud in pointclouds:
+            if pointcloud is None:
+                continue
+            data[name + '_points'] = np.asarray(pointcloud.points, dtype=np.float32)
+            if pointcloud.has_normals():
+                data[name + '_normals'] = np.asarray(pointcloud.normals, dtype=np.float32)
+        if self.plane_model is not None:
+            data['plane_model'] = np.asarray(self.plane_model)
+        if self.plane_reference_ratio is not None:
+            data['plane_reference_ratio'] = np.asarray(self.plane_reference_ratio)
+        if self.pointcloud_fpfh is not None:
+            data['fpfh'] = np.asarray(self.pointcloud_fpfh.data, dtype=np.float32)
+        # write to a temporary file first, so that other processes never read an incomplete file
+        temp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_filename, 'wb') as file:
+            np.savez(file, **data)
+        os.replace(temp_filename, filename)
+
+    def memory_bytes(self):
+        """
+        An estimation of the memory used by the pointclouds of the keyframe.
+        """
+        # caution: the points read from the scan store are not accounted, since they are mapped from a file
+        total = 0
+        pointclouds = [self.pointcloud, self.pointcloud_filtered, self.pointcloud_ground_plane,
+                       self.pointcloud_non_ground_plane]
+        if self.pointcloud_pyramid is not None:
+            pointclouds.extend(self.pointcloud_pyramid)
+        for pointcloud in pointclouds:
+            if pointcloud is None:
+                continue
+            # points, normals and colors are stored as 3 doubles
+            arrays = 1 + int(pointcloud.has_normals()) + int(pointcloud.has_colors())
+            total += 24*arrays*len(pointcloud.points)
+        if self.pointcloud_fpfh is not None:
+            total += 8*self.pointcloud_fpfh.dimension()*self.pointcloud_fpfh.num()
+        # the points of each KD-tree (3 doubles) and its indexes
+        for pointcloud, tree in list(self.kdtrees.values()):
+            total += 32*tree.n
+        return total
+
+    def get_kdtree(self, name, pointcloud):
+        """
+        The KD-tree of pointcloud (stored as name), built the first time that it is used as a registration target.
+        The tree is built again if the pointcloud has been replaced (e.g. pre-processed again after unloading) and
+        the trees are cleared when the points are modified in place (see transform).
+        """
+        with self.lock:
+            cached = self.kdtrees.get(name)
+            if cached is None or cached[0] is not pointcloud:
+                cached = (pointcloud, build_kdtree(np.asarray(pointcloud.points)))
+                self.kdtrees[name] = cached
+            return cached[1]
 
     def filter_radius_height(self, radii=None, heights=None):
+        self.pointcloud_filtered = to_pointcloud(self.filter_points(radii=radii, heights=heights))
+        return self.pointcloud_filtered
+
+    def filter_points(self, radii=None, heights=None):
+        """
+        The original points filtered by radius and height, as a np array (float32 if read from the scan store).
+        """
         if radii is None:
-            min_radius = self.min_radius
-            max_radius = self.max_radius
-        else:
-            min_radius = radii[0]
-            max_radius = radii[1]
+            radii = [self.min_radius, self.max_radius]
         if heights is None:
-            min_height = self.min_height
-            max_height = self.max_height
-        else:
-            min_height = heights[0]
-            max_height = heights[1]
+            heights = [self.min_height, self.max_height]
+        points = self.get_points()
+        return points[radius_height_mask(points, radii, heights)]
 
-        points = np.asarray(self.pointcloud.points)
-        [x, y, z] = points[:, 0], points[:, 1], points[:, 2]
-        r2 = x ** 2 + y ** 2
-        # idx = np.where(r2 < max_radius ** 2) and np.where(r2 > min_radius ** 2)
-        idx2 = np.where((r2 < max_radius ** 2) & (r2 > min_radius ** 2) & (z > min_height) & (z < max_height))
-        self.pointcloud_filtered = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points[idx2]))
-        return self.pointcloud_filtered
+    def preprocess_points(self):
+        """
+        The points filtered by radius and height and voxelized, as a np array. No Open3D pointclouds are created.
+        """
+        points = self.filter_points()
+        if self.voxel_size is not None:
+            points = voxel_down_sample(points, self.voxel_size)
+        return points
 
     # def filter_radius(self, radii=None):
     #     if radii is None:
@@ -108,20 +290,42 @@ class KeyFrame():
     def down_sample(self):
         if self.voxel_size is None:
             return
-        self.pointcloud_filtered = self.pointcloud_filtered.voxel_down_sample(voxel_size=self.voxel_size)
+        self.pointcloud_filtered = to_pointcloud(voxel_down_sample(np.asarray(self.pointcloud_filtered.points),
+                                                                   self.voxel_size))
 
-    def pre_process(self, method=False):
+    def pre_process(self, method=False, use_cache=False):
         if self.pre_processed:
             print('Already preprocessed, exiting')
             return
-        if method == 'icppointpoint':
-            self.preprocess_icp_point_point()
-        elif method == 'icppointplane':
-            self.preprocess_icp_point_plane()
-        elif method == 'icp2planes':
-            self.preprocess_icp2planes()
-        elif method == 'fpfh':
-            self.preprocess_fpfh()
+        if use_cache and self.load_from_cache(method):
+            # the next scans are seeded with the cached plane
+            if self.plane_tracker is not None and self.plane_model is not None:
+                self.plane_tracker.wait_for_previous(self.index)
+                self.plane_tracker.update(self.index, self.plane_model, self.plane_reference_ratio)
+            self.pre_processed = True
+            return
+        try:
+            # the original pointcloud is not read if the keyframe was expected to be found in the cache
+            if self.pointcloud is None and self.points is None:
+                self.load_pointcloud()
+            if method == 'icppointpoint':
+                self.preprocess_icp_point_point()
+            elif method == 'icppointplane':
+                self.preprocess_icp_point_plane()
+            elif method == 'icp2planes':
+                self.preprocess_icp2planes()
+            elif method == 'icppyramid':
+                self.preprocess_icp_pyramid()
+            elif method == 'fpfh':
+                self.preprocess_fpfh()
+        except Exception:
+            # the next scans must not wait for the plane of this scan
+            if self.plane_tracker is not None:
+                self.plane_tracker.skip(self.index)
+            raise
+        self.pre_processed = True
+        if use_cache:
+            self.save_to_cache(method)
 
         # if simple:
         #     return
@@ -146,35 +350,52 @@ class KeyFrame():
         #                                          max_nn=ICP_PARAMETERS.max_nn))
 
     def preprocess_icp_point_point(self):
-        self.pointcloud_filtered = self.filter_radius_height()
-        if self.voxel_size is not None:
-            self.pointcloud_filtered = self.pointcloud_filtered.voxel_down_sample(voxel_size=self.voxel_size)
+        self.pointcloud_filtered = to_pointcloud(self.preprocess_points())
         # self.pointcloud_filtered.estimate_normals(
         #     o3d.geometry.KDTreeSearchParamHybrid(radius=self.voxel_size_normals,
         #                                          max_nn=ICP_PARAMETERS.max_nn))
 
     def preprocess_icp_point_plane(self):
-        self.pointcloud_filtered = self.filter_radius_height()
+        self.pointcloud_filtered = to_pointcloud(self.preprocess_points())
+        self.pointcloud_filtered.estimate_normals(
+            o3d.geometry.KDTreeSearchParamHybrid(radius=self.voxel_size_normals,
+                                                 max_nn=ICP_PARAMETERS.max_nn))
+
+    def preprocess_icp_pyramid(self):
+        """
+        Build the levels for the coarse to fine ICP: one pointcloud for each of the voxel sizes in the
+        icp_pyramid parameters, plus the pointcloud filtered with voxel_size as the finest level.
+        All the levels are voxelized from the same filtered points, and all have normals (point to plane ICP).
+        """
+        points = self.filter_points()
+        self.pointcloud_pyramid = []
+        for voxel_size in ICP_PARAMETERS.pyramid_voxel_sizes:
+            pointcloud = to_pointcloud(voxel_down_sample(points, voxel_size))
+            # the normals need neighbours at the coarse levels
+            pointcloud.estimate_normals(
+                o3d.geometry.KDTreeSearchParamHybrid(radius=max(self.voxel_size_normals, 3*voxel_size),
+                                                     max_nn=ICP_PARAMETERS.max_nn))
+            self.pointcloud_pyramid.append(pointcloud)
         if self.voxel_size is not None:
-            self.pointcloud_filtered = self.pointcloud_filtered.voxel_down_sample(voxel_size=self.voxel_size)
+            points = voxel_down_sample(points, self.voxel_size)
+        self.pointcloud_filtered = to_pointcloud(points)
         self.pointcloud_filtered.estimate_normals(
             o3d.geometry.KDTreeSearchParamHybrid(radius=self.voxel_size_normals,
                                                  max_nn=ICP_PARAMETERS.max_nn))
 
     def preprocess_icp2planes(self):
-        self.pointcloud_filtered = self.filter_radius_height()
-        if self.voxel_size is not None:
-            self.pointcloud_filtered = self.pointcloud_filtered.voxel_down_sample(voxel_size=self.voxel_size)
+        points = self.preprocess_points()
+        self.pointcloud_filtered = to_pointcloud(points)
         self.pointcloud_filtered.estimate_normals(
             o3d.geometry.KDTreeSearchParamHybrid(radius=self.voxel_size_normals,
                                                  max_nn=ICP_PARAMETERS.max_nn))
         # advanced preprocessing for the two planes scanmatcher
         # if plane_model is None:
-        self.plane_model = self.calculate_plane(pcd=self.pointcloud_filtered)
+        self.plane_model = self.calculate_plane(points=points)
         # else:
         #     self.plane_model = plane_model
 
-        pcd_ground_plane, pcd_non_ground_plane = self.segment_plane(self.plane_model, pcd=self.pointcloud_filtered)
+        pcd_ground_plane, pcd_non_ground_plane = self.segment_points(points, self.plane_model)
         self.pointcloud_ground_plane = pcd_ground_plane
         self.pointcloud_non_ground_plane = pcd_non_ground_plane
 
@@ -189,28 +410,21 @@ class KeyFrame():
                                                  max_nn=ICP_PARAMETERS.max_nn))
 
     def preprocess_fpfh(self):
-        self.pointcloud_filtered = self.filter_radius_height()
-        if self.voxel_size is not None:
-            self.pointcloud_filtered = self.pointcloud_filtered.voxel_down_sample(voxel_size=self.voxel_size)
+        points = self.preprocess_points()
+        self.pointcloud_filtered = to_pointcloud(points)
         self.pointcloud_filtered.estimate_normals(
             o3d.geometry.KDTreeSearchParamHybrid(radius=self.voxel_size_normals,
                                                  max_nn=ICP_PARAMETERS.max_nn))
         # self.pointcloud_fpfh = o3d.pipelines.registration.compute_fpfh_feature(self.pointcloud_filtered,
         #                                                 o3d.geometry.KDTreeSearchParamHybrid(radius=self.voxel_size_normals,
         #                                                                                       max_nn=100))
-        # self.pointcloud_filtered = self.filter_radius_height()
-        if self.voxel_size is not None:
-            self.pointcloud_filtered = self.pointcloud_filtered.voxel_down_sample(voxel_size=self.voxel_size)
-        # self.pointcloud_filtered.estimate_normals(
-        #     o3d.geometry.KDTreeSearchParamHybrid(radius=self.voxel_size_normals,
-        #                                          max_nn=ICP_PARAMETERS.max_nn))
         # advanced preprocessing for the two planes scanmatcher
         # if plane_model is None:
-        self.plane_model = self.calculate_plane(pcd=self.pointcloud_filtered)
+        self.plane_model = self.calculate_plane(points=points)
         # else:
         #     self.plane_model = plane_model
 
-        pcd_ground_plane, pcd_non_ground_plane = self.segment_plane(self.plane_model, pcd=self.pointcloud_filtered)
+        pcd_ground_plane, pcd_non_ground_plane = self.segment_points(points, self.plane_model)
         self.pointcloud_ground_plane = pcd_ground_plane
         self.pointcloud_non_ground_plane = pcd_non_ground_plane
 
@@ -232,6 +446,7 @@ class KeyFrame():
         """
         use icp to compute transformation using an initial estimate.
         caution, initial_transform is a np array.
+        Returns the transformation, the fitness and the RMSE of the inliers.
         """
         if initial_transform is None:
             initial_transform = np.eye(4)
@@ -257,12 +472,40 @@ class KeyFrame():
         # print(reg_p2p.transformation)
         # other.draw_registration_result(self, reg_p2p.transformation)
         T = HomogeneousMatrix(reg_p2p.transformation)
-        return T
+        return T, reg_p2p.fitness, reg_p2p.inlier_rmse
+
+    def local_registration_pyramid(self, other, initial_transform):
+        """
+        Coarse to fine point to plane ICP. Each level starts at the solution of the previous (coarser) level, with a
+        smaller correspondence distance. The iterations at each level stop early when the fitness and inlier RMSE
+        converge (see icp_pyramid in icp_parameters.yaml).
+        caution, initial_transform is a np array.
+        Returns the transformation, the fitness and the RMSE of the inliers (at the finest level).
+        """
+        if initial_transform is None:
+            initial_transform = np.eye(4)
+        print("Apply point-to-plane ICP. Coarse to fine registration")
+        sources = other.pointcloud_pyramid + [other.pointcloud_filtered]
+        targets = self.pointcloud_pyramid + [self.pointcloud_filtered]
+        transformation = initial_transform
+        for k in range(len(targets)):
+            criteria = o3d.pipelines.registration.ICPConvergenceCriteria(
+                relative_fitness=ICP_PARAMETERS.pyramid_relative_fitness,
+                relative_rmse=ICP_PARAMETERS.pyramid_relative_rmse,
+                max_iteration=ICP_PARAMETERS.pyramid_max_iterations[k])
+            reg_p2p = o3d.pipelines.registration.registration_icp(
+                sources[k], targets[k], ICP_PARAMETERS.pyramid_distance_thresholds[k], transformation,
+                o3d.pipelines.registration.TransformationEstimationPointToPlane(), criteria)
+            transformation = reg_p2p.transformation
+            print('Registration result at level: ', k, reg_p2p)
+        T = HomogeneousMatrix(reg_p2p.transformation)
+        return T, reg_p2p.fitness, reg_p2p.inlier_rmse
 
     def local_registration_two_planes(self, other, initial_transform):
         """
         use icp to compute transformation using an initial estimate.
         caution, initial_transform is a np array.
+        Returns the transformation, the fitness and the RMSE of the inliers (of the non ground plane registration).
         """
         print("Apply point-to-plane ICP. Local registration in two phases")
         threshold = ICP_PARAMETERS.distance_threshold
@@ -280,23 +523,16 @@ class KeyFrame():
                                                   self.pointcloud_non_ground_plane, threshold, initial_transform,
                                                   o3d.pipelines.registration.TransformationEstimationPointToPlane()))
 
-        t1 = HomogeneousMatrix(reg_p2pa.transformation).t2v(n=3)
-        t2 = HomogeneousMatrix(reg_p2pb.transformation).t2v(n=3)
         # build solution using both solutions
-        tx = t2[0]
-        ty = t2[1]
-        tz = t1[2]
-        alpha = t1[3]
-        beta = t1[4]
-        gamma = t2[5]
-        T = HomogeneousMatrix(np.array([tx, ty, tz]), Euler([alpha, beta, gamma]))
+        T = combine_two_planes(HomogeneousMatrix(reg_p2pa.transformation), HomogeneousMatrix(reg_p2pb.transformation))
         # other.draw_registration_result(self, T.array)
         print('Registration results: ', reg_p2pb)
-        return T
+        return T, reg_p2pb.fitness, reg_p2pb.inlier_rmse
 
     def global_registration(self, other):
         """
         perform global registration followed by icp
+        Returns the transformation, the fitness and the RMSE of the inliers.
         """
         # initial_transform = o3d.pipelines.registration.registration_fast_based_on_feature_matching(
         #     other.pointcloud, self.pointcloud, other.pointcloud_fpfh, self.pointcloud_fpfh,
@@ -342,7 +578,7 @@ class KeyFrame():
         print("Refined transformation is:")
         print(reg_p2p.transformation)
         T = HomogeneousMatrix(reg_p2p.transformation)
-        return T
+        return T, reg_p2p.fitness, reg_p2p.inlier_rmse
 
     def draw_registration_result(self, other, transformation):
         source_temp = copy.deepcopy(self.pointcloud_filtered)
@@ -397,6 +633,9 @@ class KeyFrame():
         self.pointcloud.points = o3d.utility.Vector3dVector(points[index, :])
 
     def transform(self, T):
+        # the points change in place: the KD-trees built on them are no longer valid
+        with self.lock:
+            self.kdtrees = {}
         return self.pointcloud_filtered.transform(T)
 
 
@@ -414,19 +653,27 @@ class KeyFrame():
         idx2 = np.where((z > min_height) & (z < max_height))
         return o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points[idx2]))
 
-    def calculate_plane(self, pcd=None, height=-0.5, thresholdA=0.01):
+    def calculate_plane(self, pcd=None, height=-0.5, thresholdA=0.01, points=None):
         # find a plane by removing some of the points at a given height
         # this best estimates a ground plane.
 
-        if pcd is None:
+        if points is not None:
+            points = np.asarray(points)
+        elif pcd is None:
             points = np.asarray(self.pointcloud_filtered.points)
         else:
             points = np.asarray(pcd.points)
 
         idx = points[:, 2] < height
+        if self.plane_tracker is not None:
+            plane_model, self.plane_reference_ratio = self.plane_tracker.estimate(points[idx], threshold=thresholdA,
+                                                                                  index=self.index)
+            [a, b, c, d] = plane_model
+            print(f"Plane model tracked: {a:.2f}x + {b:.2f}y + {c:.2f}z + {d:.2f} = 0")
+            return plane_model
         pcd_plane = o3d.geometry.PointCloud()
 
-        pcd_plane.points = o3d.utility.Vector3dVector(points[idx])
+        pcd_plane.points = o3d.utility.Vector3dVector(points[idx].astype(np.float64))
 
         plane_model, inliers = pcd_plane.segment_plane(distance_threshold=thresholdA, ransac_n=3,
                                                        num_iterations=1000)
@@ -460,6 +707,14 @@ class KeyFrame():
         non_plane_cloud = pcd.select_by_index(inliers_final, invert=True)
         return plane_cloud, non_plane_cloud
 
+    def segment_points(self, points, plane_model, thresholdB=0.4):
+        """
+        As segment_plane, given the points as a np array. The pointclouds of the plane and non plane points are
+        created directly from the np array (without normals).
+        """
+        mask = plane_mask(points, plane_model, thresholdB)
+        return to_pointcloud(points[mask]), to_pointcloud(points[~mask])
+
     # def icp_corrected_transforms(self, keyframe_j, transformation_initial):
     #
     #     threshold = ICP_PARAMETERS.distance_threshold
@@ -1,21 +1,63 @@
 import numpy as np
 # import subprocess
+import multiprocessing
+import threading
+from collections import OrderedDict, Counter
 from artelib.homogeneousmatrix import HomogeneousMatrix
 import open3d as o3d
 from keyframemanager.keyframe import KeyFrame
+from keyframemanager.scanstore import ScanStore
+from keyframemanager.planetracker import PlaneTracker
+from keyframemanager.registrationengine import create_registration_engine
 
 
 class KeyFrameManager():
-    def __init__(self, directory, scan_times, voxel_size, method='icppointplane'):
+    def __init__(self, directory, scan_times, voxel_size, method='icppointplane', use_cache=False,
+                 memory_budget_mb=None, use_scan_store=False, registration_cache=None, track_ground_plane=False,
+                 registration_engine='open3d'):
         """
         given a list of scan times (ROS times), each pcd is read on demand
+        use_cache: store the pre-processed pointclouds in robot0/lidar/cache and read them from there in the next
+        runs (or when revisited during loop closing) with the same pre-processing parameters.
+        memory_budget_mb: maximum memory used by the pointclouds of the keyframes. When exceeded, the least
+        recently used keyframes are unloaded (and loaded again when needed). None: no limit.
+        use_scan_store: read the scans from the memory-mapped store in robot0/lidar/store (see run_converter.py)
+        instead of the pcd files.
+        registration_cache: a RegistrationCache. The registrations found in it are not computed again.
+        track_ground_plane: seed the ground plane of each scan with the plane of the previous scans (see PlaneTracker),
+        instead of a RANSAC per scan (methods icp2planes and fpfh). The planes are estimated in index order, also when
+        the keyframes are pre-processed by the KeyFramePrefetcher threads. In batch mode, each chunk starts a new track.
+        registration_engine: the engine that computes the registrations: 'open3d' or 'numpy' (see RegistrationEngine).
         """
         self.directory = directory
         self.scan_times = scan_times
         self.keyframes = []
         self.voxel_size = voxel_size
         self.method = method
+        self.use_cache = use_cache
+        self.use_scan_store = use_scan_store
+        if use_scan_store:
+            self.scan_store = ScanStore(directory=directory)
+        else:
+            self.scan_store = None
         self.show_registration_result = False
+        # keyframes whose pointclouds are in memory, least recently used first (index: bytes)
+        if memory_budget_mb is None:
+            self.memory_budget = None
+        else:
+            self.memory_budget = memory_budget_mb*1024*1024
+        self.resident = OrderedDict()
+        self.resident_bytes = 0
+        # keyframes in use (i.e. being registered) that must not be unloaded
+        self.pinned = Counter()
+        self.lock = threading.RLock()
+        self.registration_cache = registration_cache
+        self.track_ground_plane = track_ground_plane
+        if track_ground_plane:
+            self.plane_tracker = PlaneTracker()
+        else:
+            self.plane_tracker = None
+        self.registration_engine = create_registration_engine(registration_engine)
 
     def add_keyframes(self, keyframe_sampling):
         # First: add all keyframes with the known sampling
@@ -26,7 +68,8 @@ class KeyFrameManager():
     def add_keyframe(self, index):
         print('Adding keyframe with scan_time: ', self.scan_times[index])
         kf = KeyFrame(directory=self.directory, scan_time=self.scan_times[index],
-                      voxel_size=self.voxel_size)
+                      voxel_size=self.voxel_size, scan_store=self.scan_store, plane_tracker=self.plane_tracker,
+                      index=len(self.keyframes))
         self.keyframes.append(kf)
 
     def load_pointclouds(self):
@@ -35,11 +78,69 @@ class KeyFrameManager():
             self.keyframes[i].load_pointcloud()
 
     def load_pointcloud(self, i):
+        # already pre-processed and in memory: the original pointcloud is not needed again
+        if self.keyframes[i].pre_processed:
+            self.update_resident(i)
+            return
+        # the original pointcloud is not needed if the pre-processed keyframe is found in the cache
+        if self.use_cache and self.keyframes[i].is_cached(self.method):
+            return
         self.keyframes[i].load_pointcloud()
+        self.update_resident(i)
 
     def unload_pointcloud(self, i):
+        with self.lock:
+            self.resident_bytes -= self.resident.pop(i, 0)
         self.keyframes[i].unload_pointcloud()
 
+    def update_resident(self, i):
+        """
+        Mark the keyframe i as the most recently used and account for its memory.
+        Next, unload the least recently used keyframes if the memory budget is exceeded.
+        """
+        with self.lock:
+            self.resident_bytes -= self.resident.pop(i, 0)
+            self.resident[i] = self.keyframes[i].memory_bytes()
+            self.resident_bytes += self.resident[i]
+            self.evict()
+
+    def evict(self):
+        """
+        Unload the least recently used keyframes until the memory budget is met.
+        The pinned keyframes (i.e. being loaded, pre-processed or registered) are kept.
+        """
+        if self.memory_budget is None:
+            return
+        with self.lock:
+            candidates = list(self.resident.keys())
+            for index in candidates:
+                if self.resident_bytes <= self.memory_budget:
+                    break
+                if self.pinned[index] > 0:
+                    continue
+                print('Keyframemanager: memory budget exceeded. Unloading keyframe: ', index)
+                self.resident_bytes -= self.resident.pop(index)
+                self.keyframes[index].unload_pointcloud()
+
+    def pin(self, index):
+        with self.lock:
+            self.pinned[index] += 1
+
+    def unpin(self, index):
+        with self.lock:
+            self.pinned[index] -= 1
+            if self.pinned[index] <= 0:
+                del self.pinned[index]
+
+    def ensure_pre_processed(self, index):
+        """
+        Load and pre-process the keyframe if it is not in memory (i.e. it was unloaded to meet the memory budget).
+        """
+        if self.keyframes[index].pre_processed:
+            self.update_resident(index)
+        else:
+            self.load_and_pre_process(index)
+
     def save_pointcloud(self, i):
         self.keyframes[i].save_pointcloud()
 
@@ -47,7 +148,20 @@ class KeyFrameManager():
         self.keyframes[i].save_pointcloud_as_mesh()
 
     def pre_process(self, index):
-        self.keyframes[index].pre_process(method=self.method)
+        self.keyframes[index].pre_process(method=self.method, use_cache=self.use_cache)
+        self.update_resident(index)
+
+    def load_and_pre_process(self, index):
+        """
+        Read the pointcloud and pre-process it. Used by the KeyFramePrefetcher in a separate thread.
+        The keyframe cannot be unloaded by other threads meanwhile.
+        """
+        self.pin(index)
+        try:
+            self.load_pointcloud(index)
+            self.pre_process(index)
+        finally:
+            self.unpin(index)
 
     def compute_transformation(self, i, j, Tij):
         """
@@ -57,23 +171,72 @@ class KeyFrameManager():
         - A global FPFH feature matching (which could be followed by a simple ICP)
         """
         # TODO: Compute inintial transformation from IMU
-        if self.method == 'icppointpoint':
-            transform = self.keyframes[i].local_registration_simple(self.keyframes[j], initial_transform=Tij.array,
-                                                                    option='pointpoint')
-        elif self.method == 'icppointplane':
-            transform = self.keyframes[i].local_registration_simple(self.keyframes[j], initial_transform=Tij.array,
-                                                                    option='pointplane')
-        elif self.method == 'icp2planes':
-            transform = self.keyframes[i].local_registration_two_planes(self.keyframes[j], initial_transform=Tij.array)
-        elif self.method == 'fpfh':
-            transform = self.keyframes[i].global_registration(self.keyframes[j])
-        else:
-            print('Unknown registration method')
-            transform = None
-        if self.show_registration_result:
-            self.keyframes[j].draw_registration_result(self.keyframes[i], transformation=transform.array)
+        # the same registration (with the same initial transformation) may have been computed before
+        if self.registration_cache is not None:
+            key = self.registration_cache.key(self.keyframes[i], self.keyframes[j], self.method, Tij,
+                                              engine=self.registration_engine.name)
+            result = self.registration_cache.get(key)
+            if result is not None:
+                print('Found registration in cache (i, j): ', i, j)
+                return HomogeneousMatrix(result[0])
+        self.pin(i)
+        self.pin(j)
+        try:
+            # the keyframes may have been unloaded to meet the memory budget
+            self.ensure_pre_processed(i)
+            self.ensure_pre_processed(j)
+            transform, fitness, inlier_rmse = self.register(i, j, Tij)
+        finally:
+            self.unpin(i)
+            self.unpin(j)
+        if self.registration_cache is not None and transform is not None:
+            self.registration_cache.put(key, transform.array, fitness, inlier_rmse)
         return transform
 
+    def is_registration_cached(self, i, j, Tij):
+        if self.registration_cache is None:
+            return False
+        key = self.registration_cache.key(self.keyframes[i], self.keyframes[j], self.method, Tij,
+                                          engine=self.registration_engine.name)
+        return self.registration_cache.contains(key)
+
+    def register(self, i, j, Tij):
+        """
+        Returns the transformation, the fitness and the RMSE of the inliers.
+        """
+        result = self.registration_engine.register(self.keyframes[i], self.keyframes[j], initial_transform=Tij.array,
+                                                   method=self.method)
+        if self.show_registration_result:
+            self.keyframes[j].draw_registration_result(self.keyframes[i], transformation=result[0].array)
+        return result
+
+    def compute_transformations_batch(self, initial_transforms, number_of_workers=None, chunk_size=10):
+        """
+        Compute the relative transformations between all the consecutive scans (i, i+1) using a pool of processes.
+        initial_transforms[i] is the initial estimation of the transformation between i and i+1 (i.e. odometry).
+        The pairs are split in chunks of chunk_size consecutive pairs. Each process reads and pre-processes the scans
+        of its own chunk, so that each scan is read twice at most.
+        The resulting transformations are returned in index order.
+        """
+        n = len(self.scan_times) - 1
+        tasks = []
+        for start in range(0, n, chunk_size):
+            end = min(start + chunk_size, n)
+            tasks.append((self.directory, self.scan_times[start:end + 1], self.voxel_size, self.method,
+                          self.use_cache, self.use_scan_store, self.track_ground_plane, self.registration_engine.name,
+                          [initial_transforms[k].array for k in range(start, end)]))
+        print('Keyframemanager: computing ', n, 'transformations in ', len(tasks), 'chunks')
+        transforms = []
+        # caution: spawn new processes, since forking a process that already uses Open3D/OpenMP may hang
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes=number_of_workers) as pool:
+            # imap keeps the order of the tasks
+            for k, result in enumerate(pool.imap(compute_consecutive_transformations, tasks)):
+                print('Keyframemanager: finished chunk: ', k, 'out of: ', len(tasks))
+                for T in result:
+                    transforms.append(HomogeneousMatrix(T))
+        return transforms
+
     def draw_keyframe(self, index):
         self.keyframes[index].draw_cloud()
 
@@ -131,18 +294,24 @@ class KeyFrameManager():
                 vis.clear_geometries()
             print("Keyframe: ", i, "out of: ", len(self.keyframes), end='\r')
             kf = self.keyframes[i]
-            kf.load_pointcloud()
-            kf.filter_radius_height(radii=radii, heights=heights)
-            # kf.filter_radius(radii=radii)
-            # kf.filter_height(heights=heights)
-            kf.down_sample()
-            Ti = global_transforms[i]
-            # transform to global and
-            pointcloud_temp = kf.transform(T=Ti.array)
-            # yuxtaponer los pointclouds
-            # pointcloud_global = pointcloud_global + pointcloud_temp
-            # vis.add_geometry(pointcloud_global, reset_bounding_box=True)
-            vis.add_geometry(pointcloud_temp, reset_bounding_box=True)
+            # the keyframe cannot be unloaded while it is filtered and transformed
+            self.pin(i)
+            try:
+                self.load_pointcloud(i)
+                kf.filter_radius_height(radii=radii, heights=heights)
+                # kf.filter_radius(radii=radii)
+                # kf.filter_height(heights=heights)
+                kf.down_sample()
+                Ti = global_transforms[i]
+                # transform to global and
+                pointcloud_temp = kf.transform(T=Ti.array)
+                # yuxtaponer los pointclouds
+                # pointcloud_global = pointcloud_global + pointcloud_temp
+                # vis.add_geometry(pointcloud_global, reset_bounding_box=True)
+                vis.add_geometry(pointcloud_temp, reset_bounding_box=True)
+                self.update_resident(i)
+            finally:
+                self.unpin(i)
             vis.get_render_option().point_size = 1
             # vis.update_geometry(pointcloud_global)
             vis.poll_events()
@@ -171,11 +340,20 @@ class KeyFrameManager():
         for i in range(len(self.keyframes)):
             print("Keyframe: ", i, "out of: ", len(self.keyframes), end='\r')
             kf = self.keyframes[i]
-            kf.filter_radius_height(radii=radii, heights=heights)
-            kf.down_sample()
-            Ti = sampled_transforms[i]
-            # transform to global and
-            pointcloud_temp = kf.transform(T=Ti.array)
+            # the keyframe cannot be unloaded while it is filtered and transformed
+            self.pin(i)
+            try:
+                # the pointcloud may have been unloaded to meet the memory budget
+                if kf.pointcloud is None and kf.points is None:
+                    self.load_pointcloud(i)
+                kf.filter_radius_height(radii=radii, heights=heights)
+                kf.down_sample()
+                self.update_resident(i)
+                Ti = sampled_transforms[i]
+                # transform to global and
+                pointcloud_temp = kf.transform(T=Ti.array)
+            finally:
+                self.unpin(i)
             # yuxtaponer los pointclouds
             pointcloud_global = pointcloud_global + pointcloud_temp
         print('FINISHED! Use the renderer to view the map')
@@ -184,13 +362,25 @@ class KeyFrameManager():
         return pointcloud_global
 
 
-
-
-
-
-
-
-
-
-
-
+def compute_consecutive_transformations(task):
+    """
+    Compute the transformations between consecutive scans in a separate process.
+    The task is (directory, scan_times, voxel_size, method, use_cache, use_scan_store, track_ground_plane,
+    registration_engine, initial_transforms), with len(scan_times)-1 initial transforms as np arrays.
+    Returns a list of np arrays.
+    """
+    directory, scan_times, voxel_size, method, use_cache, use_scan_store, track_ground_plane, registration_engine, \
+        initial_transforms = task
+    keyframe_manager = KeyFrameManager(directory=directory, scan_times=scan_times, voxel_size=voxel_size,
+                                       method=method, use_cache=use_cache, use_scan_store=use_scan_store,
+                                       track_ground_plane=track_ground_plane, registration_engine=registration_engine)
+    keyframe_manager.add_keyframes(keyframe_sampling=1)
+    keyframe_manager.load_and_pre_process(0)
+    transforms = []
+    for i in range(len(initial_transforms)):
+        keyframe_manager.load_and_pre_process(i + 1)
+        Tij = keyframe_manager.compute_transformation(i, i + 1, Tij=HomogeneousMatrix(initial_transforms[i]))
+        transforms.append(Tij.array)
+        keyframe_manager.unload_pointcloud(i)
+    keyframe_manager.unload_pointcloud(len(initial_transforms))
+    return transforms
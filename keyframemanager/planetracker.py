@@ -0,0 +1,108 @@
+"""
+Tracking of the ground plane along consecutive scans.
+"""
+import numpy as np
+import open3d as o3d
+import threading
+from keyframemanager.pointcloudfilter import plane_mask
+
+
+class PlaneTracker():
+    def __init__(self, min_inlier_ratio_factor=0.8, num_iterations=1000):
+        """
+        The ground plane barely changes between consecutive scans. Instead of running RANSAC on each scan, the plane
+        model of the previous scan is used as a seed: the inliers of the previous plane are found in the new scan and
+        the plane is fitted to them by least squares.
+        The full RANSAC is run only on the first scan and when the fit degrades, i.e. when the ratio of inliers falls
+        below min_inlier_ratio_factor times the ratio found in the last RANSAC.
+        The tracker is shared by the keyframes of a KeyFrameManager, which may be pre-processed in different threads
+        (KeyFramePrefetcher). The seed of the scan at index is always the plane of the scan at index - 1: the scans
+        wait for their turn, so that the planes are estimated in index order and the results do not depend on the
+        order in which the threads run.
+        """
+        self.min_inlier_ratio_factor = min_inlier_ratio_factor
+        self.num_iterations = num_iterations
+        # the plane model of each scan and the ratio of inliers found in the last RANSAC (index: (plane, ratio))
+        self.planes = {}
+        # all the scans before next_index have been estimated (or skipped)
+        self.next_index = 0
+        self.condition = threading.Condition()
+        self.number_of_ransac = 0
+        self.number_of_tracked = 0
+
+    def estimate(self, points, threshold, index):
+        """
+        Return the plane model [a, b, c, d] (ax + by + cz + d = 0) that best fits the (n, 3) points of the scan at
+        index and the ratio of inliers of the last RANSAC (used as the reference for the next scans).
+        """
+        seed = self.wait_for_previous(index)
+        if seed is not None and len(points) > 0:
+            plane_model, reference_ratio = seed
+            inliers = plane_mask(points, plane_model, threshold)
+            ratio = np.count_nonzero(inliers) / len(points)
+            if ratio >= self.min_inlier_ratio_factor*reference_ratio and np.count_nonzero(inliers) >= 3:
+                plane_model = fit_plane(points[inliers], plane_model)
+                self.update(index, plane_model, reference_ratio)
+                with self.condition:
+                    self.number_of_tracked += 1
+                return plane_model, reference_ratio
+            print('PlaneTracker: inlier ratio degraded ', ratio, 'Computing RANSAC')
+        plane_model, ratio = self.ransac(points, threshold)
+        self.update(index, plane_model, ratio)
+        with self.condition:
+            self.number_of_ransac += 1
+        return plane_model, ratio
+
+    def wait_for_previous(self, index):
+        """
+        Wait until the planes of all the scans before index are known. Returns the plane model of the scan at
+        index - 1 and its reference ratio, or None.
+        """
+        with self.condition:
+            while self.next_index < index:
+                self.condition.wait()
+            return self.planes.get(index - 1)
+
+    def update(self, index, plane_model, reference_ratio):
+        """
+        Store the plane of the scan at index, e.g. computed by estimate or read from the cache of pre-processed
+        keyframes (reference_ratio may be None if unknown: the next scan runs RANSAC).
+        """
+        with self.condition:
+            if reference_ratio is None:
+                self.planes.pop(index, None)
+            else:
+                self.planes[index] = (np.asarray(plane_model), reference_ratio)
+            self.next_index = max(self.next_index, index + 1)
+            self.condition.notify_all()
+
+    def skip(self, index):
+        """
+        The scan at index will not be estimated (e.g. the pre-processing failed): do not wait for it.
+        """
+        with self.condition:
+            self.next_index = max(self.next_index, index + 1)
+            self.condition.notify_all()
+
+    def ransac(self, points, threshold):
+        """
+        Full RANSAC plane segmentation. Returns the plane model and the ratio of inliers.
+        """
+        pcd_plane = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.asarray(points, dtype=np.float64)))
+        plane_model, inliers = pcd_plane.segment_plane(distance_threshold=threshold, ransac_n=3,
+                                                       num_iterations=self.num_iterations)
+        return np.array(plane_model), len(inliers) / len(points)
+
+
+def fit_plane(points, plane_model):
+    """
+    Least squares plane through the points: the normal is the direction of least variance of the points.
+    The normal is oriented as the normal of plane_model.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    centroid = np.mean(points, axis=0)
+    _, _, vt = np.linalg.svd(points - centroid, full_matrices=False)
+    normal = vt[2]
+    if np.dot(normal, plane_model[0:3]) < 0:
+        normal = -normal
+    return np.array([normal[0], normal[1], normal[2], -np.dot(normal, centroid)])
@@ -0,0 +1,67 @@
+"""
+Pre-processing of the LiDAR points with numpy: filtering by radius and height, voxel down sampling and ground plane
+segmentation.
+All the steps work on (n, 3) np arrays (float32 when read from the scan store), so that the intermediate results do not
+allocate Open3D pointclouds. Only the final pointclouds used for registration are created (see to_pointcloud).
+"""
+import numpy as np
+import open3d as o3d
+
+
+def radius_height_mask(points, radii, heights):
+    """
+    A single boolean mask of the points with min_radius < r < max_radius and min_height < z < max_height (r measured
+    in the XY plane). The comparisons are accumulated in place, so that no temporary arrays of the size of the scan are
+    allocated for each condition.
+    """
+    x = points[:, 0]
+    y = points[:, 1]
+    z = points[:, 2]
+    r2 = x*x
+    r2 += y*y
+    mask = r2 < radii[1] ** 2
+    mask &= r2 > radii[0] ** 2
+    mask &= z > heights[0]
+    mask &= z < heights[1]
+    return mask
+
+
+def voxel_down_sample(points, voxel_size):
+    """
+    Replace the points inside each voxel by their mean, as o3d.geometry.PointCloud.voxel_down_sample.
+    The voxel grid starts at min_bound - voxel_size/2, as in Open3D. Each voxel (ix, iy, iz) is hashed to a single
+    int64 key, the points are grouped by key with np.unique and the means are computed with np.bincount.
+    Returns a (m, 3) float64 array. Caution: the points are sorted by voxel key, instead of the Open3D order.
+    """
+    if len(points) == 0:
+        return np.zeros((0, 3))
+    min_bound = np.min(points, axis=0).astype(np.float64) - voxel_size/2
+    # voxel indexes (computed in float64, as in Open3D)
+    indexes = np.empty((len(points), 3), dtype=np.int64)
+    for k in range(3):
+        indexes[:, k] = np.floor((points[:, k] - min_bound[k]) / voxel_size)
+    dims = np.max(indexes, axis=0) + 1
+    keys = indexes[:, 0] + dims[0]*(indexes[:, 1] + dims[1]*indexes[:, 2])
+    del indexes
+    keys, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse)
+    result = np.empty((len(keys), 3))
+    for k in range(3):
+        result[:, k] = np.bincount(inverse, weights=points[:, k]) / counts
+    return result
+
+
+def plane_mask(points, plane_model, threshold):
+    """
+    The points at a distance below threshold from the plane ax + by + cz + d = 0.
+    """
+    [a, b, c, d] = plane_model
+    dist = np.abs(a * points[:, 0] + b * points[:, 1] + c * points[:, 2] + d) / np.sqrt(a * a + b * b + c * c)
+    return dist < threshold
+
+
+def to_pointcloud(points):
+    """
+    The Open3D pointcloud used for registration (stored as float64).
+    """
+    return o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.asarray(points, dtype=np.float64)))
@@ -0,0 +1,62 @@
+"""
+Background loading and preprocessing of keyframes.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+
+class KeyFramePrefetcher():
+    def __init__(self, keyframe_manager, prefetch_depth=4, number_of_workers=2):
+        """
+        Reads and pre-processes the pointclouds of the keyframes ahead of time, using a pool of threads,
+        so that the registration of the current pair of scans does not wait for disk reads or normal estimation.
+        Open3D releases the GIL while reading and processing pointclouds, thus threads are enough.
+        CAUTION: at most prefetch_depth keyframes are kept in memory ahead of the one being consumed.
+        CAUTION: all the keyframes must have been added to the keyframe_manager before.
+        """
+        self.keyframe_manager = keyframe_manager
+        self.prefetch_depth = prefetch_depth
+        self.executor = ThreadPoolExecutor(max_workers=number_of_workers)
+        # futures of the keyframes being loaded/pre-processed, by index
+        self.futures = {}
+        # the next index to be scheduled
+        self.next_index = 0
+        # after close, the keyframes are loaded in the calling thread
+        self.closed = False
+
+    def schedule(self, index):
+        """
+        Schedule the keyframes up to index + prefetch_depth.
+        """
+        if self.closed:
+            return
+        # never schedule keyframes that have already been consumed
+        self.next_index = max(self.next_index, index)
+        last_index = min(index + self.prefetch_depth, len(self.keyframe_manager.keyframes) - 1)
+        while self.next_index <= last_index:
+            self.futures[self.next_index] = self.executor.submit(self.keyframe_manager.load_and_pre_process,
+                                                                 self.next_index)
+            self.next_index += 1
+
+    def get(self, index):
+        """
+        Return the keyframe at index once loaded and pre-processed. The following keyframes are scheduled.
+        """
+        self.schedule(index)
+        future = self.futures.pop(index, None)
+        if future is None:
+            # the keyframe was not scheduled (i.e. it was requested out of order)
+            self.keyframe_manager.load_and_pre_process(index)
+        else:
+            # caution: any exception raised in the worker is raised here
+            future.result()
+        return self.keyframe_manager.keyframes[index]
+
+    def close(self):
+        """
+        Cancel the pending work and wait for the running threads. The keyframes requested later (get) are loaded
+        without prefetching.
+        """
+        self.closed = True
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        # keep the keyframes already loaded
+        self.futures = {index: future for index, future in self.futures.items() if not future.cancelled()}
@@ -0,0 +1,77 @@
+"""
+A cache of the results of the registration of pairs of scans.
+"""
+import numpy as np
+import os
+import threading
+
+
+class RegistrationCache():
+    def __init__(self, filename=None, decimals=2):
+        """
+        Stores the transformation, fitness and RMSE of each registration, by key. The key is built from the times of
+        both scans, the registration method and engine, the pre-processing parameters and the initial transformation,
+        rounded to decimals.
+        filename: if not None, the results are read from this .npz file and saved to it (see save), so that they
+        are reused in the next runs.
+        """
+        self.filename = filename
+        self.decimals = decimals
+        # key --> (transform (4x4 np array), fitness, inlier_rmse)
+        self.results = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        if filename is not None and os.path.exists(filename):
+            self.load()
+
+    def key(self, keyframe_i, keyframe_j, method, initial_transform, engine='open3d'):
+        # caution: adding 0.0 converts -0.0 to 0.0
+        rounded = np.round(initial_transform.array[0:3, :], self.decimals) + 0.0
+        return '_'.join([str(keyframe_i.scan_time), str(keyframe_j.scan_time), str(method), str(engine),
+                         keyframe_i.preprocessing_key(method)] + [str(x) for x in rounded.flatten()])
+
+    def get(self, key):
+        """
+        Return (transform, fitness, inlier_rmse) or None if not found.
+        """
+        with self.lock:
+            result = self.results.get(key)
+            if result is not None:
+                self.hits += 1
+            return result
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.results
+
+    def put(self, key, transform, fitness, inlier_rmse):
+        with self.lock:
+            self.results[key] = (np.array(transform), fitness, inlier_rmse)
+
+    def load(self):
+        print('Reading registration cache: ', self.filename)
+        try:
+            data = np.load(self.filename)
+            for k in range(len(data['keys'])):
+                self.results[str(data['keys'][k])] = (data['transforms'][k], float(data['fitness'][k]),
+                                                      float(data['inlier_rmse'][k]))
+        except (OSError, ValueError, KeyError):
+            print('Could not read the registration cache: ', self.filename)
+        print('Found ', len(self.results), 'registrations in cache')
+
+    def save(self):
+        if self.filename is None:
+            return
+        with self.lock:
+            keys = list(self.results.keys())
+            results = [self.results[key] for key in keys]
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        # write to a temporary file first, so that the cache file is never left incomplete
+        temp_filename = self.filename + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_filename, 'wb') as file:
+            np.savez(file, keys=np.array(keys, dtype=str),
+                     transforms=np.array([result[0] for result in results]).reshape(-1, 4, 4),
+                     fitness=np.array([result[1] for result in results], dtype=float),
+                     inlier_rmse=np.array([result[2] for result in results], dtype=float))
+        os.replace(temp_filename, self.filename)
+        print('Saved ', len(keys), 'registrations to cache: ', self.filename, 'Cache hits: ', self.hits)
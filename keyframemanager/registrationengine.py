@@ -0,0 +1,211 @@
+"""
+Registration engines: compute the transformation between two pre-processed keyframes.
+    - Open3DEngine: the Open3D registration of the KeyFrame methods.
+    - NumpyEngine: ICP implemented with numpy and scipy (cKDTree correspondences and point to plane Gauss-Newton).
+The engine is selected by name (see create_registration_engine), so that both can be compared on the same experiment.
+This module does not import open3d, but the keyframes are still pre-processed (filtered, normals, planes) with Open3D:
+only the ICP of the numpy engine runs without it.
+"""
+import numpy as np
+from scipy.spatial.transform import Rotation
+from artelib.euler import Euler
+from artelib.homogeneousmatrix import HomogeneousMatrix
+from config import ICP_PARAMETERS
+from keyframemanager.kdtreeicp import find_correspondences
+
+
+class RegistrationEngine():
+    """
+    The interface of all the engines.
+    """
+    name = None
+
+    def register(self, keyframe_i, keyframe_j, initial_transform, method):
+        """
+        Compute the transformation of keyframe_j with respect to keyframe_i, given the initial_transform (np array)
+        and the registration method (icppointpoint, icppointplane, icp2planes, icppyramid or fpfh).
+        Returns the transformation (HomogeneousMatrix), the fitness and the RMSE of the inliers.
+        """
+        raise NotImplementedError
+
+
+class Open3DEngine(RegistrationEngine):
+    name = 'open3d'
+
+    def register(self, keyframe_i, keyframe_j, initial_transform, method):
+        if method == 'icppointpoint':
+            return keyframe_i.local_registration_simple(keyframe_j, initial_transform=initial_transform,
+                                                        option='pointpoint')
+        elif method == 'icppointplane':
+            return keyframe_i.local_registration_simple(keyframe_j, initial_transform=initial_transform,
+                                                        option='pointplane')
+        elif method == 'icppyramid':
+            return keyframe_i.local_registration_pyramid(keyframe_j, initial_transform=initial_transform)
+        elif method == 'icp2planes':
+            return keyframe_i.local_registration_two_planes(keyframe_j, initial_transform=initial_transform)
+        elif method == 'fpfh':
+            return keyframe_i.global_registration(keyframe_j)
+        print('Unknown registration method')
+        return None, None, None
+
+
+class NumpyEngine(RegistrationEngine):
+    """
+    ICP with numpy and scipy. The KD-tree of the target pointcloud is built once per keyframe (KeyFrame.get_kdtree)
+    and the correspondences are found with a parallel query. Each step is solved in closed form (point to point) or
+    with a Gauss-Newton step (point to plane), using the normals computed in the pre-processing.
+    The ICP works on np arrays (see icp): the keyframes only provide the pre-processed points, normals and trees.
+    The global FPFH registration is not implemented (use the open3d engine).
+    """
+    name = 'numpy'
+
+    def register(self, keyframe_i, keyframe_j, initial_transform, method):
+        if initial_transform is None:
+            initial_transform = np.eye(4)
+        threshold = ICP_PARAMETERS.distance_threshold
+        if method == 'icppointpoint':
+            return self.register_pointclouds(keyframe_j, keyframe_i, 'pointcloud_filtered', threshold,
+                                             initial_transform, point_to_plane=False)
+        elif method == 'icppointplane':
+            return self.register_pointclouds(keyframe_j, keyframe_i, 'pointcloud_filtered', threshold,
+                                             initial_transform)
+        elif method == 'icppyramid':
+            transformation = initial_transform
+            names = ['pointcloud_pyramid_' + str(k) for k in range(len(keyframe_i.pointcloud_pyramid))]
+            names.append('pointcloud_filtered')
+            for k in range(len(names)):
+                transformation, fitness, inlier_rmse = self.register_pointclouds(
+                    keyframe_j, keyframe_i, names[k], ICP_PARAMETERS.pyramid_distance_thresholds[k],
+                    transformation, relative_fitness=ICP_PARAMETERS.pyramid_relative_fitness,
+                    relative_rmse=ICP_PARAMETERS.pyramid_relative_rmse,
+                    max_iteration=ICP_PARAMETERS.pyramid_max_iterations[k])
+                transformation = transformation.array
+            return HomogeneousMatrix(transformation), fitness, inlier_rmse
+        elif method == 'icp2planes':
+            Ta, _, _ = self.register_pointclouds(keyframe_j, keyframe_i, 'pointcloud_ground_plane', threshold,
+                                                 initial_transform)
+            Tb, fitness, inlier_rmse = self.register_pointclouds(keyframe_j, keyframe_i,
+                                                                 'pointcloud_non_ground_plane', threshold,
+                                                                 initial_transform)
+            return combine_two_planes(Ta, Tb), fitness, inlier_rmse
+        elif method == 'fpfh':
+            raise ValueError('The numpy registration engine does not implement the fpfh method. '
+                             'Use the open3d registration engine.')
+        print('Unknown registration method')
+        return None, None, None
+
+    def register_pointclouds(self, source_keyframe, target_keyframe, name, max_correspondence_distance,
+                             initial_transform, point_to_plane=True, relative_fitness=1e-6, relative_rmse=1e-6,
+                             max_iteration=30):
+        """
+        Register the pointcloud name of source_keyframe against the same pointcloud of target_keyframe.
+        The points and normals are read from the keyframes as np arrays and the KD-tree of the target is reused.
+        """
+        source = get_pointcloud(source_keyframe, name)
+        target = get_pointcloud(target_keyframe, name)
+        target_tree = target_keyframe.get_kdtree(name, target)
+        target_normals = None
+        if point_to_plane:
+            target_normals = np.asarray(target.normals)
+        return self.icp(np.asarray(source.points), target_tree, max_correspondence_distance, initial_transform,
+                        target_normals=target_normals, relative_fitness=relative_fitness,
+                        relative_rmse=relative_rmse, max_iteration=max_iteration)
+
+    def icp(self, source_points, target_tree, max_correspondence_distance, initial_transform, target_normals=None,
+            relative_fitness=1e-6, relative_rmse=1e-6, max_iteration=30):
+        """
+        Register the source points (n, 3) against the target points stored in target_tree (see build_kdtree).
+        The ICP is point to plane if the target normals (m, 3) are given, point to point otherwise.
+        The iterations stop when the absolute changes of fitness and inlier RMSE between two iterations are below
+        relative_fitness and relative_rmse. Despite their names, Open3D applies these criteria in the same way
+        (ICPConvergenceCriteria).
+        Returns the transformation (HomogeneousMatrix), the fitness and the RMSE of the inliers.
+        """
+        # the tree stores a contiguous copy of the target points
+        target_points = target_tree.data
+        transformation = np.array(initial_transform, dtype=np.float64)
+        points = transform_points(source_points, transformation)
+        correspondences, fitness, inlier_rmse = find_correspondences(points, target_tree, max_correspondence_distance)
+        for i in range(max_iteration):
+            if len(correspondences) < 3:
+                break
+            p = points[correspondences[:, 0]]
+            q = target_points[correspondences[:, 1]]
+            if target_normals is not None:
+                update = point_to_plane_step(p, q, target_normals[correspondences[:, 1]])
+            else:
+                update = point_to_point_step(p, q)
+            transformation = np.dot(update, transformation)
+            points = transform_points(source_points, transformation)
+            previous_fitness = fitness
+            previous_inlier_rmse = inlier_rmse
+            correspondences, fitness, inlier_rmse = find_correspondences(points, target_tree,
+                                                                         max_correspondence_distance)
+            if abs(previous_fitness - fitness) < relative_fitness and \
+                    abs(previous_inlier_rmse - inlier_rmse) < relative_rmse:
+                break
+        return HomogeneousMatrix(transformation), fitness, inlier_rmse
+
+
+def create_registration_engine(name):
+    """
+    The registration engine, by name: 'open3d' or 'numpy'.
+    """
+    if name == 'open3d':
+        return Open3DEngine()
+    elif name == 'numpy':
+        return NumpyEngine()
+    raise ValueError('Unknown registration engine: ' + str(name))
+
+
+def get_pointcloud(keyframe, name):
+    if name.startswith('pointcloud_pyramid_'):
+        return keyframe.pointcloud_pyramid[int(name[len('pointcloud_pyramid_'):])]
+    return getattr(keyframe, name)
+
+
+def transform_points(points, transformation):
+    return np.dot(points, transformation[0:3, 0:3].T) + transformation[0:3, 3]
+
+
+def point_to_point_step(p, q):
+    """
+    The transformation that minimizes the distances between the corresponding points p and q (n, 3), in closed form
+    (SVD).
+    """
+    mp = np.mean(p, axis=0)
+    mq = np.mean(q, axis=0)
+    H = np.dot((p - mp).T, q - mq)
+    U, S, Vt = np.linalg.svd(H)
+    # avoid reflections
+    D = np.diag([1, 1, np.sign(np.linalg.det(np.dot(Vt.T, U.T)))])
+    R = np.dot(Vt.T, np.dot(D, U.T))
+    update = np.eye(4)
+    update[0:3, 0:3] = R
+    update[0:3, 3] = mq - np.dot(R, mp)
+    return update
+
+
+def point_to_plane_step(p, q, normals):
+    """
+    A Gauss-Newton step that minimizes the distances of the points p to the planes defined by the points q and the
+    normals (n, 3). The residuals n·(p - q) are linearized for a small rotation w and translation t:
+    r + (p x n)·w + n·t.
+    """
+    r = np.einsum('ij,ij->i', p - q, normals)
+    J = np.hstack((np.cross(p, normals), normals))
+    x = np.linalg.lstsq(np.dot(J.T, J), -np.dot(J.T, r), rcond=None)[0]
+    update = np.eye(4)
+    update[0:3, 0:3] = Rotation.from_rotvec(x[0:3]).as_matrix()
+    update[0:3, 3] = x[3:6]
+    return update
+
+
+def combine_two_planes(Ta, Tb):
+    """
+    Build the transformation of the two planes registration: z, alpha and beta from the registration of the ground
+    planes (Ta) and x, y and gamma from the registration of the non ground planes (Tb).
+    """
+    t1 = Ta.t2v(n=3)
+    t2 = Tb.t2v(n=3)
+    return HomogeneousMatrix(np.array([t2[0], t2[1], t1[2]]), Euler([t1[3], t1[4], t2[5]]))
@@ -0,0 +1,74 @@
+"""
+All the LiDAR scans of an experiment packed in a single memory-mapped file.
+The points of all scans are stored consecutively as float32 (x, y, z) in robot0/lidar/store/points.bin.
+The file robot0/lidar/store/index.csv stores, for each timestamp, the offset and number of points of the scan.
+"""
+import numpy as np
+import pandas as pd
+import os
+
+STORE_DIRECTORY = '/robot0/lidar/store/'
+
+
+class ScanStore():
+    def __init__(self, directory):
+        """
+        Open the store for reading. The points are not read: they are mapped in memory and read on demand.
+        """
+        self.points_filename = directory + STORE_DIRECTORY + 'points.bin'
+        self.index_filename = directory + STORE_DIRECTORY + 'index.csv'
+        print('Opening scan store: ', self.points_filename)
+        # caution: np.memmap cannot map an empty file (a store with no scans or only empty scans)
+        if os.path.getsize(self.points_filename) == 0:
+            self.points = np.zeros((0, 3), dtype=np.float32)
+        else:
+            self.points = np.memmap(self.points_filename, dtype=np.float32, mode='r').reshape(-1, 3)
+        df_index = pd.read_csv(self.index_filename)
+        scan_times = df_index['#timestamp [ns]'].to_numpy()
+        self.offsets = df_index['offset'].to_numpy(dtype=np.int64)
+        self.counts = df_index['count'].to_numpy(dtype=np.int64)
+        # the data file must hold all the points listed in the index (e.g. it may be truncated)
+        if len(self.counts) > 0 and np.max(self.offsets + self.counts) > len(self.points):
+            raise ValueError('Scan store ' + self.points_filename + ' holds ' + str(len(self.points)) +
+                             ' points, but the index lists ' + str(np.max(self.offsets + self.counts)))
+        # the position in the index of each timestamp
+        self.index = dict(zip(scan_times, range(len(scan_times))))
+
+    def get_points(self, scan_time):
+        """
+        Return the points of the scan as a (n, 3) float32 np array.
+        CAUTION: the array is a read-only view into the memory-mapped file (no copies are made).
+        """
+        k = self.index[scan_time]
+        return self.points[self.offsets[k]:self.offsets[k] + self.counts[k]]
+
+
+class ScanStoreWriter():
+    def __init__(self, directory):
+        """
+        Create a new store. The scans must be added with add_scan and the store closed with close.
+        """
+        store_directory = directory + STORE_DIRECTORY
+        os.makedirs(store_directory, exist_ok=True)
+        self.points_filename = store_directory + 'points.bin'
+        self.index_filename = store_directory + 'index.csv'
+        self.file = open(self.points_filename, 'wb')
+        self.scan_times = []
+        self.offsets = []
+        self.counts = []
+        self.offset = 0
+
+    def add_scan(self, scan_time, points):
+        points = np.ascontiguousarray(points, dtype=np.float32)
+        self.file.write(points.tobytes())
+        self.scan_times.append(scan_time)
+        self.offsets.append(self.offset)
+        self.counts.append(len(points))
+        self.offset += len(points)
+
+    def close(self):
+        self.file.close()
+        df_index = pd.DataFrame({'#timestamp [ns]': self.scan_times, 'offset': self.offsets, 'count': self.counts})
+        df_index.to_csv(self.index_filename, index=False)
+        print('Scan store saved: ', self.points_filename, 'with', len(self.scan_times), 'scans and', self.offset,
+              'points')
@@ -3,6 +3,7 @@ Run a scanmatcher using O3D for consecutive scans.
 """
 from eurocreader.eurocreader import EurocReader
 from keyframemanager.keyframemanager import KeyFrameManager
+from keyframemanager.scanstore import ScanStoreWriter
 from artelib.homogeneousmatrix import HomogeneousMatrix, compute_global_transformations, \
     compute_relative_transformations
 import time
@@ -11,6 +12,7 @@ import matplotlib.pyplot as plt
 from tools.gpsconversions import gps2utm
 from tools.sampling import sample_odometry, sample_times
 from artelib.homogeneousmatrix import compute_homogeneous_transforms
+from artelib.homogeneousmatrixarray import HomogeneousMatrixArray
 import getopt
 import sys
 from artelib.euler import Euler
@@ -19,19 +21,23 @@ import yaml
 def find_options():
     argv = sys.argv[1:]
     euroc_path = None
+    pack = False
     try:
-        opts, args = getopt.getopt(argv, "hi:", ["ifile="])
+        opts, args = getopt.getopt(argv, "hi:p", ["ifile=", "pack"])
     except getopt.GetoptError:
-        print('python run_scanmatcher.py -i <euroc_directory>')
+        print('python run_converter.py -i <euroc_directory> [-p]')
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
-            print('python run_scanmatcher.py -i <euroc_directory>')
+            print('python run_converter.py -i <euroc_directory> [-p]')
+            print('-p: pack all the scans in a single memory-mapped file (robot0/lidar/store)')
             sys.exit()
         elif opt in ("-i", "--ifile"):
             euroc_path = arg
+        elif opt in ("-p", "--pack"):
+            pack = True
     print('Input find_options directory is: ', euroc_path)
-    return euroc_path
+    return euroc_path, pack
 
 
 def read_scanmatcher_parameters(directory):
@@ -48,15 +54,9 @@ def plot_odometry(df_odo):
 
 
 def plot_transformations(transforms):
-    positions = []
-    orientations = []
-    for i in range(len(transforms)):
-        t = transforms[i].t2v(n=3)
-        positions.append([t[0], t[1], t[2]])
-        orientations.append([t[3], t[4], t[5]])
-
-    positions = np.array(positions)
-    orientations = np.array(orientations)
+    t = HomogeneousMatrixArray(transforms).t2v(n=3)
+    positions = t[:, 0:3]
+    orientations = t[:, 3:6]
     # plt.figure()
     plt.scatter(positions[:, 0], positions[:, 1])
     # plt.show()
@@ -186,6 +186,28 @@ def converter(directory=None):
         keyframe_manager.unload_pointcloud(i)
 
 
+def pack_scans(directory):
+    """
+    Pack all the LiDAR scans of the experiment (robot0/lidar/data/*.pcd) in a single memory-mapped file, along with an
+    index of the position of each scan, keyed by its timestamp. Use use_scan_store in the scanmatcher/SLAM parameters
+    to read the scans from it.
+    """
+    euroc_read = EurocReader(directory=directory)
+    scan_times = get_scan_times(euroc_read=euroc_read)
+    keyframe_manager = KeyFrameManager(directory=directory, scan_times=scan_times, voxel_size=None)
+    keyframe_manager.add_keyframes(keyframe_sampling=1)
+    writer = ScanStoreWriter(directory=directory)
+    for i in range(0, len(scan_times)):
+        print('Packing scan: ', i, 'out of ', len(scan_times))
+        keyframe_manager.load_pointcloud(i)
+        writer.add_scan(scan_times[i], keyframe_manager.keyframes[i].get_points())
+        keyframe_manager.unload_pointcloud(i)
+    writer.close()
+
+
 if __name__ == "__main__":
-    directory = find_options()
-    converter(directory=directory)
+    directory, pack = find_options()
+    if pack:
+        pack_scans(directory=directory)
+    else:
+        converter(directory=directory)
@@ -4,11 +4,13 @@ We are integrating odometry, scanmatching odometry and (if present) GPS.
 
 """
 from graphslam.loopclosing import LoopClosing
+from graphslam.loopclosingservice import LoopClosingService
 from graphslam.graphSLAM import GraphSLAM
 from eurocreader.eurocreader import EurocReader
 from artelib.homogeneousmatrix import compute_homogeneous_transforms, HomogeneousMatrix, \
     compute_relative_transformations, multiply_by_transform
 from keyframemanager.keyframemanager import KeyFrameManager
+from keyframemanager.registrationcache import RegistrationCache
 import numpy as np
 from tools.gpsconversions import gps2utm, filter_gps
 import matplotlib.pyplot as plt
@@ -44,7 +46,7 @@ def prepare_experiment_data(euroc_read):
     df_scan_times = euroc_read.read_csv(filename='/robot0/scanmatcher/lidar_times.csv')
     scan_times = df_scan_times['#timestamp [ns]'].to_numpy()
     # Read LiDAR transformation (between each of the previous times)
-    df_scanmatcher_global = euroc_read.read_csv(filename='/robot0/scanmatcher/scanmatcher_global.csv')
+    _, scanmatcher_global = euroc_read.read_transforms(filename='/robot0/scanmatcher/scanmatcher_global.csv')
     # read and sample odometry data
     try:
         df_odo = euroc_read.read_csv(filename='/robot0/odom/data.csv')
@@ -71,7 +73,30 @@ def prepare_experiment_data(euroc_read):
         df_gps = None
         gps_times = None
         T0gps = None
-    return scan_times, df_scanmatcher_global, df_odo, df_gps, gps_times, T0gps
+    return scan_times, scanmatcher_global, df_odo, df_gps, gps_times, T0gps
+
+
+def add_loop_closures(loop_closing, edges):
+    """
+    Add the edges [i, j, Tij] found by the LoopClosingService to the graph. Returns the pairs [i, j] added.
+    """
+    added_loop_closures = []
+    for i, j, Tij in edges:
+        loop_closing.add_loop_closing_observation(i=i, j=j, Tij=Tij)
+        added_loop_closures.append([i, j])
+    return added_loop_closures
+
+
+def reject_loop_closing_outliers(graphslam, chi2_threshold):
+    """
+    Disable the loop closing edges that are not consistent with the current estimate and optimize again.
+    """
+    if chi2_threshold is None:
+        return
+    rejected = graphslam.reject_outliers(chi2_threshold=chi2_threshold)
+    if len(rejected) > 0:
+        print('Rejected loop closing edges: ', len(rejected))
+        graphslam.optimize()
 
 
 def get_current_gps_reading(current_time, gps_times, max_delta_time_s=0.1):
@@ -85,7 +110,8 @@ def get_current_gps_reading(current_time, gps_times, max_delta_time_s=0.1):
     return None
 
 
-def view_result_map(global_transforms, directory, scan_times, keyframe_sampling):
+def view_result_map(global_transforms, directory, scan_times, keyframe_sampling, memory_budget_mb=None,
+                    use_scan_store=False):
     """
     View the map (visualize_map_online) or build it.
     When building it, an open3D kd-tree is obtained, which can be saved to a file (i.e.) a csv file.
@@ -100,7 +126,8 @@ def view_result_map(global_transforms, directory, scan_times, keyframe_sampling)
         sampled_global_transforms.append(global_transforms[i])
     # use, for example, voxel_size=0.2. Use voxel_size=None to use full resolution
     voxel_size = None
-    keyframe_manager = KeyFrameManager(directory=directory, scan_times=scan_times, voxel_size=voxel_size)
+    keyframe_manager = KeyFrameManager(directory=directory, scan_times=scan_times, voxel_size=voxel_size,
+                                       memory_budget_mb=memory_budget_mb, use_scan_store=use_scan_store)
     # OPTIONAL: visualize resulting map
     keyframe_manager.add_keyframes(keyframe_sampling=keyframe_sampling)
     # keyframe_manager.load_pointclouds()
@@ -188,6 +215,25 @@ def run_graphSLAM(directory):
     distance_backwards = slam_parameters.get('distance_backwards', 9.0)
     # visualization: choose, for example, 1 out of 10 poses and its matching scan
     visualization_keyframe_sampling = slam_parameters.get('visualization_keyframe_sampling', 20)
+    # read the pre-processed pointclouds from robot0/lidar/cache (and store them there)
+    use_cache = slam_parameters.get('use_cache', False)
+    # maximum memory (MB) used by the keyframes in memory. The least recently used are unloaded. None: no limit
+    memory_budget_mb = slam_parameters.get('keyframe_memory_budget_mb', None)
+    # read the scans from the memory-mapped store (robot0/lidar/store, see run_converter.py -p)
+    use_scan_store = slam_parameters.get('use_scan_store', False)
+    # number of threads used to compute the registrations of the loop closing triplets (1: sequential)
+    loop_closing_workers = slam_parameters.get('loop_closing_workers', 1)
+    # store the loop closing registrations in robot0/SLAM/registration_cache.npz and reuse them in the next runs
+    use_registration_cache = slam_parameters.get('use_registration_cache', False)
+    # look for loop closures in a background thread, while the trajectory is added to the graph
+    async_loop_closing = slam_parameters.get('async_loop_closing', False)
+    # robust kernel for the loop closing edges: None, 'huber', 'cauchy' or 'dcs' (and its parameter)
+    robust_kernel = slam_parameters.get('robust_kernel', None)
+    robust_kernel_parameter = slam_parameters.get('robust_kernel_parameter', 1.0)
+    # disable the loop closing edges with a chi2 error over this threshold after each optimization (None: keep all)
+    loop_closing_outlier_chi2 = slam_parameters.get('loop_closing_outlier_chi2', None)
+    # the engine that computes the loop closing registrations: 'open3d' or 'numpy' (numpy/scipy ICP)
+    registration_engine = slam_parameters.get('registration_engine', 'open3d')
     ###################################################################
 
     # T0: Define the initial transformation (Prior for GraphSLAM)
@@ -201,11 +247,10 @@ def run_graphSLAM(directory):
     # CAUTION: the df_scanmatcher data is referred to the LIDAR reference system. A T0_gps transform should be used if
     # we need to consider GPS readings
     # caution: the GPS is only considered if the timestamp with scan_times (LiDAR) is below 0.05 seconds
-    scan_times, df_scanmatcher_global, df_odo_global, df_gps, gps_times, T0_gps = prepare_experiment_data(euroc_read=euroc_read)
+    scan_times, scanmatcher_global, df_odo_global, df_gps, gps_times, T0_gps = prepare_experiment_data(euroc_read=euroc_read)
     if T0_gps is None:
         T0_gps = HomogeneousMatrix()
-    # Read global transformations from scanmatcher and change the reference system to the GPS (if the GPS is available)
-    scanmatcher_global = compute_homogeneous_transforms(df_scanmatcher_global)
+    # Global transformations from scanmatcher: change the reference system to the GPS (if the GPS is available)
     # modify transform if GPS readings are to be included
     scanmatcher_global = multiply_by_transform(scanmatcher_global, Trel=T0_gps)
     scanmatcher_relative = compute_relative_transformations(global_transforms=scanmatcher_global)
@@ -215,14 +260,28 @@ def run_graphSLAM(directory):
     relative_transforms_odo = compute_relative_transformations(global_transforms=odo_transforms)
 
     # create the graphslam graph
-    graphslam = GraphSLAM(T0=T0, T0_gps=T0_gps)
+    graphslam = GraphSLAM(T0=T0, T0_gps=T0_gps, robust_kernel=robust_kernel,
+                          robust_kernel_parameter=robust_kernel_parameter)
     graphslam.init_graph()
     # create the Data Association object
-    dassoc = LoopClosing(graphslam, distance_backwards=distance_backwards, radius_threshold=radius_threshold)
+    dassoc = LoopClosing(graphslam, distance_backwards=distance_backwards, radius_threshold=radius_threshold,
+                         number_of_workers=loop_closing_workers)
     print('Adding Keyframes!')
     # create keyframemanager and add initial observation
-    keyframe_manager = KeyFrameManager(directory=directory, scan_times=scan_times, voxel_size=None, method=method)
+    if use_registration_cache:
+        registration_cache = RegistrationCache(filename=directory + '/robot0/SLAM/registration_cache.npz')
+    else:
+        registration_cache = None
+    keyframe_manager = KeyFrameManager(directory=directory, scan_times=scan_times, voxel_size=None, method=method,
+                                       use_cache=use_cache, memory_budget_mb=memory_budget_mb,
+                                       use_scan_store=use_scan_store, registration_cache=registration_cache,
+                                       registration_engine=registration_engine)
     keyframe_manager.add_keyframes(keyframe_sampling=1)
+    if perform_loop_closing and async_loop_closing:
+        loop_closing_service = LoopClosingService(loop_closing=dassoc, keyframe_manager=keyframe_manager,
+                                                  number_of_triplets_loop_closing=number_of_triplets_loop_closing)
+    else:
+        loop_closing_service = None
     corr_indexes = []
     loop_closures = []
     # start adding scanmatcher info as edges,
@@ -252,11 +311,18 @@ def run_graphSLAM(directory):
 
         # just in case that gps were added
         if i % skip_optimization == 0:
+            # add the loop closures found in the background since the last optimization
+            if loop_closing_service is not None:
+                loop_closures.append(add_loop_closures(dassoc, loop_closing_service.get_edges()))
             graphslam.optimize()
+            reject_loop_closing_outliers(graphslam, chi2_threshold=loop_closing_outlier_chi2)
             graphslam.plot_simple(skip=1, plot3D=False)
 
         # perform Loop Closing: the last condition forces to check for loop closure on the last robot pose in  the trajectory
         if perform_loop_closing and ((i % skip_loop_closing) == 0 or (len(scanmatcher_relative)-i) < 2):
+            if loop_closing_service is not None:
+                loop_closing_service.post(current_index=i, poses=graphslam.get_poses())
+                continue
             graphslam.plot_simple(skip=1, plot3D=False)
             # dassoc.loop_closing_simple(current_index=i, number_of_candidates_DA=number_of_candidates_DA,
             #                                                   keyframe_manager=keyframe_manager)
@@ -266,15 +332,24 @@ def run_graphSLAM(directory):
             loop_closures.append(part_loop_closures)
             graphslam.plot_simple(skip=1, plot3D=False)
         # graphslam.plot_simple(skip=10, plot3D=False)
+    if loop_closing_service is not None:
+        print('Waiting for the loop closing service')
+        loop_closing_service.close()
+        loop_closures.append(add_loop_closures(dassoc, loop_closing_service.get_edges()))
     print('FINAL OPTIMIZATION OF THE MAP')
     graphslam.optimize()
+    reject_loop_closing_outliers(graphslam, chi2_threshold=loop_closing_outlier_chi2)
     print('ENDED SLAM!! SAVING RESULTS!!')
 
     # saving the result as csv: given the estimations, the position and orientation of the LiDAR is retrieved to ease the computation of the maps
     global_transforms_gps = graphslam.get_solution_transforms()
     global_transforms_lidar = graphslam.get_solution_transforms_lidar()
-    euroc_read.save_transforms_as_csv(scan_times, global_transforms_lidar, filename='/robot0/SLAM/solution_graphslam.csv')
+    # also saved as .npz, read back by run_map_viewer.py
+    euroc_read.save_transforms_as_csv(scan_times, global_transforms_lidar, filename='/robot0/SLAM/solution_graphslam.csv',
+                                      save_binary=True)
     euroc_read.save_loop_closures_as_csv(loop_closures, filename='/robot0/SLAM/loop_closures.csv')
+    if registration_cache is not None:
+        registration_cache.save()
 
     # optional, view resulting map
     if view_results:
@@ -283,7 +358,8 @@ def run_graphSLAM(directory):
         graphslam.plot_simple(skip=1, plot3D=True)
         # graphslam.plot(plot3D=True, plot_uncertainty_ellipse=False, skip=1)
         view_result_map(global_transforms=global_transforms_lidar, directory=directory, scan_times=scan_times,
-                        keyframe_sampling=visualization_keyframe_sampling)
+                        keyframe_sampling=visualization_keyframe_sampling, memory_budget_mb=memory_budget_mb,
+                        use_scan_store=use_scan_store)
         if gps_times is not None:
             graphslam.plot_compare_GPS(df_gps=df_gps, correspondences=corr_indexes)
 
@@ -49,27 +49,29 @@ import matplotlib.pyplot as plt
 #     keyframemanager.build_map(global_transforms=global_transforms, keyframe_sampling=keyframe_sampling)
 # from tools.plottools import plot_3D_data
 
-def plot_3D_with_loop_closures(df_data, loop_closures):
+def plot_3D_with_loop_closures(positions, loop_closures):
     """
         Print and plot the result simply. in 3D
+        positions is a (N, 3) array.
     """
     plt.figure(0)
     # axes = fig.gca(projection='3d')
     # plt.cla()
-    # plt.scatter(df_data['x'], df_data['y'], df_data['z'])
-    plt.scatter(df_data['x'], df_data['y'])
+    # plt.scatter(positions[:, 0], positions[:, 1], positions[:, 2])
+    plt.scatter(positions[:, 0], positions[:, 1])
     for k in range(len(loop_closures)):
         i = loop_closures['i'].iloc[k]
         j = loop_closures['j'].iloc[k]
-        x = [df_data['x'].iloc[i], df_data['x'].iloc[j]]
-        y = [df_data['y'].iloc[i], df_data['y'].iloc[j]]
+        x = [positions[i, 0], positions[j, 0]]
+        y = [positions[i, 1], positions[j, 1]]
         # z = [df_data['y'].iloc[lc[0]], df_data['y'].iloc[lc[1]]]
         plt.plot(x, y, color='black', linewidth=3)
 
     plt.show()
 
 
-def view_result_map(global_transforms, directory, scan_times, keyframe_sampling, radii, heights, voxel_size):
+def view_result_map(global_transforms, directory, scan_times, keyframe_sampling, radii, heights, voxel_size,
+                    memory_budget_mb=None, use_scan_store=False):
     """
     View the map (visualize_map_online) or build it.
     When building it, an open3D kd-tree is obtained, which can be saved to a file (i.e.) a csv file.
@@ -84,7 +86,8 @@ def view_result_map(global_transforms, directory, scan_times, keyframe_sampling,
         sampled_global_transforms.append(global_transforms[i])
     # use, for example, voxel_size=0.2. Use voxel_size=None to use full resolution
     # voxel_size = None
-    keyframe_manager = KeyFrameManager(directory=directory, scan_times=scan_times, voxel_size=voxel_size)
+    keyframe_manager = KeyFrameManager(directory=directory, scan_times=scan_times, voxel_size=voxel_size,
+                                       memory_budget_mb=memory_budget_mb, use_scan_store=use_scan_store)
     # OPTIONAL: visualize resulting map
     keyframe_manager.add_keyframes(keyframe_sampling=keyframe_sampling)
     # keyframe_manager.load_pointclouds()
@@ -123,6 +126,10 @@ def main():
     keyframe_sampling = 20
     # use, for example, voxel_size=0.2. Use voxel_size=None to use full resolution
     voxel_size = None
+    # maximum memory (MB) used by the scans while building the map. Use None to keep all the scans in memory
+    memory_budget_mb = 2048
+    # read the scans from the memory-mapped store (robot0/lidar/store), if created with run_converter.py -p
+    use_scan_store = False
 
     # Remove by filtering max and min radius and heights
     # basic scan filtering to build the map (Radius_min, Radius_max, Height_min, Height_max)
@@ -132,12 +139,11 @@ def main():
 
     # read data
     euroc_read = EurocReader(directory=directory)
-    df_map_poses = euroc_read.read_csv(filename=filename)
-    global_transforms = compute_homogeneous_transforms(df_data=df_map_poses)
-    scan_times = df_map_poses['#timestamp [ns]'].to_numpy()
+    # read the binary .npz file saved next to the csv file, if available
+    scan_times, global_transforms = euroc_read.read_transforms(filename=filename)
 
     loop_closures = euroc_read.read_csv(filename='/robot0/SLAM/loop_closures.csv')
-    plot_3D_with_loop_closures(df_data=df_map_poses, loop_closures=loop_closures)
+    plot_3D_with_loop_closures(positions=global_transforms.pos(), loop_closures=loop_closures)
 
     # keyframe_manager = KeyFrameMan    # ager(directory=directory, scan_times=scan_times, voxel_size=voxel_size)
 
@@ -149,7 +155,8 @@ def main():
     #                      radii=radii, heights=heights)
     view_result_map(global_transforms=global_transforms, directory=directory,
                     scan_times=scan_times, keyframe_sampling=keyframe_sampling,
-                    radii=radii, heights=heights, voxel_size=voxel_size)
+                    radii=radii, heights=heights, voxel_size=voxel_size, memory_budget_mb=memory_budget_mb,
+                    use_scan_store=use_scan_store)
 
 
 
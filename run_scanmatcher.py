@@ -3,6 +3,7 @@ Run a scanmatcher using O3D for consecutive scans.
 """
 from eurocreader.eurocreader import EurocReader
 from keyframemanager.keyframemanager import KeyFrameManager
+from keyframemanager.prefetcher import KeyFramePrefetcher
 from artelib.homogeneousmatrix import HomogeneousMatrix, compute_global_transformations, \
     compute_relative_transformations
 import time
@@ -11,6 +12,7 @@ import matplotlib.pyplot as plt
 from tools.gpsconversions import gps2utm
 from tools.sampling import sample_odometry, sample_times
 from artelib.homogeneousmatrix import compute_homogeneous_transforms
+from artelib.homogeneousmatrixarray import HomogeneousMatrixArray
 import getopt
 import sys
 from artelib.euler import Euler
@@ -48,15 +50,9 @@ def plot_odometry(df_odo):
 
 
 def plot_transformations(transforms):
-    positions = []
-    orientations = []
-    for i in range(len(transforms)):
-        t = transforms[i].t2v(n=3)
-        positions.append([t[0], t[1], t[2]])
-        orientations.append([t[3], t[4], t[5]])
-
-    positions = np.array(positions)
-    orientations = np.array(orientations)
+    t = HomogeneousMatrixArray(transforms).t2v(n=3)
+    positions = t[:, 0:3]
+    orientations = t[:, 3:6]
     # plt.figure()
     plt.scatter(positions[:, 0], positions[:, 1])
     # plt.show()
@@ -168,7 +164,25 @@ def scanmatcher(directory=None):
     # other methods:
     # method = 'icppointpoint'
     # method = 'icp2planes'
+    # method = 'icppyramid'
     # method = 'fpfh'
+    # number of scans that are read and pre-processed in the background, ahead of the scanmatcher
+    prefetch_depth = scanmatcher_parameters.get('prefetch_depth', 4)
+    # number of threads used to read and pre-process the scans
+    prefetch_workers = scanmatcher_parameters.get('prefetch_workers', 2)
+    # batch mode: register all pairs of consecutive scans in parallel, using a pool of processes
+    batch_mode = scanmatcher_parameters.get('batch_mode', False)
+    # number of processes (None: the number of CPUs) and number of consecutive pairs assigned to each task
+    batch_workers = scanmatcher_parameters.get('batch_workers', None)
+    batch_chunk_size = scanmatcher_parameters.get('batch_chunk_size', 10)
+    # store the pre-processed pointclouds in robot0/lidar/cache, so that they are reused in the next runs
+    use_cache = scanmatcher_parameters.get('use_cache', False)
+    # read the scans from the memory-mapped store (robot0/lidar/store, see run_converter.py -p)
+    use_scan_store = scanmatcher_parameters.get('use_scan_store', False)
+    # seed the ground plane of each scan with the plane of the previous scan, instead of RANSAC (icp2planes, fpfh)
+    track_ground_plane = scanmatcher_parameters.get('track_ground_plane', False)
+    # the engine that computes the registrations: 'open3d' or 'numpy' (numpy/scipy ICP)
+    registration_engine = scanmatcher_parameters.get('registration_engine', 'open3d')
     ################################################################################################
     # COMPUTATION OF GLOBAL TRANSFORMATIONS
     # T0: initial origin of all transformations
@@ -186,31 +200,42 @@ def scanmatcher(directory=None):
     relative_transforms_odo = compute_relative_odometry_transformations(df_odo=df_odo)
     # Create the KeyFrameManager to store all scans and compute relative transformations
     keyframe_manager = KeyFrameManager(directory=directory, scan_times=scan_times,
-                                       voxel_size=voxel_size, method=method)
+                                       voxel_size=voxel_size, method=method, use_cache=use_cache,
+                                       use_scan_store=use_scan_store, track_ground_plane=track_ground_plane,
+                                       registration_engine=registration_engine)
     relative_transforms_scanmatcher = []
-    keyframe_manager.add_keyframe(0)
-    keyframe_manager.load_pointcloud(0)
-    keyframe_manager.pre_process(0)
-    start_t = time.time()
-    # now run the scanmatcher routine, for each pair of scans
-    for i in range(0, len(scan_times) - 1):
-        print('Adding keyframe and computing transform: ', i, 'out of ', len(scan_times))
-        print('Experiment time is (s): ', (scan_times[i]-scan_times[0])/1e9)
-        # add current keyframe
-        keyframe_manager.add_keyframe(i+1)
-        keyframe_manager.load_pointcloud(i+1)
-        keyframe_manager.pre_process(i+1)
-        atb_odo = relative_transforms_odo[i]
-        print('Initial transform')
-        atb_odo.print_nice()
-        atbsm = keyframe_manager.compute_transformation(i, i + 1, Tij=atb_odo)
-        relative_transforms_scanmatcher.append(atbsm)
-        atbsm.print_nice()
+    if batch_mode:
+        # each pair (i, i+1) is registered independently, the results are returned in index order
+        start_t = time.time()
+        relative_transforms_scanmatcher = keyframe_manager.compute_transformations_batch(
+            initial_transforms=relative_transforms_odo, number_of_workers=batch_workers, chunk_size=batch_chunk_size)
         end_t = time.time()
-        print('COMPUTATION TIME: ', (end_t-start_t)/(i+1))
-        # releasing memory to avoid crashdowns or memory kills
-        # use with caution!
-        keyframe_manager.unload_pointcloud(i)
+        print('COMPUTATION TIME: ', (end_t-start_t)/len(relative_transforms_scanmatcher))
+    else:
+        # all keyframes are added, so that the next scans can be read and pre-processed in the background
+        keyframe_manager.add_keyframes(keyframe_sampling=1)
+        prefetcher = KeyFramePrefetcher(keyframe_manager=keyframe_manager, prefetch_depth=prefetch_depth,
+                                        number_of_workers=prefetch_workers)
+        prefetcher.get(0)
+        start_t = time.time()
+        # now run the scanmatcher routine, for each pair of scans
+        for i in range(0, len(scan_times) - 1):
+            print('Adding keyframe and computing transform: ', i, 'out of ', len(scan_times))
+            print('Experiment time is (s): ', (scan_times[i]-scan_times[0])/1e9)
+            # wait for the current keyframe (read and pre-processed in the background)
+            prefetcher.get(i+1)
+            atb_odo = relative_transforms_odo[i]
+            print('Initial transform')
+            atb_odo.print_nice()
+            atbsm = keyframe_manager.compute_transformation(i, i + 1, Tij=atb_odo)
+            relative_transforms_scanmatcher.append(atbsm)
+            atbsm.print_nice()
+            end_t = time.time()
+            print('COMPUTATION TIME: ', (end_t-start_t)/(i+1))
+            # releasing memory to avoid crashdowns or memory kills
+            # use with caution!
+            keyframe_manager.unload_pointcloud(i)
+        prefetcher.close()
 
     # view results in matplotlib. Caution: both global results are modified by T0 using GPS information
     # CAUTION: made to observe the results in case GPS is available
@@ -229,9 +254,9 @@ def scanmatcher(directory=None):
     # save scanmatcher transforms. Relative
     euroc_read.save_transforms_as_csv(scan_times, relative_transforms_scanmatcher,
                                       filename='/robot0/scanmatcher/scanmatcher_relative.csv')
-    # save global transforms
+    # save global transforms (also as .npz, read back by run_graphSLAM.py)
     euroc_read.save_transforms_as_csv(scan_times, global_transforms_scanmatcher,
-                                      filename='/robot0/scanmatcher/scanmatcher_global.csv')
+                                      filename='/robot0/scanmatcher/scanmatcher_global.csv', save_binary=True)
     # save global transforms, estimated GPS position
     # euroc_read.save_transforms_as_csv(scan_times, global_transforms_scanmatcher_gps,
     #                                   filename='/robot0/scanmatcher/scanmatcher_gps_global.csv')
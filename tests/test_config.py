@@ -0,0 +1,21 @@
+"""
+Test the validation of the ICP parameters.
+"""
+import pytest
+from config.config import ICP_PARAMETERS, check_icp_pyramid
+
+
+def test_default_icp_pyramid():
+    assert len(ICP_PARAMETERS.pyramid_distance_thresholds) == len(ICP_PARAMETERS.pyramid_voxel_sizes) + 1
+    assert len(ICP_PARAMETERS.pyramid_max_iterations) == len(ICP_PARAMETERS.pyramid_voxel_sizes) + 1
+
+
+def test_check_icp_pyramid():
+    check_icp_pyramid(voxel_sizes=[1.0, 0.4], distance_thresholds=[5.0, 1.5, 0.5], max_iterations=[30, 20, 10])
+    # no coarse levels: only the finest level
+    check_icp_pyramid(voxel_sizes=[], distance_thresholds=[0.5], max_iterations=[10])
+    with pytest.raises(ValueError):
+        # a value per voxel size, without the finest level
+        check_icp_pyramid(voxel_sizes=[1.0, 0.4], distance_thresholds=[5.0, 1.5], max_iterations=[30, 20])
+    with pytest.raises(ValueError):
+        check_icp_pyramid(voxel_sizes=[1.0, 0.4], distance_thresholds=[5.0, 1.5, 0.5], max_iterations=[30, 20])
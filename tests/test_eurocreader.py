@@ -0,0 +1,143 @@
+"""
+Test the vectorized EurocReader functions against the original per-timestamp loops.
+"""
+import os
+import warnings
+import numpy as np
+import pandas as pd
+from artelib.euler import Euler
+from artelib.homogeneousmatrix import HomogeneousMatrix
+from eurocreader.eurocreader import EurocReader
+
+
+def closest_indexes_loop(master_sensor_times, sensor_times):
+    """
+    The original search: the argmin of the time difference for each master time.
+    """
+    indexes = []
+    time_diffs = []
+    for timestamp in master_sensor_times:
+        d = np.abs(sensor_times-timestamp)
+        index = np.argmin(d)
+        indexes.append(index)
+        time_diffs.append(d[index])
+    return np.array(indexes), np.array(time_diffs)
+
+
+def test_closest_indexes_match_argmin():
+    rng = np.random.default_rng(0)
+    euroc_read = EurocReader(directory='')
+    sensor_times = np.sort(rng.integers(0, 10**10, 200))
+    master_sensor_times = rng.integers(-10**9, 11*10**9, 300)
+    indexes, time_diffs = euroc_read.get_closest_indexes(master_sensor_times=master_sensor_times,
+                                                         sensor_times=sensor_times)
+    expected_indexes, expected_time_diffs = closest_indexes_loop(master_sensor_times, sensor_times)
+    assert np.array_equal(indexes, expected_indexes)
+    assert np.array_equal(time_diffs, expected_time_diffs)
+
+
+def test_closest_indexes_unsorted_ties_and_repeats():
+    rng = np.random.default_rng(1)
+    euroc_read = EurocReader(directory='')
+    # unsorted sensor times, with repeated times
+    sensor_times = rng.permutation(np.repeat(np.arange(0, 100, 10), 3))
+    # master times on the sensor times and halfway between two of them (ties)
+    master_sensor_times = np.concatenate((np.arange(0, 100, 10), np.arange(5, 100, 10), [-7, 130]))
+    indexes, time_diffs = euroc_read.get_closest_indexes(master_sensor_times=master_sensor_times,
+                                                         sensor_times=sensor_times)
+    expected_indexes, expected_time_diffs = closest_indexes_loop(master_sensor_times, sensor_times)
+    assert np.array_equal(indexes, expected_indexes)
+    assert np.array_equal(time_diffs, expected_time_diffs)
+    times = euroc_read.get_closest_times(master_sensor_times=master_sensor_times, sensor_times=sensor_times)
+    assert np.array_equal(times, sensor_times[expected_indexes])
+
+
+def df_at_times_loop(df_data, time_list):
+    """
+    The original selection: a boolean mask and a concat for each time.
+    """
+    df = pd.DataFrame(columns=['#timestamp [ns]', 'x', 'y', 'z', 'qx', 'qy', 'qz', 'qw'])
+    for timestamp in time_list:
+        ind = df_data['#timestamp [ns]'] == timestamp
+        row = df_data.loc[ind]
+        df = pd.concat([df, row], ignore_index=True)
+    return df
+
+
+def test_df_at_times_match_loop():
+    rng = np.random.default_rng(2)
+    euroc_read = EurocReader(directory='')
+    n = 50
+    # unsorted times, some of them repeated, and an extra column
+    times = rng.permutation(np.repeat(np.arange(n//2)*100, 2))
+    df_data = pd.DataFrame({'#timestamp [ns]': times,
+                            'qw': rng.random(n), 'qx': rng.random(n), 'qy': rng.random(n), 'qz': rng.random(n),
+                            'x': rng.random(n), 'y': rng.random(n), 'z': rng.random(n),
+                            'covariance': rng.random(n)})
+    # repeated times, out of order and a time not found in df_data
+    time_list = np.concatenate((rng.choice(times, 30), [50]))
+    df = euroc_read.get_df_at_times(df_data=df_data, time_list=time_list)
+    with warnings.catch_warnings():
+        # concat with an empty DataFrame
+        warnings.simplefilter('ignore', FutureWarning)
+        expected_df = df_at_times_loop(df_data=df_data, time_list=time_list)
+    assert list(df.columns) == list(expected_df.columns)
+    pd.testing.assert_frame_equal(df, expected_df, check_dtype=False)
+
+
+def random_transforms(n, seed=3):
+    rng = np.random.default_rng(seed)
+    transforms = []
+    for i in range(n):
+        transforms.append(HomogeneousMatrix(rng.uniform(-5, 5, 3), Euler(rng.uniform(-np.pi, np.pi, 3))))
+    return transforms
+
+
+def transforms_df_loop(sensor_times, transforms):
+    """
+    The original conversion: position and quaternion of each transform.
+    """
+    data_list = []
+    for i in range(len(transforms)):
+        Ti = transforms[i]
+        t = Ti.pos()
+        q = Ti.Q()
+        data_list.append({'#timestamp [ns]': sensor_times[i],
+                          'x': t[0], 'y': t[1], 'z': t[2],
+                          'qx': q[1], 'qy': q[2], 'qz': q[3], 'qw': q[0]})
+    return pd.DataFrame(data_list)
+
+
+def test_save_and_read_transforms(tmp_path):
+    euroc_read = EurocReader(directory=str(tmp_path))
+    transforms = random_transforms(20)
+    # one time more than transforms
+    sensor_times = np.arange(21)*100000000
+    filename = '/robot0/SLAM/solution.csv'
+    df = euroc_read.save_transforms_as_csv(sensor_times, transforms, filename=filename)
+    pd.testing.assert_frame_equal(df, transforms_df_loop(sensor_times, transforms))
+    # the .npz file is only written if requested: the transforms are computed from the csv file
+    assert not os.path.exists(euroc_read.binary_filename(filename))
+    times, read_transforms = euroc_read.read_transforms(filename=filename)
+    assert np.array_equal(times, sensor_times[0:20])
+    for i in range(len(transforms)):
+        assert np.allclose(read_transforms[i].toarray(), transforms[i].toarray())
+    # the .npz file is read back without any conversion
+    euroc_read.save_transforms_as_csv(sensor_times, transforms, filename=filename, save_binary=True)
+    times, read_transforms = euroc_read.read_transforms(filename=filename)
+    assert np.array_equal(times, sensor_times[0:20])
+    assert np.array_equal(read_transforms.toarray(), np.array([T.toarray() for T in transforms]))
+
+
+def test_read_transforms_ignores_old_binary(tmp_path):
+    euroc_read = EurocReader(directory=str(tmp_path))
+    filename = '/solution.csv'
+    euroc_read.save_transforms_as_csv(np.arange(5), random_transforms(5), filename=filename, save_binary=True)
+    # the csv file is written again, without the .npz file, and it is more recent
+    transforms = random_transforms(5, seed=4)
+    euroc_read.save_transforms_as_csv(np.arange(5), transforms, filename=filename)
+    binary_time = os.path.getmtime(euroc_read.binary_filename(filename))
+    os.utime(str(tmp_path) + filename, (binary_time + 10, binary_time + 10))
+    times, read_transforms = euroc_read.read_transforms(filename=filename)
+    for i in range(len(transforms)):
+        assert np.allclose(read_transforms[i].toarray(), transforms[i].toarray())
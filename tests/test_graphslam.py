@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+gtsam = pytest.importorskip('gtsam')
+
+from artelib.euler import Euler
+from artelib.homogeneousmatrix import HomogeneousMatrix
+from graphslam.graphSLAM import GraphSLAM
+
+
+def test_poses_with_non_symmetric_rotations():
+    graphslam = GraphSLAM(T0=HomogeneousMatrix(), T0_gps=HomogeneousMatrix())
+    graphslam.init_graph()
+    atb = HomogeneousMatrix(np.array([1.0, 0.5, 0.2]), Euler([0.1, -0.2, 0.7]))
+    for k in range(1, 4):
+        graphslam.add_initial_estimate(atb, k)
+        graphslam.add_edge(atb, k - 1, k, 'SM')
+    # all the poses change: the estimate is refreshed at once (extractPose3)
+    graphslam.optimize()
+    poses = graphslam.get_poses()
+    estimate = graphslam.isam.calculateEstimate()
+    T = np.eye(4)
+    for k in range(4):
+        assert np.allclose(poses[k], estimate.atPose3(k).matrix(), atol=1e-9)
+        assert np.allclose(poses[k], T, atol=1e-6)
+        T = np.dot(T, atb.array)
+
+
+def build_graph(loop_closing=None):
+    """
+    A square trajectory with scanmatching edges and, optionally, a loop closing edge (atb, i, j).
+    """
+    graphslam = GraphSLAM(T0=HomogeneousMatrix(), T0_gps=HomogeneousMatrix())
+    graphslam.init_graph()
+    atb = HomogeneousMatrix(np.array([1.0, 0.0, 0.0]), Euler([0.0, 0.0, np.pi/2]))
+    for k in range(1, 5):
+        graphslam.add_initial_estimate(atb, k)
+        graphslam.add_edge(atb, k - 1, k, 'SM')
+    graphslam.optimize()
+    edge_index = None
+    if loop_closing is not None:
+        edge_index = graphslam.add_edge(loop_closing[0], loop_closing[1], loop_closing[2], 'LC')
+        graphslam.optimize()
+    return graphslam, edge_index
+
+
+def test_rejected_loop_closing_is_removed():
+    # a wrong loop closing: the pose 4 is the pose 0, but the edge says it is 3 m away
+    wrong = HomogeneousMatrix(np.array([3.0, 0.0, 0.0]), Euler([0.0, 0.0, 0.0]))
+    graphslam, edge_index = build_graph(loop_closing=(wrong, 0, 4))
+    reference, _ = build_graph()
+    assert not np.allclose(graphslam.get_poses(), reference.get_poses(), atol=1e-3)
+    assert graphslam.reject_outliers() == [edge_index]
+    assert not graphslam.edges[edge_index]['enabled']
+    # the factor is removed from iSAM2 in the next optimization. A few more updates relinearize the poses
+    for k in range(5):
+        graphslam.optimize()
+    assert np.allclose(graphslam.get_poses(), reference.get_poses(), atol=1e-6)
+    # the covariances (plot) are computed without the rejected edge
+    assert graphslam.active_graph().size() == reference.graph.size() == graphslam.graph.size() - 1
+    marginals = gtsam.Marginals(graphslam.active_graph(), graphslam.current_estimate)
+    reference_marginals = gtsam.Marginals(reference.graph, reference.current_estimate)
+    assert np.allclose(marginals.marginalCovariance(4), reference_marginals.marginalCovariance(4), atol=1e-9)
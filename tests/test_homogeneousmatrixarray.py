@@ -0,0 +1,88 @@
+"""
+Test HomogeneousMatrixArray and the batched rotation kernels against the scalar HomogeneousMatrix and artelib.tools
+functions.
+"""
+import numpy as np
+from artelib.euler import Euler
+from artelib.homogeneousmatrix import HomogeneousMatrix
+from artelib.homogeneousmatrixarray import HomogeneousMatrixArray
+from artelib.tools import quaternion2rot, quaternion2rot_array, rot2quaternion, rot2quaternion_array, rot2euler, \
+    rot2euler_array, euler2rot
+
+
+def random_transforms(n, seed=0):
+    rng = np.random.default_rng(seed)
+    transforms = []
+    for i in range(n):
+        abg = rng.uniform(-np.pi, np.pi, 3)
+        transforms.append(HomogeneousMatrix(rng.uniform(-5, 5, 3), Euler(abg)))
+    return transforms
+
+
+def special_rotations():
+    """
+    Rotations of 180 degrees (w = 0) about the axes and about a random axis, plus rotations with beta = +-pi/2
+    (gimbal lock).
+    """
+    rotations = [np.diag([1, -1, -1]), np.diag([-1, 1, -1]), np.diag([-1, -1, 1])]
+    axis = np.array([1, 2, 3])/np.linalg.norm([1, 2, 3])
+    rotations.append(2*np.outer(axis, axis) - np.eye(3))
+    for beta in [np.pi/2, -np.pi/2]:
+        for alpha, gamma in [(0, 0), (0.3, -1.2), (-2.5, 2.0)]:
+            rotations.append(euler2rot([alpha, beta, gamma]))
+    return np.array(rotations, dtype=float)
+
+
+def test_cumulative_relative_inv_match_scalar():
+    transforms = random_transforms(37)
+    T0 = HomogeneousMatrix(np.array([1, 2, 3]), Euler([0.1, 0.2, 0.3]))
+    transforms_array = HomogeneousMatrixArray(transforms)
+    # cumulative: T0, T0*T[0], T0*T[0]*T[1], ...
+    expected = [T0]
+    for T in transforms:
+        expected.append(expected[-1]*T)
+    cumulative = transforms_array.cumulative(T0)
+    assert len(cumulative) == len(transforms) + 1
+    for i in range(len(expected)):
+        assert np.allclose(cumulative[i].toarray(), expected[i].toarray())
+    # relative: T[i].inv()*T[i+1]
+    relative = transforms_array.relative()
+    assert len(relative) == len(transforms) - 1
+    for i in range(len(transforms) - 1):
+        assert np.allclose(relative[i].toarray(), (transforms[i].inv()*transforms[i+1]).toarray())
+    # relative and cumulative are inverse operations
+    assert np.allclose(relative.cumulative(transforms[0]).toarray(), transforms_array.toarray())
+    inv = transforms_array.inv()
+    for i in range(len(transforms)):
+        assert np.allclose(inv[i].toarray(), transforms[i].inv().toarray())
+
+
+def test_append_and_compose():
+    transforms = random_transforms(5, seed=1)
+    transforms_array = HomogeneousMatrixArray()
+    for T in transforms:
+        transforms_array.append(T)
+    assert len(transforms_array) == 5
+    T = transforms[0]
+    for i in range(5):
+        assert np.allclose((transforms_array*T)[i].toarray(), (transforms[i]*T).toarray())
+        assert np.allclose((T*transforms_array)[i].toarray(), (T*transforms[i]).toarray())
+
+
+def test_rotation_kernels_match_scalar():
+    transforms = random_transforms(50, seed=2)
+    R = np.concatenate((np.array([T.toarray()[0:3, 0:3] for T in transforms]), special_rotations()))
+    Q = rot2quaternion_array(R)
+    e1, e2 = rot2euler_array(R)
+    for i in range(len(R)):
+        assert np.allclose(Q[i], rot2quaternion(R[i]))
+        # caution: rot2euler modifies R
+        expected_e1, expected_e2 = rot2euler(R[i].copy())
+        assert np.allclose(e1[i], expected_e1)
+        assert np.allclose(e2[i], expected_e2)
+    # the rotations of 180 degrees have w = 0
+    assert np.allclose(Q[50:54, 0], 0)
+    R2 = quaternion2rot_array(Q)
+    for i in range(len(Q)):
+        assert np.allclose(R2[i], quaternion2rot(Q[i]))
+    assert np.allclose(R2, R)
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+o3d = pytest.importorskip('open3d')
+
+from keyframemanager import keyframe
+from keyframemanager.keyframe import KeyFrame
+from keyframemanager.registrationengine import NumpyEngine
+
+
+def corner_points(n=1000, seed=0):
+    """
+    Points on three orthogonal planes (a corner), so that the registration is well constrained.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.uniform(-5, 5, (n, 2))
+    zeros = np.zeros(n)
+    return np.vstack((np.column_stack((a, zeros)),
+                      np.column_stack((a[:, 0], zeros, a[:, 1])),
+                      np.column_stack((zeros, a))))
+
+
+def build_keyframe(points):
+    keyframe_i = KeyFrame(directory=None, scan_time=0, voxel_size=None)
+    keyframe_i.pointcloud_filtered = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+    return keyframe_i
+
+
+def test_kdtree_is_reused_and_invalidated_by_transform(monkeypatch):
+    # count the trees built by the keyframes
+    built = []
+    build_kdtree = keyframe.build_kdtree
+
+    def counting_build_kdtree(points):
+        built.append(len(points))
+        return build_kdtree(points)
+
+    monkeypatch.setattr(keyframe, 'build_kdtree', counting_build_kdtree)
+    points = corner_points()
+    target = build_keyframe(points)
+    source = build_keyframe(points + np.array([0.1, -0.2, 0.05]))
+    engine = NumpyEngine()
+    T1, _, _ = engine.register(target, source, np.eye(4), 'icppointpoint')
+    tree = target.kdtrees['pointcloud_filtered'][1]
+    T2, _, _ = engine.register(target, source, np.eye(4), 'icppointpoint')
+    # the second registration against the same target reuses the tree
+    assert len(built) == 1
+    assert target.kdtrees['pointcloud_filtered'][1] is tree
+    assert np.allclose(T1.array, T2.array)
+    # the points of the target are moved in place: the tree is built again, on the new points
+    T = np.eye(4)
+    T[0:3, 3] = [1.0, 2.0, 3.0]
+    target.transform(T)
+    assert len(target.kdtrees) == 0
+    new_tree = target.get_kdtree('pointcloud_filtered', target.pointcloud_filtered)
+    assert len(built) == 2
+    assert new_tree is not tree
+    assert np.allclose(new_tree.data, np.asarray(target.pointcloud_filtered.points))
@@ -0,0 +1,155 @@
+import os
+import numpy as np
+import pytest
+
+o3d = pytest.importorskip('open3d')
+
+from artelib.euler import Euler
+from artelib.homogeneousmatrix import HomogeneousMatrix
+from keyframemanager.keyframemanager import KeyFrameManager
+from keyframemanager.planetracker import PlaneTracker
+from keyframemanager.prefetcher import KeyFramePrefetcher
+
+
+def write_scans(directory, scan_times):
+    rng = np.random.default_rng(0)
+    os.makedirs(directory + '/robot0/lidar/data/')
+    for scan_time in scan_times:
+        points = rng.uniform(-10, 10, (2000, 3))
+        pointcloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+        o3d.io.write_point_cloud(directory + '/robot0/lidar/data/' + str(scan_time) + '.pcd', pointcloud)
+
+
+def test_build_map_from_cached_keyframes(tmp_path, monkeypatch):
+    directory = str(tmp_path)
+    scan_times = [1000, 2000, 3000]
+    write_scans(directory, scan_times)
+    # first run: pre-process the keyframes and store them in the cache
+    keyframe_manager = KeyFrameManager(directory=directory, scan_times=scan_times, voxel_size=None,
+                                       method='icppointpoint', use_cache=True)
+    keyframe_manager.add_keyframes(keyframe_sampling=1)
+    for i in range(len(scan_times)):
+        keyframe_manager.load_and_pre_process(i)
+    # second run: the keyframes are restored from the cache, without reading the original scans
+    keyframe_manager = KeyFrameManager(directory=directory, scan_times=scan_times, voxel_size=None,
+                                       method='icppointpoint', use_cache=True)
+    keyframe_manager.add_keyframes(keyframe_sampling=1)
+    for i in range(len(scan_times)):
+        keyframe_manager.load_and_pre_process(i)
+        assert keyframe_manager.keyframes[i].pointcloud is None
+    monkeypatch.setattr(o3d.visualization, 'draw_geometries', lambda geometries: None)
+    global_transforms = [HomogeneousMatrix() for i in range(len(scan_times))]
+    pointcloud_global = keyframe_manager.build_map(global_transforms=global_transforms, keyframe_sampling=1)
+    assert len(pointcloud_global.points) > 0
+
+
+def test_plane_tracker_is_updated_from_cached_keyframes(tmp_path, monkeypatch):
+    directory = str(tmp_path)
+    scan_times = [1000, 2000, 3000]
+    write_scans(directory, scan_times)
+    monkeypatch.setattr(PlaneTracker, 'ransac', lambda self, points, threshold: (np.array([0, 0, 1, 1.0]), 0.9))
+    planes = []
+    for k in range(2):
+        # first run: the planes are estimated and stored in the cache. Second run: read from the cache
+        keyframe_manager = KeyFrameManager(directory=directory, scan_times=scan_times, voxel_size=None,
+                                           method='icp2planes', use_cache=True, track_ground_plane=True)
+        keyframe_manager.add_keyframes(keyframe_sampling=1)
+        for i in range(len(scan_times)):
+            keyframe_manager.load_and_pre_process(i)
+        planes.append(keyframe_manager.plane_tracker.planes)
+    assert keyframe_manager.keyframes[0].pointcloud is None
+    assert planes[1].keys() == planes[0].keys() == {0, 1, 2}
+    for i in range(len(scan_times)):
+        assert np.allclose(planes[1][i][0], planes[0][i][0])
+        assert planes[1][i][1] == planes[0][i][1]
+
+
+def test_prefetcher_pre_processes_keyframes_in_order(tmp_path):
+    directory = str(tmp_path)
+    scan_times = [1000, 2000, 3000, 4000, 5000]
+    write_scans(directory, scan_times)
+    keyframe_manager = KeyFrameManager(directory=directory, scan_times=scan_times, voxel_size=None,
+                                       method='icppointpoint')
+    keyframe_manager.add_keyframes(keyframe_sampling=1)
+    prefetcher = KeyFramePrefetcher(keyframe_manager=keyframe_manager, prefetch_depth=2, number_of_workers=2)
+    for i in range(len(scan_times)):
+        keyframe = prefetcher.get(i)
+        assert keyframe is keyframe_manager.keyframes[i]
+        assert keyframe.pre_processed
+    prefetcher.close()
+
+
+def write_moving_scans(directory, scan_times, step):
+    """
+    A scene with a ground plane and two walls, seen from a robot that moves step (a HomogeneousMatrix) between
+    consecutive scans.
+    """
+    rng = np.random.default_rng(0)
+    n = 1500
+    a = rng.uniform(-10, 10, (n, 2))
+    h = rng.uniform(-0.5, 5, n)
+    scene = np.vstack((np.column_stack((a, -0.5*np.ones(n))),
+                       np.column_stack((8*np.ones(n), a[:, 0], h)),
+                       np.column_stack((a[:, 1], 8*np.ones(n), h))))
+    os.makedirs(directory + '/robot0/lidar/data/')
+    T = np.eye(4)
+    for scan_time in scan_times:
+        # the points in the frame of the robot
+        points = np.dot(scene - T[0:3, 3], T[0:3, 0:3])
+        pointcloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+        o3d.io.write_point_cloud(directory + '/robot0/lidar/data/' + str(scan_time) + '.pcd', pointcloud)
+        T = np.dot(T, step.array)
+
+
+def test_batch_transformations_match_sequential(tmp_path):
+    directory = str(tmp_path)
+    scan_times = [1000, 2000, 3000, 4000, 5000]
+    step = HomogeneousMatrix(np.array([0.3, 0.05, 0.0]), Euler([0.0, 0.0, 0.02]))
+    write_moving_scans(directory, scan_times, step)
+    initial_transforms = [HomogeneousMatrix() for i in range(len(scan_times) - 1)]
+    keyframe_manager = KeyFrameManager(directory=directory, scan_times=scan_times, voxel_size=None,
+                                       method='icppointpoint', registration_engine='numpy')
+    keyframe_manager.add_keyframes(keyframe_sampling=1)
+    sequential = []
+    for i in range(len(scan_times) - 1):
+        keyframe_manager.load_and_pre_process(i)
+        keyframe_manager.load_and_pre_process(i + 1)
+        sequential.append(keyframe_manager.compute_transformation(i, i + 1, Tij=initial_transforms[i]))
+    batch = keyframe_manager.compute_transformations_batch(initial_transforms=initial_transforms,
+                                                           number_of_workers=2, chunk_size=2)
+    assert len(batch) == len(sequential)
+    for i in range(len(sequential)):
+        assert np.allclose(batch[i].array, sequential[i].array, atol=1e-9)
+        assert np.allclose(sequential[i].array, step.array, atol=1e-3)
+
+
+def test_memory_budget(tmp_path):
+    directory = str(tmp_path)
+    scan_times = [1000, 2000, 3000, 4000, 5000, 6000]
+    write_scans(directory, scan_times)
+    keyframe_manager = KeyFrameManager(directory=directory, scan_times=scan_times, voxel_size=None,
+                                       method='icppointpoint', memory_budget_mb=1.0)
+    keyframe_manager.add_keyframes(keyframe_sampling=1)
+    keyframe_manager.pin(0)
+    keyframe_manager.load_and_pre_process(0)
+    # only two keyframes fit in the budget (all the scans have the same number of points)
+    keyframe_manager.memory_budget = int(2.5*keyframe_manager.keyframes[0].memory_bytes())
+    for i in range(len(scan_times)):
+        keyframe_manager.load_and_pre_process(i)
+        assert keyframe_manager.resident_bytes <= keyframe_manager.memory_budget
+        # the pinned keyframe is never unloaded
+        assert keyframe_manager.keyframes[0].pre_processed
+        assert 0 in keyframe_manager.resident
+    keyframe_manager.unpin(0)
+    keyframe_manager.load_and_pre_process(0)
+    assert keyframe_manager.resident_bytes <= keyframe_manager.memory_budget
+    # the least recently used keyframes have been unloaded
+    assert not keyframe_manager.keyframes[1].pre_processed
+    assert keyframe_manager.keyframes[1].pointcloud_filtered is None
+    assert list(keyframe_manager.resident.keys()) == [5, 0]
+    assert keyframe_manager.resident_bytes == sum([keyframe_manager.keyframes[i].memory_bytes() for i in [5, 0]])
+    # an unloaded keyframe is loaded again when needed
+    keyframe_manager.ensure_pre_processed(1)
+    assert keyframe_manager.keyframes[1].pre_processed
+    assert len(keyframe_manager.keyframes[1].pointcloud_filtered.points) > 0
+    assert keyframe_manager.resident_bytes <= keyframe_manager.memory_budget
@@ -0,0 +1,89 @@
+import numpy as np
+
+from graphslam.loopclosing import LoopClosing
+
+
+def circular_trajectory(n=300, laps=2, radius=10.0, seed=0):
+    """
+    The poses (n, 4, 4) of a robot that drives laps around a circle, with some noise, so that it revisits places.
+    """
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2*np.pi*laps, n)
+    poses = np.tile(np.eye(4), (n, 1, 1))
+    poses[:, 0, 3] = radius*np.cos(angles) + rng.normal(0, 0.3, n)
+    poses[:, 1, 3] = radius*np.sin(angles) + rng.normal(0, 0.3, n)
+    poses[:, 2, 3] = rng.normal(0, 0.1, n)
+    return poses
+
+
+def index_backwards_brute_force(positions, distance_backwards):
+    """
+    The last index i whose distance travelled to the last position is over distance_backwards (or None).
+    """
+    d = 0
+    for i in reversed(range(len(positions)-1)):
+        d += np.linalg.norm(positions[i+1]-positions[i])
+        if d > distance_backwards:
+            return i
+    return None
+
+
+def candidates_brute_force(positions, distance_backwards, radius_threshold):
+    index = index_backwards_brute_force(positions, distance_backwards)
+    if index is None:
+        return np.zeros(0, dtype=int)
+    d = np.linalg.norm(positions[0:index] - positions[-1], axis=1)
+    return np.where(d < radius_threshold)[0]
+
+
+def triplets_brute_force(positions, candidates, i):
+    """
+    For each candidate j1, the first candidate j2 after it with 1 < |j2-j1| < 80 and 1 < distance(j1, j2) < 2.
+    """
+    triplets = []
+    candidates = np.sort(candidates)
+    for k in range(len(candidates)):
+        j1 = candidates[k]
+        for j2 in candidates[k:]:
+            d = np.linalg.norm(positions[j1] - positions[j2])
+            if 1 < abs(j2 - j1) < 80 and 1.0 < d < 2.0:
+                triplets.append([i, j1, j2])
+                break
+    return triplets
+
+
+def test_candidates_match_brute_force():
+    rng = np.random.default_rng(1)
+    poses = circular_trajectory()
+    loop_closing = LoopClosing(graphslam=None, distance_backwards=7, radius_threshold=5.0)
+    number_of_candidates = 0
+    for n in range(20, len(poses), 7):
+        # the optimizations move the past poses: the path lengths and the grid are updated
+        if n % 3 == 0:
+            poses[rng.integers(n):n, 0:3, 3] += rng.normal(0, 0.2, 3)
+        loop_closing.set_estimate(poses[0:n])
+        candidates = loop_closing.find_candidates()
+        positions = poses[0:n, 0:3, 3]
+        assert loop_closing.find_index_backwards() == index_backwards_brute_force(positions, 7)
+        assert np.allclose(loop_closing.path_lengths[-1] - loop_closing.path_lengths,
+                           np.concatenate((np.cumsum(np.linalg.norm(np.diff(positions, axis=0),
+                                                                    axis=1)[::-1])[::-1], [0.0])))
+        assert np.array_equal(candidates, candidates_brute_force(positions, 7, 5.0))
+        number_of_candidates += len(candidates)
+    # the trajectory revisits places: the comparison is not trivial
+    assert number_of_candidates > 0
+
+
+def test_triplets_match_brute_force():
+    poses = circular_trajectory()
+    loop_closing = LoopClosing(graphslam=None, distance_backwards=7, radius_threshold=5.0)
+    number_of_triplets = 0
+    for n in range(20, len(poses), 7):
+        loop_closing.set_estimate(poses[0:n])
+        triplets = loop_closing.find_feasible_triplets(current_index=n-1)
+        positions = poses[0:n, 0:3, 3]
+        candidates = candidates_brute_force(positions, 7, 5.0)
+        expected = triplets_brute_force(positions, candidates, n-1)
+        assert [[int(x) for x in triplet] for triplet in triplets] == expected
+        number_of_triplets += len(triplets)
+    assert number_of_triplets > 0
@@ -0,0 +1,82 @@
+import threading
+import numpy as np
+import pytest
+
+from graphslam.loopclosingservice import LoopClosingService
+
+
+class StubLoopClosing():
+    """
+    Returns an edge [i, i-1, None] for each request. The first request waits until release is set, so that the next
+    requests queue up. The requests at fail_indexes raise an exception.
+    """
+    def __init__(self, fail_indexes=(), block=False):
+        self.fail_indexes = fail_indexes
+        self.processed = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+
+    def find_loop_closures_triangle(self, current_index, number_of_triplets_loop_closing, keyframe_manager, poses):
+        self.started.set()
+        self.release.wait()
+        self.processed.append(current_index)
+        if current_index in self.fail_indexes:
+            raise RuntimeError('Loop closing failed at index: ' + str(current_index))
+        return [[current_index, current_index - 1, None]]
+
+
+def poses(n):
+    return np.tile(np.eye(4), (n, 1, 1))
+
+
+def test_stale_requests_are_skipped():
+    loop_closing = StubLoopClosing(block=True)
+    service = LoopClosingService(loop_closing, keyframe_manager=None, number_of_triplets_loop_closing=5)
+    service.post(10, poses(11))
+    loop_closing.started.wait()
+    # the requests posted meanwhile: only the most recent one is processed
+    for index in [11, 12, 13]:
+        service.post(index, poses(index + 1))
+    loop_closing.release.set()
+    service.wait()
+    assert loop_closing.processed == [10, 13]
+    assert service.get_edges() == [[10, 9, None], [13, 12, None]]
+    assert service.get_edges() == []
+    service.close()
+    assert not service.thread.is_alive()
+
+
+def test_error_is_raised_in_get_edges():
+    service = LoopClosingService(StubLoopClosing(fail_indexes=[10]), keyframe_manager=None,
+                                 number_of_triplets_loop_closing=5)
+    service.post(10, poses(11))
+    service.requests.join()
+    with pytest.raises(RuntimeError):
+        service.get_edges()
+    # the error is raised once: the service keeps processing requests
+    service.post(11, poses(12))
+    service.wait()
+    assert service.get_edges() == [[11, 10, None]]
+    service.close()
+
+
+def test_error_is_raised_in_wait():
+    service = LoopClosingService(StubLoopClosing(fail_indexes=[10]), keyframe_manager=None,
+                                 number_of_triplets_loop_closing=5)
+    service.post(10, poses(11))
+    with pytest.raises(RuntimeError):
+        service.wait()
+    service.close()
+    assert not service.thread.is_alive()
+
+
+def test_error_is_raised_in_close():
+    service = LoopClosingService(StubLoopClosing(fail_indexes=[10]), keyframe_manager=None,
+                                 number_of_triplets_loop_closing=5)
+    service.post(10, poses(11))
+    with pytest.raises(RuntimeError):
+        service.close()
+    # the thread is stopped anyway
+    assert not service.thread.is_alive()
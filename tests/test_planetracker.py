@@ -0,0 +1,108 @@
+import threading
+import numpy as np
+import pytest
+
+pytest.importorskip('open3d')
+
+from keyframemanager.planetracker import PlaneTracker
+
+
+def ground_points(plane_model, n=2000, noise=0.001, seed=0):
+    """
+    Points on the plane ax + by + cz + d = 0 (c != 0), with some noise in z.
+    """
+    rng = np.random.default_rng(seed)
+    [a, b, c, d] = plane_model
+    xy = rng.uniform(-10, 10, (n, 2))
+    z = -(a*xy[:, 0] + b*xy[:, 1] + d)/c + rng.normal(0, noise, n)
+    return np.column_stack((xy, z))
+
+
+def unit(plane_model):
+    plane_model = np.asarray(plane_model, dtype=np.float64)
+    return plane_model / np.linalg.norm(plane_model[0:3])
+
+
+class FakeRansac():
+    """
+    Replaces PlaneTracker.ransac: returns a fixed plane model and ratio and counts the calls.
+    """
+    def __init__(self, plane_model, ratio):
+        self.plane_model = np.asarray(plane_model)
+        self.ratio = ratio
+        self.calls = 0
+
+    def __call__(self, points, threshold):
+        self.calls += 1
+        return self.plane_model, self.ratio
+
+
+def test_first_scan_runs_ransac():
+    tracker = PlaneTracker()
+    tracker.ransac = FakeRansac([0, 0, 1, 1], 0.9)
+    plane_model, ratio = tracker.estimate(ground_points([0, 0, 1, 1]), threshold=0.01, index=0)
+    assert tracker.ransac.calls == 1
+    assert np.allclose(plane_model, [0, 0, 1, 1])
+    assert ratio == 0.9
+
+
+def test_refit_from_previous_plane():
+    tracker = PlaneTracker()
+    tracker.ransac = FakeRansac([0, 0, 1, 1], 0.9)
+    tracker.update(0, [0, 0, 1, 1], 0.9)
+    # the ground tilts slightly: all the points are still close to the previous plane
+    new_plane = unit([0.0005, -0.0003, 1, 1.001])
+    plane_model, ratio = tracker.estimate(ground_points(new_plane), threshold=0.05, index=1)
+    assert tracker.ransac.calls == 0
+    assert tracker.number_of_tracked == 1
+    assert np.allclose(plane_model, new_plane, atol=1e-3)
+    # the reference ratio is kept from the last RANSAC
+    assert ratio == 0.9
+    assert np.allclose(tracker.planes[1][0], plane_model)
+
+
+def test_ransac_when_inlier_ratio_degrades():
+    tracker = PlaneTracker()
+    ransac_plane = unit([0, 0.2, 1, 2])
+    tracker.ransac = FakeRansac(ransac_plane, 0.95)
+    tracker.update(0, [0, 0, 1, 1], 0.9)
+    # 75% of the points on the previous plane: above 0.8*0.9 = 0.72, the plane is refitted
+    points = np.vstack((ground_points([0, 0, 1, 1], n=1500), ground_points(ransac_plane, n=500, seed=1) + [0, 0, 5]))
+    tracker.estimate(points, threshold=0.01, index=1)
+    assert tracker.ransac.calls == 0
+    # 70% of the points on the previous plane: below 0.8*0.9, RANSAC is run again
+    points = np.vstack((ground_points([0, 0, 1, 1], n=1400), ground_points(ransac_plane, n=600, seed=1) + [0, 0, 5]))
+    plane_model, ratio = tracker.estimate(points, threshold=0.01, index=2)
+    assert tracker.ransac.calls == 1
+    assert np.allclose(plane_model, ransac_plane)
+    assert ratio == 0.95
+    # the next scans are compared with the ratio of the new RANSAC
+    assert tracker.planes[2][1] == 0.95
+
+
+def test_planes_are_estimated_in_index_order():
+    tracker = PlaneTracker()
+    tracker.ransac = FakeRansac([0, 0, 1, 1], 0.9)
+    results = {}
+
+    def estimate(index):
+        results[index] = tracker.estimate(ground_points([0, 0, 1, 1], seed=index), threshold=0.01, index=index)
+
+    # the scan 1 is started first, but it is seeded with the plane of the scan 0
+    thread = threading.Thread(target=estimate, args=(1,))
+    thread.start()
+    thread.join(timeout=0.2)
+    assert thread.is_alive()
+    estimate(0)
+    thread.join()
+    assert tracker.ransac.calls == 1
+    assert tracker.number_of_tracked == 1
+    assert set(tracker.planes.keys()) == {0, 1}
+
+
+def test_skipped_scans_are_not_waited_for():
+    tracker = PlaneTracker()
+    tracker.ransac = FakeRansac([0, 0, 1, 1], 0.9)
+    tracker.skip(0)
+    tracker.estimate(ground_points([0, 0, 1, 1]), threshold=0.01, index=1)
+    assert tracker.ransac.calls == 1
@@ -0,0 +1,45 @@
+import numpy as np
+
+from graphslam.positiongrid import PositionGrid
+
+
+def brute_force(positions, point, radius, max_index=None):
+    if max_index is not None:
+        positions = positions[0:max_index]
+    d = np.linalg.norm(positions - point, axis=1)
+    return np.where(d < radius)[0]
+
+
+def test_query_radius_matches_brute_force():
+    rng = np.random.default_rng(0)
+    positions = np.cumsum(rng.normal(0, 1.0, (500, 3)), axis=0)
+    grid = PositionGrid(cell_size=5.0)
+    grid.update(positions)
+    for k in range(100):
+        point = positions[rng.integers(len(positions))] + rng.normal(0, 2.0, 3)
+        radius = rng.uniform(0.5, 12.0)
+        max_index = rng.integers(len(positions))
+        assert np.array_equal(grid.query_radius(point, radius), brute_force(positions, point, radius))
+        assert np.array_equal(grid.query_radius(point, radius, max_index=max_index),
+                              brute_force(positions, point, radius, max_index=max_index))
+
+
+def test_update_after_optimization_and_rebuild():
+    rng = np.random.default_rng(1)
+    positions = np.cumsum(rng.normal(0, 1.0, (300, 3)), axis=0)
+    grid = PositionGrid(cell_size=5.0)
+    grid.update(positions)
+    # an optimization moves part of the positions and new positions are added
+    positions = np.vstack((positions, positions[-1] + np.cumsum(rng.normal(0, 1.0, (50, 3)), axis=0)))
+    positions[100:] += rng.normal(0, 3.0, (len(positions) - 100, 3))
+    grid.update(positions)
+    # the positions are replaced by a shorter trajectory
+    shorter = np.cumsum(rng.normal(0, 1.0, (120, 3)), axis=0)
+    for points in [positions, shorter]:
+        grid.update(points)
+        assert len(grid) == len(points)
+        # each position is stored once, in its cell
+        assert sum([len(indexes) for indexes in grid.grid.values()]) == len(points)
+        for k in range(50):
+            point = points[rng.integers(len(points))]
+            assert np.array_equal(grid.query_radius(point, 5.0), brute_force(points, point, 5.0))
@@ -0,0 +1,57 @@
+import threading
+import time
+import pytest
+
+from keyframemanager.prefetcher import KeyFramePrefetcher
+
+
+class StubKeyFrameManager():
+    """
+    Loads the keyframes 0, 1, 2... in the background. The later keyframes are loaded faster, so that they finish
+    out of order.
+    """
+    def __init__(self, n, fail_index=None):
+        self.keyframes = ['keyframe_' + str(i) for i in range(n)]
+        self.loaded = []
+        self.fail_index = fail_index
+        self.lock = threading.Lock()
+
+    def load_and_pre_process(self, index):
+        time.sleep(0.01*(len(self.keyframes) - index) / len(self.keyframes))
+        if index == self.fail_index:
+            raise IOError('Could not read the scan: ' + str(index))
+        with self.lock:
+            self.loaded.append(index)
+
+
+def test_keyframes_are_returned_in_order():
+    keyframe_manager = StubKeyFrameManager(20)
+    prefetcher = KeyFramePrefetcher(keyframe_manager, prefetch_depth=4, number_of_workers=3)
+    for i in range(20):
+        assert prefetcher.get(i) == 'keyframe_' + str(i)
+        # the keyframe has been loaded before it is returned
+        assert i in keyframe_manager.loaded
+    prefetcher.close()
+    # each keyframe is loaded once
+    assert sorted(keyframe_manager.loaded) == list(range(20))
+
+
+def test_get_after_close():
+    keyframe_manager = StubKeyFrameManager(20)
+    prefetcher = KeyFramePrefetcher(keyframe_manager, prefetch_depth=4, number_of_workers=2)
+    prefetcher.get(0)
+    prefetcher.close()
+    # the pending keyframes are cancelled: they are loaded when requested
+    for i in range(1, 20):
+        assert prefetcher.get(i) == 'keyframe_' + str(i)
+    assert sorted(keyframe_manager.loaded) == list(range(20))
+
+
+def test_worker_exception_is_raised_in_get():
+    keyframe_manager = StubKeyFrameManager(10, fail_index=3)
+    prefetcher = KeyFramePrefetcher(keyframe_manager, prefetch_depth=4, number_of_workers=2)
+    for i in range(3):
+        prefetcher.get(i)
+    with pytest.raises(IOError):
+        prefetcher.get(3)
+    prefetcher.close()
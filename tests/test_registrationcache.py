@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from artelib.euler import Euler
+from artelib.homogeneousmatrix import HomogeneousMatrix
+from keyframemanager.registrationcache import RegistrationCache
+
+
+class StubKeyFrame():
+    def __init__(self, scan_time, voxel_size=None):
+        self.scan_time = scan_time
+        self.voxel_size = voxel_size
+
+    def preprocessing_key(self, method):
+        return str(self.voxel_size)
+
+
+def test_key_is_stable():
+    cache = RegistrationCache(decimals=2)
+    keyframe_i = StubKeyFrame(1000)
+    keyframe_j = StubKeyFrame(2000)
+    T = HomogeneousMatrix(np.array([1.0, 2.0, 0.0]), Euler([0.0, 0.0, 0.1]))
+    key = cache.key(keyframe_i, keyframe_j, 'icppointplane', T)
+    # the same registration gives the same key, also with small changes of the initial transform (and -0.0)
+    assert cache.key(keyframe_i, keyframe_j, 'icppointplane', T) == key
+    T_close = HomogeneousMatrix(np.array([1.001, 2.0, -0.0001]), Euler([0.0, 0.0, 0.1]))
+    assert cache.key(keyframe_i, keyframe_j, 'icppointplane', T_close) == key
+    # any change of the scans, method, engine, pre-processing or initial transform gives a different key
+    T_far = HomogeneousMatrix(np.array([1.1, 2.0, 0.0]), Euler([0.0, 0.0, 0.1]))
+    keys = [cache.key(keyframe_j, keyframe_i, 'icppointplane', T),
+            cache.key(keyframe_i, keyframe_j, 'icp2planes', T),
+            cache.key(keyframe_i, keyframe_j, 'icppointplane', T, engine='numpy'),
+            cache.key(StubKeyFrame(1000, voxel_size=0.2), keyframe_j, 'icppointplane', T),
+            cache.key(keyframe_i, keyframe_j, 'icppointplane', T_far)]
+    assert key not in keys
+    assert len(set(keys)) == len(keys)
+
+
+def test_hit_and_miss():
+    cache = RegistrationCache()
+    assert cache.get('a') is None
+    assert not cache.contains('a')
+    cache.put('a', np.eye(4), 0.9, 0.1)
+    assert cache.contains('a')
+    transform, fitness, inlier_rmse = cache.get('a')
+    assert np.array_equal(transform, np.eye(4))
+    assert (fitness, inlier_rmse) == (0.9, 0.1)
+    assert cache.get('b') is None
+    assert cache.hits == 1
+
+
+def test_save_and_load(tmp_path):
+    filename = str(tmp_path) + '/SLAM/registration_cache.npz'
+    cache = RegistrationCache(filename=filename)
+    T = HomogeneousMatrix(np.array([1.0, 2.0, 3.0]), Euler([0.1, 0.2, 0.3])).array
+    cache.put('a', T, 0.9, 0.1)
+    cache.put('b', np.eye(4), 0.5, 0.2)
+    cache.save()
+    cache = RegistrationCache(filename=filename)
+    assert len(cache.results) == 2
+    transform, fitness, inlier_rmse = cache.get('a')
+    assert np.allclose(transform, T)
+    assert (fitness, inlier_rmse) == (0.9, 0.1)
+    # a corrupt file is ignored (all the registrations are computed again)
+    with open(filename, 'wb') as file:
+        file.write(b'not a npz file')
+    cache = RegistrationCache(filename=filename)
+    assert len(cache.results) == 0
+
+
+def test_key_changes_with_preprocessing_parameters():
+    pytest.importorskip('open3d')
+    from keyframemanager.keyframe import KeyFrame
+    cache = RegistrationCache()
+    T = HomogeneousMatrix()
+    keyframe_j = KeyFrame(directory=None, scan_time=2000, voxel_size=0.1)
+    key = cache.key(KeyFrame(directory=None, scan_time=1000, voxel_size=0.1), keyframe_j, 'icppointplane', T)
+    assert cache.key(KeyFrame(directory=None, scan_time=1000, voxel_size=0.1), keyframe_j, 'icppointplane', T) == key
+    # the registrations computed with other pre-processing parameters are not reused
+    assert cache.key(KeyFrame(directory=None, scan_time=1000, voxel_size=0.2), keyframe_j, 'icppointplane',
+                     T) != key
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from artelib.euler import Euler
+from artelib.homogeneousmatrix import HomogeneousMatrix
+from keyframemanager.kdtreeicp import build_kdtree
+from keyframemanager.registrationengine import create_registration_engine, NumpyEngine, Open3DEngine
+
+
+def corner():
+    """
+    Points and normals of three orthogonal planes (a corner), so that the registration is well constrained.
+    """
+    rng = np.random.default_rng(0)
+    n = 1000
+    a = rng.uniform(-5, 5, (n, 2))
+    zeros = np.zeros(n)
+    points = np.vstack((np.column_stack((a, zeros)),
+                        np.column_stack((a[:, 0], zeros, a[:, 1])),
+                        np.column_stack((zeros, a))))
+    normals = np.vstack((np.tile([0.0, 0.0, 1.0], (n, 1)),
+                         np.tile([0.0, 1.0, 0.0], (n, 1)),
+                         np.tile([1.0, 0.0, 0.0], (n, 1))))
+    return points, normals
+
+
+def test_create_registration_engine():
+    assert isinstance(create_registration_engine('open3d'), Open3DEngine)
+    assert isinstance(create_registration_engine('numpy'), NumpyEngine)
+    assert create_registration_engine('numpy').name == 'numpy'
+    with pytest.raises(ValueError):
+        create_registration_engine('unknown')
+
+
+@pytest.mark.parametrize('point_to_plane', [False, True])
+def test_numpy_icp_recovers_rigid_transform(point_to_plane):
+    target_points, target_normals = corner()
+    T = HomogeneousMatrix(np.array([0.2, -0.1, 0.05]), Euler([0.02, -0.01, 0.05])).array
+    # the source points are the target points seen from T, so that T transforms the source onto the target
+    source_points = np.dot(target_points - T[0:3, 3], T[0:3, 0:3])
+    if not point_to_plane:
+        target_normals = None
+    transform, fitness, inlier_rmse = NumpyEngine().icp(source_points, build_kdtree(target_points), 1.0, np.eye(4),
+                                                        target_normals=target_normals, max_iteration=60)
+    assert np.allclose(transform.array, T, atol=1e-6)
+    assert fitness == pytest.approx(1.0)
+    assert inlier_rmse < 1e-6
+
+
+def test_numpy_engine_rejects_fpfh():
+    with pytest.raises(ValueError):
+        NumpyEngine().register(None, None, np.eye(4), 'fpfh')
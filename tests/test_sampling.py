@@ -0,0 +1,103 @@
+"""
+Test the vectorized odometry sampling and Euler kernels against the original per-row conversions.
+"""
+import os
+import warnings
+import numpy as np
+import pandas as pd
+from artelib.quaternion import Quaternion
+from artelib.tools import euler2rot, euler2rot_array, euler2q, euler2q_array, q2euler, q2euler_array
+from eurocreader.eurocreader import EurocReader
+from tools.sampling import sample_odometry
+
+
+def odometry(n=200, seed=0):
+    """
+    A random odometry, turning more than a full circle (crossing th = +-pi, where qw = 0) with some noise in roll and
+    pitch.
+    """
+    rng = np.random.default_rng(seed)
+    th = np.cumsum(rng.uniform(0, 0.1, n))
+    abg = np.column_stack((rng.normal(0, 0.01, n), rng.normal(0, 0.01, n), th))
+    q = euler2q_array(abg)
+    xy = np.cumsum(rng.uniform(-0.2, 0.2, (n, 2)), axis=0)
+    df_odo = pd.DataFrame({'#timestamp [ns]': np.arange(n)*100000000,
+                           'x': xy[:, 0], 'y': xy[:, 1], 'z': np.zeros(n),
+                           'qx': q[:, 1], 'qy': q[:, 2], 'qz': q[:, 3], 'qw': q[:, 0]})
+    return df_odo
+
+
+def sample_odometry_loop(df_odo, deltaxy=0.5, deltath=0.2):
+    """
+    The original sampling: a Quaternion and a DataFrame concat for each row.
+    """
+    df_sampled_odo = pd.DataFrame(columns=['#timestamp [ns]', 'x', 'y', 'z', 'qx', 'qy', 'qz', 'qw'])
+    odo_times = []
+    for ind in df_odo.index:
+        position = [df_odo['x'][ind], df_odo['y'][ind], df_odo['z'][ind]]
+        q = Quaternion([df_odo['qw'][ind], df_odo['qx'][ind], df_odo['qy'][ind], df_odo['qz'][ind]])
+        th = q.Euler()[0]
+        odo = np.array([position[0], position[1], th.abg[2]])
+        current_time = df_odo['#timestamp [ns]'][ind]
+        if ind == 0:
+            odo_times.append(current_time)
+            odoi = odo
+            df_temp = pd.DataFrame(df_odo.iloc[ind])
+            df_sampled_odo = pd.concat([df_sampled_odo, df_temp.T], ignore_index=True)
+        odoi1 = odo
+        dxy = np.linalg.norm(odoi1[0:2] - odoi[0:2])
+        dth = np.linalg.norm(odoi1[2] - odoi[2])
+        if dxy > deltaxy or dth > deltath:
+            odo_times.append(current_time)
+            odoi = odoi1
+            df_temp = pd.DataFrame(df_odo.iloc[ind])
+            df_sampled_odo = pd.concat([df_sampled_odo, df_temp.T], ignore_index=True)
+    return np.array(odo_times), df_sampled_odo
+
+
+def test_euler_kernels_match_scalar():
+    rng = np.random.default_rng(1)
+    abg = rng.uniform(-np.pi, np.pi, (50, 3))
+    # gimbal lock (beta = +-pi/2) and rotations of 180 degrees (qw = 0)
+    special = np.array([[0.3, np.pi/2, -1.2], [-2.5, -np.pi/2, 2.0], [0, np.pi/2, 0],
+                        [np.pi, 0, 0], [0, np.pi, 0], [0, 0, np.pi], [0, 0, -np.pi]])
+    abg = np.concatenate((abg, special))
+    R = euler2rot_array(abg)
+    Q = euler2q_array(abg)
+    e1, e2 = q2euler_array(Q)
+    for i in range(len(abg)):
+        assert np.allclose(R[i], euler2rot(abg[i]))
+        assert np.allclose(Q[i], euler2q(abg[i]))
+        expected_e1, expected_e2 = q2euler(Q[i])
+        assert np.allclose(e1[i], expected_e1)
+        assert np.allclose(e2[i], expected_e2)
+    assert np.allclose(Q[53:57, 0], 0)
+    # both solutions are the same rotation
+    # caution: with beta = -pi/2, rot2euler (and rot2euler_array, as it must match) returns gamma = alpha - gamma
+    valid = ~np.isclose(abg[:, 1], -np.pi/2)
+    assert np.allclose(euler2rot_array(e1[valid]), R[valid])
+    assert np.allclose(euler2rot_array(e2[valid]), R[valid])
+
+
+def test_sample_odometry_match_loop():
+    df_odo = odometry()
+    times, df_sampled_odo = sample_odometry(df_odo, deltaxy=0.5, deltath=0.2)
+    with warnings.catch_warnings():
+        # concat with an empty DataFrame
+        warnings.simplefilter('ignore', FutureWarning)
+        expected_times, expected_df = sample_odometry_loop(df_odo, deltaxy=0.5, deltath=0.2)
+    assert len(times) > 10
+    assert np.array_equal(times, expected_times)
+    pd.testing.assert_frame_equal(df_sampled_odo, expected_df, check_dtype=False)
+
+
+def test_euroc_sample_odometry_match_loop(tmp_path):
+    df_odo = odometry(seed=2)
+    os.makedirs(str(tmp_path) + '/robot0/lidar')
+    df_odo.to_csv(str(tmp_path) + '/robot0/lidar/data.csv', index=False)
+    euroc_read = EurocReader(directory=str(tmp_path))
+    times = euroc_read.sample_odometry(deltaxy=0.5, deltath=0.2)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        expected_times, _ = sample_odometry_loop(euroc_read.read_csv('/robot0/lidar/data.csv'))
+    assert np.array_equal(times, expected_times)
@@ -0,0 +1,62 @@
+"""
+Test the memory-mapped scan store.
+"""
+import os
+import numpy as np
+import pytest
+from keyframemanager.scanstore import ScanStore, ScanStoreWriter, STORE_DIRECTORY
+
+
+def test_write_and_read(tmp_path):
+    directory = str(tmp_path)
+    rng = np.random.default_rng(0)
+    scans = {100: rng.random((10, 3)), 200: np.zeros((0, 3)), 300: rng.random((5, 3))}
+    writer = ScanStoreWriter(directory=directory)
+    for scan_time, points in scans.items():
+        writer.add_scan(scan_time, points)
+    writer.close()
+    scan_store = ScanStore(directory=directory)
+    for scan_time, points in scans.items():
+        assert scan_store.get_points(scan_time).shape == points.shape
+        assert np.allclose(scan_store.get_points(scan_time), points.astype(np.float32))
+
+
+def test_empty_store(tmp_path):
+    directory = str(tmp_path)
+    # no scans
+    ScanStoreWriter(directory=directory).close()
+    scan_store = ScanStore(directory=directory)
+    assert len(scan_store.points) == 0
+    # only empty scans
+    writer = ScanStoreWriter(directory=directory)
+    writer.add_scan(100, np.zeros((0, 3)))
+    writer.close()
+    scan_store = ScanStore(directory=directory)
+    assert scan_store.get_points(100).shape == (0, 3)
+
+
+def test_truncated_store(tmp_path):
+    directory = str(tmp_path)
+    writer = ScanStoreWriter(directory=directory)
+    writer.add_scan(100, np.ones((10, 3)))
+    writer.close()
+    # the data file is empty, but the index lists 10 points
+    open(directory + STORE_DIRECTORY + 'points.bin', 'wb').close()
+    with pytest.raises(ValueError):
+        ScanStore(directory=directory)
+
+
+def test_save_pointcloud_from_store_is_rejected(tmp_path):
+    pytest.importorskip('open3d')
+    from keyframemanager.keyframe import KeyFrame
+    directory = str(tmp_path)
+    writer = ScanStoreWriter(directory=directory)
+    writer.add_scan(100, np.ones((10, 3)))
+    writer.close()
+    keyframe = KeyFrame(directory=directory, scan_time=100, voxel_size=None, scan_store=ScanStore(directory=directory))
+    keyframe.load_pointcloud()
+    with pytest.raises(ValueError):
+        keyframe.save_pointcloud()
+    with pytest.raises(ValueError):
+        keyframe.save_pointcloud_as_mesh()
+    assert not os.path.exists(directory + '/robot0/lidar/dataply')
@@ -0,0 +1,75 @@
+import numpy as np
+
+from tools.graphslam import GraphSLAM, Vertex, Edge
+
+
+def build_graph(N=30, seed=0):
+    """
+    A random 2D trajectory with odometry edges and some loop closing edges, with noise.
+    """
+    rng = np.random.default_rng(seed)
+    poses = np.cumsum(rng.normal(0, 1.0, (N, 3)), axis=0)
+    vertices = [Vertex(i, poses[i] + rng.normal(0, 0.1, 3)) for i in range(N)]
+    pairs = [(i, i+1) for i in range(N-1)] + [(0, N-1), (3, 17), (5, 25), (10, 20)]
+    edges = []
+    for i, j in pairs:
+        # the pose of j seen from i
+        c, s = np.cos(poses[i, 2]), np.sin(poses[i, 2])
+        d = poses[j, 0:2] - poses[i, 0:2]
+        zij = np.array([c*d[0] + s*d[1], -s*d[0] + c*d[1], poses[j, 2] - poses[i, 2]]) + rng.normal(0, 0.05, 3)
+        edges.append(Edge(i, j, zij, np.diag(rng.uniform(10, 100, 3))))
+    return vertices, edges
+
+
+def dense_hessian(graphslam):
+    """
+    H and b built with the scalar Edge methods and dense blocks (the original implementation).
+    """
+    n = len(graphslam.x)
+    H = np.zeros((n, n))
+    b = np.zeros(n)
+    for edge in graphslam.edges:
+        i, j = 3*edge.i, 3*edge.j
+        Aij = edge.Aij(graphslam.x)
+        Bij = edge.Bij(graphslam.x)
+        eij = edge.eij(graphslam.x)
+        H[i:i+3, i:i+3] += Aij.T @ edge.Oij @ Aij
+        H[i:i+3, j:j+3] += Aij.T @ edge.Oij @ Bij
+        H[j:j+3, i:i+3] += Bij.T @ edge.Oij @ Aij
+        H[j:j+3, j:j+3] += Bij.T @ edge.Oij @ Bij
+        b[i:i+3] += Aij.T @ edge.Oij @ eij
+        b[j:j+3] += Bij.T @ edge.Oij @ eij
+    H[0:3, 0:3] += np.eye(3)
+    return H, b
+
+
+def test_sparse_hessian_and_solve_match_dense():
+    vertices, edges = build_graph()
+    graphslam = GraphSLAM(vertices, edges)
+    for iteration in range(3):
+        H, b = dense_hessian(graphslam)
+        graphslam.compute_hessian()
+        assert np.allclose(graphslam.H.toarray(), H, atol=1e-9)
+        assert np.allclose(graphslam.b, b, atol=1e-9)
+        x = graphslam.x.copy()
+        dx = graphslam.solve_deltax()
+        assert np.allclose(dx, -np.linalg.solve(H, b), atol=1e-9)
+        assert np.allclose(graphslam.x, x + dx)
+
+
+def test_marginal_covariances_match_dense_inverse():
+    vertices, edges = build_graph()
+    graphslam = GraphSLAM(vertices, edges)
+    x, H = graphslam.optimize(plot=False)
+    # the covariances relative to pose 0: the inverse of H without pose 0
+    S = np.linalg.inv(H.toarray()[3:, 3:])
+    indexes = [5, 0, 29, 1, 5]
+    covariances = graphslam.marginal_covariances(indexes)
+    for k, i in enumerate(indexes):
+        if i == 0:
+            assert np.allclose(covariances[k], np.zeros((3, 3)))
+        else:
+            assert np.allclose(covariances[k], S[3*(i-1):3*i, 3*(i-1):3*i], atol=1e-12)
+    # all the poses at once
+    assert np.allclose(graphslam.marginal_covariances(range(1, 30)),
+                       np.array([S[3*i:3*i+3, 3*i:3*i+3] for i in range(29)]), atol=1e-12)
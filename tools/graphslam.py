@@ -1,11 +1,18 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.patches import Ellipse
+from scipy import sparse
+from scipy.sparse import linalg as splinalg
 from tools.simulate import mod_2pi
 
 
 class GraphSLAM():
     def __init__(self, vertices, edges, ground_truth=None):
+        """
+        The Hessian H is built as a sparse matrix (scipy.sparse) from the 3x3 blocks of all the edges at once and the
+        system H*dx = -b is solved with a sparse LU factorization. Only the 3x3 blocks of H that correspond to an edge
+        are stored, so that large graphs (thousands of poses) can be optimized.
+        """
         self.ground_truth = ground_truth
         self.vertices = vertices
         self.edges = edges
@@ -13,7 +20,10 @@ class GraphSLAM():
         self.H = []
         self.b = []
         self.indexesH = []
+        # marginal covariances (3x3) of the poses, relative to pose 0, by vertex index
+        self.S = {}
         self.init_x()
+        self.init_edges()
 
     def init_x(self):
         """
@@ -27,7 +37,23 @@ class GraphSLAM():
             self.x[i*3 + 2] = self.vertices[i].x[2]
         return
 
-    def optimize(self):
+    def init_edges(self):
+        """
+        Store the edges as arrays: indexes i, j, observations zij (E, 3) and information matrices Oij (E, 3, 3).
+        """
+        E = len(self.edges)
+        self.edges_i = np.array([int(edge.i) for edge in self.edges], dtype=np.int64)
+        self.edges_j = np.array([int(edge.j) for edge in self.edges], dtype=np.int64)
+        self.edges_zij = np.array([edge.zij for edge in self.edges], dtype=float).reshape(E, 3)
+        self.edges_Oij = np.array([edge.Oij for edge in self.edges], dtype=float).reshape(E, 3, 3)
+        # the row and column of H of each element of the blocks Hii, Hij, Hji and Hjj (E, 4, 3, 3)
+        k = np.arange(3)
+        first = np.stack((self.edges_i, self.edges_i, self.edges_j, self.edges_j), axis=1)
+        second = np.stack((self.edges_i, self.edges_j, self.edges_i, self.edges_j), axis=1)
+        self.rowsH = np.broadcast_to(3*first[:, :, None, None] + k[None, None, :, None], (E, 4, 3, 3)).ravel()
+        self.colsH = np.broadcast_to(3*second[:, :, None, None] + k[None, None, None, :], (E, 4, 3, 3)).ravel()
+
+    def optimize(self, plot=True):
         """
         Perform iterations until dx is low
         :return:
@@ -35,77 +61,145 @@ class GraphSLAM():
         self.init_x()
         while True:
             self.compute_hessian()
-            # compute directly by inverting H (the information matrix)
+            # solve H*dx = -b with a sparse factorization of H (the information matrix)
             dx = self.solve_deltax()
             if np.linalg.norm(dx) < 0.01:
                 break
         # unfix H
-        self.H[0:3, 0:3] -= np.eye(3)
-        # now resize H, removing row and column to compute
-        n = len(self.x)
-        self.plotH()
-        # uncertainties relative to pose 0
-        H2 = self.H[3:n, 3:n]
-        self.S = np.linalg.inv(H2)
-        self.plotS()
-        self.plot_uncertainty()
+        prior = np.zeros(len(self.x))
+        prior[0:3] = 1
+        self.H = (self.H - sparse.diags(prior)).tocsc()
+        self.S = {}
+        if plot:
+            self.plotH()
+            # uncertainties relative to pose 0
+            self.plot_uncertainty()
         return self.x, self.H
 
     def compute_hessian(self):
         N = len(self.vertices)
-        self.H = np.zeros((3*N, 3*N))
+        # Jacobians and errors of all the edges (E, 3, 3) and (E, 3)
+        Aij = self.compute_Aij()
+        Bij = self.compute_Bij()
+        eij = self.compute_eij()
+        Oij = self.edges_Oij
+        AtO = np.matmul(np.transpose(Aij, (0, 2, 1)), Oij)
+        BtO = np.matmul(np.transpose(Bij, (0, 2, 1)), Oij)
+        Hii = np.matmul(AtO, Aij)
+        Hij = np.matmul(AtO, Bij)
+        Hji = np.matmul(BtO, Aij)
+        Hjj = np.matmul(BtO, Bij)
+        bi = np.einsum('eij,ej->ei', AtO, eij)
+        bj = np.einsum('eij,ej->ei', BtO, eij)
+        # compute F based on the errors eij
+        F = np.einsum('ei,eij,ej->', eij, Oij, eij)
+        # build H from the (row, col, value) triplets of all the blocks, repeated entries are summed
+        # the first pose is fixed by adding the identity to its block
+        values = np.stack((Hii, Hij, Hji, Hjj), axis=1).ravel()
+        rows = np.concatenate((self.rowsH, np.arange(3)))
+        cols = np.concatenate((self.colsH, np.arange(3)))
+        values = np.concatenate((values, np.ones(3)))
+        self.H = sparse.coo_matrix((values, (rows, cols)), shape=(3*N, 3*N)).tocsc()
         self.b = np.zeros(3*N)
-        # Function F to be minimized
-        F = 0
-        for edge in self.edges:
-            Aij = edge.Aij(self.x)
-            Bij = edge.Bij(self.x)
-            eij = edge.eij(self.x)
-            Oij = edge.Oij
-            Hii = np.dot(Aij.T, np.dot(Oij, Aij))
-            Hij = np.dot(Aij.T, np.dot(Oij, Bij))
-            Hji = np.dot(Bij.T, np.dot(Oij, Aij))
-            Hjj = np.dot(Bij.T, np.dot(Oij, Bij))
-            bi = np.dot(Aij.T, np.dot(Oij, eij))
-            bj = np.dot(Bij.T, np.dot(Oij, eij))
-            # compute F based on the errors eij
-            F += np.dot(eij.T, np.dot(Oij, eij))
-            # update +=Hii, Hij, Hji, and Hjj
-            # update +=bi, +=bj
-            # update in full H
-            self.update_Hb(edge.i, edge.j, Hii, Hij, Hji, Hjj, bi, bj)
-            # self.plotH()
-        self.H[0:3, 0:3] += np.eye(3)
+        k = np.arange(3)
+        np.add.at(self.b, (3*self.edges_i[:, None] + k).ravel(), bi.ravel())
+        np.add.at(self.b, (3*self.edges_j[:, None] + k).ravel(), bj.ravel())
         print('F is: ', F)
-        # self.plotH()
         return self.H, self.b
 
-    def plotH(self):
-        plt.figure()
-        plt.matshow(self.H)
-        plt.show()
+    def compute_Aij(self):
+        """
+        Vectorized Edge.Aij for all the edges (E, 3, 3).
+        """
+        ti = self.x.reshape(-1, 3)[self.edges_i]
+        tj = self.x.reshape(-1, 3)[self.edges_j]
+        c = np.cos(ti[:, 2] + self.edges_zij[:, 2])
+        s = np.sin(ti[:, 2] + self.edges_zij[:, 2])
+        dx = ti[:, 0] - tj[:, 0]
+        dy = ti[:, 1] - tj[:, 1]
+        Aij = np.zeros((len(ti), 3, 3))
+        Aij[:, 0, 0] = -c
+        Aij[:, 0, 1] = -s
+        Aij[:, 0, 2] = s*dx - c*dy
+        Aij[:, 1, 0] = s
+        Aij[:, 1, 1] = -c
+        Aij[:, 1, 2] = c*dx + s*dy
+        Aij[:, 2, 2] = -1
+        return Aij
+
+    def compute_Bij(self):
+        """
+        Vectorized Edge.Bij for all the edges (E, 3, 3).
+        """
+        ti = self.x.reshape(-1, 3)[self.edges_i]
+        c = np.cos(ti[:, 2] + self.edges_zij[:, 2])
+        s = np.sin(ti[:, 2] + self.edges_zij[:, 2])
+        Bij = np.zeros((len(ti), 3, 3))
+        Bij[:, 0, 0] = c
+        Bij[:, 0, 1] = s
+        Bij[:, 1, 0] = -s
+        Bij[:, 1, 1] = c
+        Bij[:, 2, 2] = 1
+        return Bij
+
+    def compute_eij(self):
+        """
+        Vectorized Edge.eij for all the edges (E, 3).
+        """
+        ti = self.x.reshape(-1, 3)[self.edges_i]
+        tj = self.x.reshape(-1, 3)[self.edges_j]
+        xij = self.edges_zij[:, 0]
+        yij = self.edges_zij[:, 1]
+        thij = self.edges_zij[:, 2]
+        ci = np.cos(ti[:, 2])
+        si = np.sin(ti[:, 2])
+        dx = ti[:, 0] - tj[:, 0]
+        dy = ti[:, 1] - tj[:, 1]
+        u = xij + ci*dx + si*dy
+        v = yij + ci*dy - si*dx
+        eij = np.zeros((len(ti), 3))
+        eij[:, 0] = -np.cos(thij)*u - np.sin(thij)*v
+        eij[:, 1] = np.sin(thij)*u - np.cos(thij)*v
+        eij[:, 2] = mod_2pi(tj[:, 2] - ti[:, 2] - thij)
+        return eij
 
-    def plotS(self):
+    def plotH(self):
         plt.figure()
-        plt.matshow(self.S)
+        plt.spy(self.H, markersize=1)
         plt.show()
 
-    def update_Hb(self, i, j, Hii, Hij, Hji, Hjj, bi, bj):
-        self.H[3*i:3*i + 3, 3*i:3*i + 3] += Hii
-        self.H[3*i:3*i + 3, 3*j:3*j + 3] += Hij
-        self.H[3*j:3*j + 3, 3*i:3*i + 3] += Hji
-        self.H[3*j:3*j + 3, 3*j:3*j + 3] += Hjj
-        self.b[3*i:3*i+3] += bi
-        self.b[3*j:3*j+3] += bj
-        return
-
     def solve_deltax(self):
         # dx = solve(H, -b)
-        dx = -np.dot(np.linalg.inv(self.H), self.b)
+        dx = -splinalg.spsolve(self.H, self.b)
         self.x = self.x + dx
         print('Norm update is: ', np.linalg.norm(dx))
         return dx
 
+    def marginal_covariances(self, indexes):
+        """
+        Return the marginal covariances (len(indexes), 3, 3) of the poses in indexes, relative to pose 0 (which is
+        fixed). Call after optimize. Only the requested 3x3 blocks of the inverse of H are computed: H (without pose 0)
+        is factorized once and solved for the 3 columns of each requested pose, that are not stored already in self.S.
+        """
+        indexes = [int(i) for i in indexes]
+        missing = [i for i in indexes if i not in self.S and i > 0]
+        if len(missing) > 0:
+            n = len(self.x)
+            # remove the rows and columns of pose 0
+            H2 = self.H[3:n, 3:n].tocsc()
+            lu = splinalg.splu(H2)
+            # solve by chunks of poses to keep the memory bounded
+            for k in range(0, len(missing), 256):
+                chunk = np.array(missing[k:k+256])
+                cols = (3*(chunk[:, None] - 1) + np.arange(3)).ravel()
+                E = np.zeros((n - 3, len(cols)))
+                E[cols, np.arange(len(cols))] = 1
+                X = lu.solve(E)
+                for m, i in enumerate(chunk):
+                    self.S[int(i)] = X[3*(i-1):3*(i-1)+3, 3*m:3*m+3]
+        # pose 0 is fixed
+        return np.array([self.S[i] if i > 0 else np.zeros((3, 3)) for i in indexes]).reshape(-1, 3, 3)
+
     def plot(self, title='UNTITLED'):
         plt.figure()
         if self.ground_truth is not None:
@@ -153,10 +247,11 @@ class GraphSLAM():
             x[i, 2] = self.x[3*i + 2]
         plt.plot(x[:, 0], x[:, 1], color='blue', linestyle='dashed', marker='o', markerfacecolor='blue', markersize=12)
 
-        # remove first row and column
+        # marginal covariances of the poses 1...N-1 (pose 0 is fixed)
+        S = self.marginal_covariances(range(1, N))
         for i in range(N-1):
-            sx2 = self.S[3 * i, 3 * i]
-            sy2 = self.S[3 * i + 1, 3 * i + 1]
+            sx2 = S[i, 0, 0]
+            sy2 = S[i, 1, 1]
             mux = self.x[3 * (i+1)]
             muy = self.x[3 * (i+1) + 1]
             muth = self.x[3 * (i+1) + 2]
@@ -2,6 +2,7 @@ import numpy as np
 from artelib.homogeneousmatrix import HomogeneousMatrix
 from artelib.euler import Euler
 from artelib.quaternion import Quaternion
+from artelib.tools import q2euler_array
 import pandas as pd
 
 
@@ -9,31 +10,24 @@ def sample_odometry(df_odo, deltaxy=0.5, deltath=0.2):
     """
     Get odometry times separated by dxy (m) and dth (rad)
     """
-    df_sampled_odo = pd.DataFrame(columns=['#timestamp [ns]', 'x', 'y', 'z', 'qx', 'qy', 'qz', 'qw'])
-    odo_times = []
-    # sampled_indexes = []
-    for ind in df_odo.index:
-        # print(df_odo['x'][ind])
-        position = [df_odo['x'][ind], df_odo['y'][ind], df_odo['z'][ind]]
-        q = Quaternion([df_odo['qw'][ind], df_odo['qx'][ind], df_odo['qy'][ind], df_odo['qz'][ind]])
-        th = q.Euler()[0]
-        odo = np.array([position[0], position[1], th.abg[2]])
-        current_time = df_odo['#timestamp [ns]'][ind]
-        if ind == 0:
-            odo_times.append(current_time)
-            odoi = odo
-            df_temp = pd.DataFrame(df_odo.iloc[ind])
-            df_sampled_odo = pd.concat([df_sampled_odo, df_temp.T], ignore_index=True)
-        odoi1 = odo
-
+    columns = ['#timestamp [ns]', 'x', 'y', 'z', 'qx', 'qy', 'qz', 'qw']
+    # convert all the orientations at once
+    q = df_odo[['qw', 'qx', 'qy', 'qz']].to_numpy(dtype=float)
+    th = q2euler_array(q)[0]
+    odo = np.column_stack((df_odo['x'].to_numpy(), df_odo['y'].to_numpy(), th[:, 2]))
+    odo_times = df_odo['#timestamp [ns]'].to_numpy()
+    sampled_indexes = [0]
+    odoi = odo[0]
+    for ind in range(1, len(odo)):
+        odoi1 = odo[ind]
         dxy = np.linalg.norm(odoi1[0:2] - odoi[0:2])
         dth = np.linalg.norm(odoi1[2] - odoi[2])
         if dxy > deltaxy or dth > deltath:
-            odo_times.append(current_time)
+            sampled_indexes.append(ind)
             odoi = odoi1
-            df_temp = pd.DataFrame(df_odo.iloc[ind])
-            df_sampled_odo = pd.concat([df_sampled_odo, df_temp.T], ignore_index=True)
-    return np.array(odo_times), df_sampled_odo
+    df_sampled_odo = df_odo.iloc[sampled_indexes].reset_index(drop=True)
+    df_sampled_odo = df_sampled_odo.reindex(columns=columns + [c for c in df_odo.columns if c not in columns])
+    return odo_times[sampled_indexes], df_sampled_odo
 
 
 def sample_times(sensor_times, start_index=10, delta_time=1*1e9):
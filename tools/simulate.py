@@ -1,6 +1,6 @@
 import numpy as np
-from back_del.homogeneousmatrix import HomogeneousMatrix
-from tools.euler import Euler
+from artelib.homogeneousmatrix import HomogeneousMatrix
+from artelib.euler import Euler
 
 
 def mod_2pi(th):